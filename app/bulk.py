@@ -0,0 +1,189 @@
+"""Bulk lookup jobs. Rows are scheduled on the worker executor and results are spooled to a NDJSON file
+so that neither the input nor the results have to be held in memory"""
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+import utility
+
+logger = logging.getLogger(__name__)
+
+VALID_TERMS = ('taxnum', 'name', 'address', 'idnum')
+
+def clean_row(row):
+    """Keep only non-empty search terms of a row"""
+    return {term:str(value).strip() for term, value in row.items()
+            if term in VALID_TERMS and value is not None and str(value).strip()}
+
+class Job():
+    """State of a bulk lookup job"""
+    def __init__(self, site, command, folder):
+        self.id = uuid.uuid4().hex
+        self.site = site
+        self.command = command
+        self.folder = Path(folder) / self.id
+        self.folder.mkdir(parents=True)
+        self.input_path = self.folder / 'input'
+        self.result_path = self.folder / 'results.ndjson'
+        self.result_path.touch()
+        self.status = 'pending'
+        self.error = None
+        self.total = None # unknown until input is exhausted
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.created = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    @property
+    def done(self):
+        return self.succeeded + self.failed
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def write(self, line):
+        """Append a result line. Called from worker threads"""
+        with self._lock:
+            with open(self.result_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
+            if 'error' in line:
+                self.failed += 1
+            else:
+                self.succeeded += 1
+            self._idle.notify_all()
+
+    def wait_all(self):
+        with self._lock:
+            self._idle.wait_for(lambda: self.done >= self.submitted)
+
+    def stats(self):
+        return {'id': self.id,
+                'site': self.site,
+                'command': self.command,
+                'status': self.status,
+                'error': self.error,
+                'total': self.total,
+                'submitted': self.submitted,
+                'done': self.done,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'created': self.created,
+                'finished': self.finished}
+
+class JobManager():
+    """Create, run and keep track of bulk jobs.
+
+    Args:
+        executor (executor.BoundedExecutor): executor shared with the single lookup endpoint
+        lookup (callable): lookup(site, command, search_terms) returning the scraped result
+        folder (str, optional): where input and results are spooled. Defaults to a temporary folder.
+        concurrency (int, optional): maximum rows of one job running at the same time. Defaults to 2.
+        max_age (int, optional): seconds to keep finished jobs. Defaults to 1 day.
+    """
+    def __init__(self, executor, lookup, folder=None, concurrency=2, max_age=86400):
+        self.executor = executor
+        self.lookup = lookup
+        self.folder = Path(folder or tempfile.mkdtemp(prefix='bulk-'))
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.jobs = {}
+
+    def cleanup(self):
+        """Forget finished jobs older than max_age and delete their files"""
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.is_finished and now - job.finished > self.max_age:
+                shutil.rmtree(job.folder, ignore_errors=True)
+                del self.jobs[job_id]
+
+    def create_from_file(self, site, command, file_object):
+        """Start a job reading rows from an uploaded CSV/XLS/XLSX file object"""
+        job = self._new_job(site, command)
+        with open(job.input_path, 'wb') as f:
+            shutil.copyfileobj(file_object, f)
+        def rows():
+            with open(job.input_path, 'rb') as f:
+                yield from utility.generate_from_file(f)
+        self._start(job, rows())
+        return job
+
+    def create_from_list(self, site, command, rows):
+        """Start a job from a list of {term: value}"""
+        job = self._new_job(site, command)
+        self._start(job, enumerate(rows))
+        return job
+
+    def _new_job(self, site, command):
+        self.cleanup()
+        job = Job(site, command, self.folder)
+        self.jobs[job.id] = job
+        return job
+
+    def _start(self, job, rows):
+        threading.Thread(target=self._run, args=(job, rows), name=f'bulk-{job.id}', daemon=True).start()
+
+    def _lookup_row(self, job, index, search_terms, slots):
+        try:
+            if not search_terms:
+                raise ValueError(f'Row must contain at least one of {VALID_TERMS}')
+            result = self.lookup(job.site, job.command, search_terms)
+            job.write({'row': index, 'search_terms': search_terms, 'result': result})
+        except Exception as e:
+            logger.warning('Row %d of job %s failed: %r', index, job.id, e)
+            job.write({'row': index, 'search_terms': search_terms, 'error': repr(e)})
+        finally:
+            slots.release()
+
+    def _run(self, job, rows):
+        job.status = 'running'
+        slots = threading.Semaphore(self.concurrency)
+        try:
+            for index, row in rows:
+                slots.acquire()
+                with job._lock:
+                    job.submitted += 1
+                try:
+                    self.executor.submit(self._lookup_row, job, index, clean_row(row), slots, block=True)
+                except Exception:
+                    with job._lock:
+                        job.submitted -= 1
+                    slots.release()
+                    raise
+            job.total = job.submitted
+            job.wait_all()
+            status = 'done'
+        except Exception as e:
+            logger.exception('Job %s failed', job.id)
+            job.wait_all()
+            job.error = repr(e)
+            status = 'failed'
+        job.finished = time.time()
+        job.status = status
+        logger.info('Job %s finished: %d succeeded, %d failed', job.id, job.succeeded, job.failed)
+
+    def stream(self, job_id, poll=0.2):
+        """Yield NDJSON result lines as soon as they are written, until the job is finished"""
+        job = self.jobs[job_id]
+        with open(job.result_path, 'rb') as f:
+            pending = b''
+            while True:
+                finished = job.is_finished # read before the file so no line can be missed
+                chunk = f.readline()
+                if chunk:
+                    pending += chunk
+                    if pending.endswith(b'\n'):
+                        yield pending
+                        pending = b''
+                    continue
+                if finished:
+                    break
+                time.sleep(poll)
@@ -0,0 +1,183 @@
+"""Two-tier cache of scraped results: an in-process LRU in front of a SQLite file"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from unicodedata import normalize
+
+logger = logging.getLogger(__name__)
+
+FRESH = 'HIT'
+STALE = 'STALE'
+MISS = 'MISS'
+
+def normalize_value(value):
+    """Normalize a search value so that trivial variants share one cache entry"""
+    return ' '.join(normalize('NFKC', str(value)).casefold().split())
+
+def make_key(site, command, search_terms, options=None):
+    terms = sorted((term, normalize_value(value)) for term, value in search_terms.items())
+    key = [site, command, terms]
+    if options:
+        key.append(sorted(options.items()))
+    return json.dumps(key, ensure_ascii=False)
+
+class ResultCache():
+    """Cache keyed on (site, command, normalized search terms).
+
+    Args:
+        path (str, optional): SQLite file of the disk tier. Disk tier is disabled if None.
+        memory_size (int, optional): maximum entries kept in memory. Defaults to 1024.
+        disk_size (int, optional): maximum entries kept on disk. Defaults to 100000.
+        ttl (dict, optional): seconds an entry stays fresh, per command.
+        stale_ttl (int, optional): seconds after expiry during which a stale entry is still served
+            while it is refreshed in background. Defaults to 1 day.
+    """
+    default_ttl = {'pinpoint': 7*86400, 'sweep': 86400, 'harvest': 86400}
+    def __init__(self, path=None, memory_size=1024, disk_size=100000, ttl=None, stale_ttl=86400):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = {**self.default_ttl, **(ttl or {})}
+        self.stale_ttl = stale_ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock() # memory tier, never held during disk I/O so the event loop can read it
+        self._db_lock = threading.Lock() # disk tier, may wait for a commit
+        self._refreshing = set()
+        self._writes = 0
+        self._db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache '
+                             '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            return entry
+
+    def _memory_set(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute('SELECT value, created FROM cache WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE cache SET accessed=? WHERE key=?', (time.time(), key))
+        return json.loads(row[0]), row[1]
+
+    def _disk_set(self, key, entry):
+        if self._db is None:
+            return
+        value, created = entry
+        with self._db_lock:
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(value, ensure_ascii=False), created, time.time()))
+            self._writes += 1
+            if self._writes % 100: # counting rows is not free, only evict every 100 writes
+                return
+            count = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            if count > self.disk_size:
+                self._db.execute('DELETE FROM cache WHERE key IN '
+                                 '(SELECT key FROM cache ORDER BY accessed LIMIT ?)', (count - self.disk_size,))
+
+    def get(self, site, command, search_terms, options=None, disk=True):
+        """Return (value, state, age). state is HIT, STALE or MISS.
+        With disk=False only the memory tier is read, e.g. from the event loop, and an entry missing from
+        memory is not counted as a miss, since the caller goes on to read the disk tier"""
+        key = make_key(site, command, search_terms, options)
+        entry = self._memory_get(key)
+        if entry is None:
+            if not disk:
+                return None, MISS, None
+            entry = self._disk_get(key)
+            if entry is not None:
+                self._memory_set(key, entry)
+        if entry is not None:
+            value, created = entry
+            age = time.time() - created
+            ttl = self.ttl.get(command, 0)
+            if age < ttl:
+                self.hits += 1
+                return value, FRESH, age
+            if age < ttl + self.stale_ttl:
+                self.stale_hits += 1
+                return value, STALE, age
+        self.misses += 1
+        return None, MISS, None
+
+    def set(self, site, command, search_terms, value, options=None):
+        key = make_key(site, command, search_terms, options)
+        entry = (value, time.time())
+        self._memory_set(key, entry)
+        self._disk_set(key, entry)
+
+    def lookup(self, site, command, search_terms, lookup, options=None):
+        """Call lookup(site, command, search_terms, **options) and store its result"""
+        value = lookup(site, command, search_terms, **(options or {}))
+        self.set(site, command, search_terms, value, options)
+        return value
+
+    def fetch(self, site, command, search_terms, lookup, schedule=None, options=None):
+        """Return (value, state, age), calling lookup(site, command, search_terms, **options) on miss.
+
+        Stale entries are returned right away and refreshed through schedule(fn), e.g. a non-blocking
+        executor submit. Without schedule they are refreshed synchronously like a miss.
+        """
+        value, state, age = self.get(site, command, search_terms, options)
+        if state == FRESH:
+            return value, state, age
+        if state == STALE and schedule is not None:
+            self.refresh(site, command, search_terms, lookup, schedule, options)
+            return value, state, age
+        return self.lookup(site, command, search_terms, lookup, options), MISS, 0
+
+    def refresh(self, site, command, search_terms, lookup, schedule, options=None):
+        """Refresh an entry in background through schedule(fn). At most one refresh runs per key"""
+        key = make_key(site, command, search_terms, options)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        def refresh():
+            try:
+                self.lookup(site, command, search_terms, lookup, options)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        try:
+            schedule(refresh)
+        except Exception: # e.g. executor is saturated. Try again on next hit
+            logger.info('Could not schedule refresh for %s', key)
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            memory = len(self._memory)
+        disk = 0
+        if self._db is not None:
+            with self._db_lock:
+                disk = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'memory_entries': memory,
+                'disk_entries': disk,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses}
@@ -0,0 +1,65 @@
+"""Responses captured by the selenium-wire proxy, kept in memory for the scrapers to wait on"""
+import re
+import threading
+import time
+from collections import deque
+from selenium.common.exceptions import TimeoutException
+
+class ResponseRing():
+    """Bounded record of the responses matching the capture scopes, filled by the proxy thread.
+
+    Each scope keeps its last `size` responses as (sequence number, url, body). A scraper takes `mark()`
+    before an action and waits for the response that the action causes with `wait(pattern, mark)`.
+    """
+    def __init__(self, scopes, size=8):
+        self._scopes = [(scope, re.compile(scope)) for scope in scopes]
+        self._responses = {scope: deque(maxlen=size) for scope in scopes}
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def add(self, url, body):
+        """Record a response. Return False if it is not in any scope"""
+        for scope, pattern in self._scopes:
+            if pattern.search(url):
+                with self._cond:
+                    self._seq += 1
+                    self._responses[scope].append((self._seq, url, body))
+                    self._cond.notify_all()
+                return True
+        return False
+
+    def mark(self):
+        """Position of the last response recorded"""
+        with self._cond:
+            return self._seq
+
+    def _find(self, pattern, after, latest):
+        found = [entry for entries in self._responses.values() for entry in entries
+                 if entry[0] > after and re.search(pattern, entry[1])]
+        if not found:
+            return None
+        return max(found) if latest else min(found)
+
+    def wait(self, pattern, after=0, timeout=10, latest=False):
+        """Return the body of the first response recorded after mark `after` whose url matches pattern,
+        or the last one if latest. Raise TimeoutException like selenium-wire's wait_for_request"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                entry = self._find(pattern, after, latest)
+                if entry is not None:
+                    return entry[2]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutException(f'Timed out after {timeout}s waiting for response to {pattern}')
+                self._cond.wait(remaining)
+
+    def clear(self):
+        with self._cond:
+            for entries in self._responses.values():
+                entries.clear()
+
+    def stats(self):
+        with self._cond:
+            return {'responses': sum(len(entries) for entries in self._responses.values()),
+                    'bytes': sum(len(entry[2] or b'') for entries in self._responses.values() for entry in entries)}
@@ -0,0 +1,33 @@
+"""One-time conversion of the Tensorflow SavedModel into formats that can run in process without Tensorflow.
+
+Usage: python convert_model.py [--format tflite|onnx] [SAVED_MODEL_DIR] [OUTPUT]
+Require tensorflow (and tf2onnx for onnx) on the machine doing the conversion only.
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+DEFAULT_MODEL = Path(__file__).resolve().parent.parent / 'model' / 'CNN5_v10_acc_98_tf220_ubuntu2204' / '1'
+
+def to_tflite(saved_model, output):
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_saved_model(str(saved_model))
+    Path(output).write_bytes(converter.convert())
+
+def to_onnx(saved_model, output):
+    subprocess.run([sys.executable, '-m', 'tf2onnx.convert', '--saved-model', str(saved_model),
+                    '--output', str(output)], check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('saved_model', nargs='?', default=DEFAULT_MODEL)
+    parser.add_argument('output', nargs='?', default=None)
+    parser.add_argument('--format', choices=('tflite', 'onnx'), default='tflite')
+    args = parser.parse_args()
+    output = args.output or Path(args.saved_model).parent / f'solver.{args.format}'
+    {'tflite': to_tflite, 'onnx': to_onnx}[args.format](args.saved_model, output)
+    print(f'Saved {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Bounded worker executor to run the blocking scrapers outside of the event loop"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class ExecutorSaturated(Exception):
+    """Raised when all workers are busy and the queue is full"""
+
+class BoundedExecutor():
+    """Thread pool with at most `max_workers` running jobs and `max_queue` waiting jobs.
+
+    Submitting more than that either raises ExecutorSaturated or blocks until a slot is free,
+    so callers can apply backpressure instead of piling up work in memory.
+    """
+    def __init__(self, max_workers=2, max_queue=8):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='scraper')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.pending = 0 # running + queued
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        return self.pending - self.running
+
+    def _wrap(self, fn, *args, **kwargs):
+        with self._lock:
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self._slots.release()
+
+    def submit(self, fn, *args, block=False, timeout=None, **kwargs):
+        """Schedule fn(*args, **kwargs) and return a concurrent.futures.Future"""
+        if not self._slots.acquire(blocking=block, timeout=timeout if block else None):
+            with self._lock:
+                self.rejected += 1
+            raise ExecutorSaturated(f'{self.pending} jobs already pending')
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self._executor.submit(self._wrap, fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn in a worker thread without blocking the event loop. Raise ExecutorSaturated if full"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {'max_workers': self.max_workers,
+                    'max_queue': self.max_queue,
+                    'running': self.running,
+                    'queued': self.queued,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'rejected': self.rejected}
@@ -0,0 +1,208 @@
+"""Flat, columnar export of lookup results to CSV, Parquet or Arrow, written incrementally.
+
+Results hold one dict per row keyed by the Vietnamese headers of the site. Here every record, i.e. an outer row
+with its profile and sub-tables when they were scraped, becomes one row of a fixed schema: known headers map
+to named columns once, in COLUMNS, profile fields the schema doesn't know go to a JSON `extra` column and each
+sub-table to a JSON column. Rows are buffered column by column and written in batches, so an export of any size
+holds one batch in memory. Parquet and Arrow require pyarrow.
+"""
+import csv
+import io
+import json
+
+# header of the site -> column. Outer rows and profiles share the tax number and name
+COLUMNS = {'MST': 'taxnum',
+           'Mã số thuế': 'taxnum',
+           'Tên người nộp thuế': 'name',
+           'STT': 'row',
+           'Cơ quan thuế': 'tax_office',
+           'Số CMT/Thẻ căn cước': 'id_number',
+           'Ngày thay đổi thông tin gần nhất': 'last_changed',
+           'Ghi chú': 'note',
+           'Địa chỉ trụ sở': 'address',
+           'Cơ quan thuế quản lý': 'managing_tax_office',
+           'Ngày cấp MST': 'issued',
+           'Ngày đóng MST': 'closed',
+           'Loại hình kinh tế': 'business_type',
+           'Tình trạng': 'status'}
+SUBTABLES = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+# input_row and search tell which row of a bulk job or which search the record answers
+SCHEMA = ('input_row', 'search', 'page', *dict.fromkeys(COLUMNS.values()), 'extra',
+          *(f'sub_{name}' for name in SUBTABLES), 'error')
+FORMATS = {'csv': 'text/csv; charset=utf-8',
+           'parquet': 'application/vnd.apache.parquet',
+           'arrow': 'application/vnd.apache.arrow.stream'}
+
+class UnsupportedFormat(Exception):
+    """The export format is unknown, or its library is not installed"""
+
+def iter_records(command, result):
+    """Yield the records of a command's result as {'outer': row, 'inner': profile, 'sub': sub-tables}.
+    A pinpoint returns the first page of outer rows with the profile of the first one"""
+    if not result:
+        return
+    if command == 'harvest':
+        yield from result
+        return
+    rows = result.get('outer') or ()
+    for index, row in enumerate(rows):
+        if command == 'pinpoint' and index == 0:
+            yield {**result, 'outer': row}
+        else:
+            yield {'outer': row}
+
+def flatten(record, **context):
+    """One row of SCHEMA for a record. context fills the input_row, search, page or error columns"""
+    row = dict.fromkeys(SCHEMA)
+    extra = {}
+    inner = record.get('inner') or []
+    for fields in (*(inner if isinstance(inner, list) else [inner]), record.get('outer') or {}):
+        for header, value in fields.items():
+            column = COLUMNS.get(header)
+            if column is None:
+                extra[header] = value
+            else:
+                row[column] = value
+    if extra:
+        row['extra'] = json.dumps(extra, ensure_ascii=False)
+    for name, table in (record.get('sub') or {}).items():
+        if f'sub_{name}' in row:
+            row[f'sub_{name}'] = json.dumps(table, ensure_ascii=False)
+    for name, value in context.items():
+        row[name] = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+    return row
+
+class Drain():
+    """Write-only file collecting what a writer produces until it is drained"""
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+class ColumnWriter():
+    """Buffer rows of SCHEMA column by column and write them every `batch_size` rows"""
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.sink = Drain()
+        self.columns = {name: [] for name in SCHEMA}
+        self.rows = 0
+
+    def add(self, row):
+        """Add a row, return the bytes written meanwhile"""
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush()
+        return self.sink.drain()
+
+    def flush(self):
+        if self.rows:
+            self.write_batch()
+            for values in self.columns.values():
+                values.clear()
+            self.rows = 0
+
+    def close(self):
+        """Write the last rows and the footer, return the remaining bytes"""
+        self.flush()
+        self.finish()
+        return self.sink.drain()
+
+    def write_batch(self):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+class CsvWriter(ColumnWriter):
+    def __init__(self, batch_size=1000):
+        super().__init__(batch_size)
+        self.sink.write('\ufeff'.encode('utf-8')) # BOM, so that spreadsheets read the file as UTF-8
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(SCHEMA)
+
+    def write_batch(self):
+        self._writer.writerows(zip(*self.columns.values()))
+        self.sink.write(self._text.getvalue().encode('utf-8'))
+        self._text.seek(0)
+        self._text.truncate()
+
+class ArrowWriter(ColumnWriter):
+    """Arrow IPC stream, or Parquet with one row group per batch. Require pyarrow"""
+    def __init__(self, parquet=False, batch_size=1000):
+        super().__init__(batch_size)
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise UnsupportedFormat('Parquet and Arrow exports require pyarrow')
+        self._pa = pa
+        self.schema = pa.schema([(name, pa.int64() if name in ('input_row', 'page') else pa.string())
+                                 for name in SCHEMA])
+        if parquet:
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.sink, self.schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def write_batch(self):
+        columns = [self._pa.array(values, type=field.type) for field, values in zip(self.schema, self.columns.values())]
+        self._writer.write_batch(self._pa.RecordBatch.from_arrays(columns, schema=self.schema))
+
+    def finish(self):
+        self._writer.close()
+
+def create_writer(format, batch_size=1000):
+    if format == 'csv':
+        return CsvWriter(batch_size)
+    if format in ('parquet', 'arrow'):
+        return ArrowWriter(format == 'parquet', batch_size)
+    raise UnsupportedFormat(f'Unknown format {format}. Valid: {list(FORMATS)}')
+
+def export(rows, format='csv', batch_size=1000, writer=None):
+    """Yield the bytes of rows of SCHEMA written in format, as soon as each batch is written"""
+    writer = writer or create_writer(format, batch_size)
+    for row in rows:
+        data = writer.add(row)
+        if data:
+            yield data
+    yield writer.close()
+
+def result_rows(lines):
+    """Rows of the NDJSON result lines of a bulk job, see bulk.Job.write"""
+    for line in lines:
+        line = json.loads(line)
+        context = {'input_row': line['row'], 'search': line['search_terms']}
+        if 'error' in line:
+            yield flatten({}, **context, error=line['error'])
+            continue
+        for output in (line['result'] or {}).values(): # {str(search_terms): {'command': ..., 'result': ...}}
+            for record in iter_records(output['command'], output['result']):
+                yield flatten(record, **context)
+
+def page_rows(pages, search_terms):
+    """Rows of the pages of a sweep, see ProfileScraper.iter_sweep"""
+    for page in pages:
+        for row in page['outer']:
+            yield flatten({'outer': row}, search=search_terms, page=page['page'])
@@ -0,0 +1,378 @@
+"""Browserless scraper which replays the form posts of tracuunnt directly over HTTP.
+
+It follows the same pinpoint/sweep contract as webdriver.ProfileScraper, but only keeps
+an HTTP session and its cookie jar instead of a whole Firefox.
+
+The site keeps one captcha per session, the last one downloaded, so the next captcha of a session can only be
+fetched once its previous answer was checked. With `prefetch_captcha`, a sweep keeps a spare session whose captcha
+is fetched and solved while the current session submits; the next page, or the retry of a rejected answer, is then
+submitted from the spare session, and the two sessions swap roles. Pages are plain form posts, so any session
+can ask for any of them.
+"""
+import copy
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests as rq
+from requests.adapters import HTTPAdapter
+import lxml.html
+import metrics
+import pageparser
+import ratelimit
+from prefetch import CaptchaPrefetch
+from ratelimit import UpstreamError, CaptchaRejected
+from metrics import CAPTCHA_STATS
+
+logger = logging.getLogger(__name__)
+
+# connections are shared between all sessions, cookies are not
+ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+
+JS_ARGS = re.compile(r"""\(([^)]*)\)""")
+JS_ASSIGN = re.compile(r"""\.(\w+)\.value\s*=\s*(\w+)""")
+
+def parse_js_args(href):
+    """Extract the arguments of a javascript call such as javascript:submitform('0100109106')"""
+    match = JS_ARGS.search(href)
+    if not match or not match.group(1).strip():
+        return []
+    return [arg.strip().strip('\'"') for arg in match.group(1).split(',')]
+
+def parse_js_function(doc, name):
+    """Map the form fields assigned by an inline javascript function to the index of its arguments.
+
+    For example `function gotoPage(page) {document.myform.page.value = page; ...}` gives {'page': 0}
+    """
+    pattern = re.compile(r'function\s+%s\s*\(([^)]*)\)\s*\{(.*?)\}' % name, re.DOTALL)
+    for script in doc.xpath('//script/text()'):
+        match = pattern.search(script)
+        if match:
+            params = [p.strip() for p in match.group(1).split(',')]
+            return {field:params.index(arg) for field, arg in JS_ASSIGN.findall(match.group(2)) if arg in params}
+    return {}
+
+class HttpProfileScraper():
+    """Abstract class for browserless scraper"""
+    site = None
+    field_name = None
+    max_page = None
+    max_attempts = 5
+    timeout = 30
+    # fallbacks when the page scripts cannot be read
+    page_fields = {'page': 0}
+    detail_fields = {'tin': 0}
+    harvest_concurrency = 4
+    prefetch_captcha = False
+    def __init__(self, solver=None, base_url=None, timeout=None):
+        if not all((self.site, self.field_name, self.max_page)):
+            raise NotImplementedError("Attributes 'site', 'field_name', 'max_page' must all be implemented")
+        if not solver:
+            raise NotImplementedError("Must specify a solver first")
+        self.solver = solver
+        if base_url: # e.g. a local stand-in server
+            self.site = urljoin(base_url, self.site.split('/')[-1])
+        self.timeout = timeout or self.timeout
+        self.session = rq.Session()
+        self.session.mount('http://', ADAPTER)
+        self.session.mount('https://', ADAPTER)
+        self._doc = None # the page currently displayed
+        self._form = None # the search form
+        self._spare = None # session solving the next captcha, see prefetch_captcha
+        self._prefetch = CaptchaPrefetch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.quit()
+
+    def quit(self):
+        self._prefetch.discard()
+        if self._spare is not None:
+            self._spare.quit()
+        self.session.close()
+
+    def set_solver(self, solver):
+        """Set the solver to be used for captcha regconition. Support any class that has predict method"""
+        self.solver = solver
+
+    def _request(self, method, url, **kwargs):
+        with ratelimit.LIMITER.request():
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (rq.Timeout, rq.ConnectionError) as e:
+                raise UpstreamError(f'{method} {url} failed: {e}') from e
+            if response.status_code == 429 or response.status_code >= 500:
+                raise UpstreamError(f'{method} {url} returned {response.status_code}')
+            response.raise_for_status()
+        return response
+
+    def _retry(self, step, *args, before_retry=None, **kwargs):
+        """Run one step of a lookup, retrying it alone when the site fails"""
+        return ratelimit.RETRY.call(step, *args, before_retry=before_retry, **kwargs)
+
+    def _load(self, response):
+        """Keep the page as current page, like a browser would do"""
+        return self._show(lxml.html.fromstring(response.content))
+
+    def _show(self, doc):
+        self._doc = doc
+        form = self._doc.xpath("//input[@name='captcha']/ancestor::form[1]")
+        if form:
+            self._form = form[0]
+        return self._doc
+
+    def _form_action(self):
+        return urljoin(self.site, self._form.get('action') or self.site)
+
+    def _form_values(self):
+        values = {}
+        for elem in self._form.xpath('.//input'):
+            name = elem.get('name')
+            if name and elem.get('type', 'text').lower() not in ('button', 'submit', 'image', 'reset'):
+                values[name] = elem.get('value', '')
+        return values
+
+    @metrics.timed('captcha_fetch')
+    def _get_captcha_image(self):
+        """Download the captcha displayed on the current page"""
+        src = self._doc.xpath("//img[contains(@src, 'captcha')]/@src")[0]
+        return self._request('GET', urljoin(self.site, src)).content
+
+    def _answer_captcha(self):
+        """Use model to predict characters in captcha.
+        If the solver is not confident enough, download a new captcha instead of submitting a likely wrong answer"""
+        if not hasattr(self.solver, 'solve'):
+            image = self._get_captcha_image()
+            with metrics.span('solve'):
+                return self.solver.predict(image)
+        refresh = 0
+        while True:
+            # each download of the captcha makes the site issue a new one
+            image = self._get_captcha_image()
+            with metrics.span('solve'):
+                answer = self.solver.solve(image)
+            if self.solver.is_confident(answer) or refresh >= self.solver.max_refresh:
+                return answer.label
+            logger.debug('Refresh captcha. Confidence=%.3f', answer.confidence)
+            CAPTCHA_STATS.record_refresh()
+            refresh += 1
+
+    def _fork(self):
+        """Another session on the site, sharing the solver and showing a copy of the current page.
+        Its first captcha download starts the session, no need to open the site"""
+        other = type(self)(solver=self.solver, base_url=self.site, timeout=self.timeout)
+        other._show(copy.deepcopy(self._doc))
+        return other
+
+    def _swap(self, other):
+        """Exchange sessions and current pages with another scraper"""
+        for name in ('session', '_doc', '_form'):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            setattr(self, name, theirs)
+            setattr(other, name, mine)
+
+    def _prefetch_captcha(self):
+        """Start solving the captcha of the spare session while the current one is busy"""
+        if self._spare is None:
+            self._spare = self._fork()
+        self._prefetch.start(self._spare._answer_captcha)
+
+    def _next_answer(self):
+        """Answer of the prefetched captcha, whose session becomes current, or of the current captcha"""
+        if self._prefetch.pending:
+            answer = self._prefetch.take()
+            if answer is not None:
+                self._swap(self._spare)
+                return answer
+        return self._answer_captcha()
+
+    @metrics.timed('submit')
+    def _submit(self, values):
+        return self._load(self._request('POST', self._form_action(), data=values))
+
+    def _js_values(self, function, fallback, args):
+        fields = parse_js_function(self._doc, function) or fallback
+        return {field:args[index] for field, index in fields.items() if index < len(args)}
+
+    def _submit_search(self, search_terms, answer, page=1):
+        """Submit the search form, like typing the answer then clicking on search or on gotoPage(page)"""
+        values = self._form_values()
+        values.update({self.field_name[term]:value for term, value in search_terms.items()})
+        values['captcha'] = answer
+        if page > 1:
+            values.update(self._js_values('gotoPage', self.page_fields, [str(page)]))
+        return self._submit(values)
+
+    def _detail_links(self):
+        return self._doc.xpath("//a[contains(@href, 'javascript:submitform')]/@href")
+
+    def _detail_values(self, profile_index=0):
+        """Form values posted by clicking on nth-profile"""
+        args = parse_js_args(self._detail_links()[profile_index])
+        values = self._form_values()
+        values.update(self._js_values('submitform', self.detail_fields, args))
+        return values
+
+    def _goto_detail(self, profile_index=0):
+        """Go to nth-profile"""
+        return self._submit(self._detail_values(profile_index))
+
+    @metrics.timed('detail')
+    def _fetch_detail(self, values, subtables=None):
+        """Fetch and parse a profile without changing the current page, so that several can run at once"""
+        doc = pageparser.to_document(self._request('POST', self._form_action(), data=values).content)
+        with metrics.span('parse'):
+            detail = {'inner': pageparser.parse_inner(doc)}
+        sub = self._scrape_subtables(subtables, doc)
+        if sub is not None:
+            detail['sub'] = sub
+        return detail
+
+    @metrics.timed('open')
+    def _open(self):
+        self._load(self._request('GET', self.site))
+
+    def _search_page(self, search_terms, page=1, ahead=False):
+        """Search and return the parsed outer table of a page. Reopen the site before retrying,
+        since the session may have expired"""
+        return self._retry(self._search_outer, search_terms, page, ahead, before_retry=self._open)
+
+    def _search_outer(self, search_terms, page=1, ahead=False):
+        """Solve captcha and submit until the site accepts the answer. Return the parsed outer table.
+        If ahead, another captcha will likely be needed and the spare session solves it meanwhile"""
+        attempt = 0
+        while True:
+            if attempt > self.max_attempts:
+                ratelimit.LIMITER.record(failed=True)
+                raise CaptchaRejected(f'Captcha rejected {attempt} times in a row')
+            answer = self._next_answer()
+            if ahead:
+                self._prefetch_captcha()
+            doc = self._submit_search(search_terms, answer, page)
+            with metrics.span('parse'):
+                outer = pageparser.process_outer(doc)
+            if outer == pageparser.WRONG_CAPTCHA:
+                CAPTCHA_STATS.record_rejected()
+                attempt += 1
+                continue
+            CAPTCHA_STATS.record_accepted(attempt + 1)
+            return outer
+
+    def _scrape_subtables(self, subtables=None, doc=None):
+        return None
+
+    def pinpoint(self, search_terms, subtables=None):
+        logger.info("Pinpoint a single profile ... Search terms=%s", str(search_terms))
+        self._retry(self._open)
+        parse_result = {}
+        outer = self._search_page(search_terms)
+        if outer == pageparser.EMPTY:
+            logger.info('Finished scraping. Record is empty.')
+            return None
+        parse_result['outer'] = outer
+        doc = self._retry(self._goto_detail)
+        with metrics.span('parse'):
+            parse_result['inner'] = pageparser.parse_inner(doc)
+        sub = self._scrape_subtables(subtables)
+        if sub is not None:
+            parse_result['sub'] = sub
+        logger.info('Finished scraping. Record is present.')
+        return parse_result
+
+    def iter_sweep(self, search_terms, start_page=1, max_page=None):
+        """Scrape multiple records in outer page, yielding each page as soon as it is parsed:
+        {'page': n, 'outer': rows, 'next_page': n+1 or None when it was the last page}.
+        A full last page is followed by an empty one, the only way to tell it was the last.
+        Start from start_page to resume an interrupted sweep"""
+        max_page = max_page or self.max_page
+        logger.info("Sweep all profiles produced under search terms ... Search terms=%s", str(search_terms))
+        self._retry(self._open)
+        next_page = start_page
+        try:
+            while True:
+                # past the first page, the sweep likely goes on: solve the next captcha during the submission
+                ahead = self.prefetch_captcha and start_page < next_page < max_page
+                outer = self._search_page(search_terms, next_page, ahead)
+                if outer == pageparser.EMPTY:
+                    logger.info('Finished sweeping. Record is empty.')
+                    if next_page > 1: # the previous page was full, tell the caller there is none after it
+                        yield {'page': next_page, 'outer': [], 'next_page': None}
+                    return
+                last = len(outer) < 15 or next_page >= max_page # page contains max 15 profiles
+                if not last and self.prefetch_captcha and not self._prefetch.pending:
+                    self._prefetch_captcha() # at least while the page is consumed
+                yield {'page': next_page, 'outer': outer, 'next_page': None if last else next_page + 1}
+                if last:
+                    return
+                next_page += 1
+        finally: # e.g. the last page was short, or the sweep was interrupted
+            self._prefetch.discard()
+
+    def sweep(self, search_terms, max_page=None):
+        parse_result = []
+        for page in self.iter_sweep(search_terms, max_page=max_page):
+            parse_result += page['outer']
+        logger.info('Finished sweeping. %d records found', len(parse_result))
+        return {'outer':parse_result}
+
+    def harvest(self, search_terms, subtables=None, max_page=None):
+        """Sweep once, then fetch the detail of every record found within the same session.
+        Details of each page are fetched by up to harvest_concurrency workers while the page is current"""
+        parse_result = []
+        def fetch(values):
+            return self._retry(self._fetch_detail, values, subtables)
+        with ThreadPoolExecutor(self.harvest_concurrency) as executor:
+            for page in self.iter_sweep(search_terms, max_page=max_page):
+                forms = [self._detail_values(index) for index in range(len(self._detail_links()))]
+                for outer, detail in zip(page['outer'], executor.map(metrics.carry(fetch), forms)):
+                    parse_result.append({'outer': outer, **detail})
+        logger.info('Finished harvesting. %d records found', len(parse_result))
+        return parse_result
+
+    def run(self, command, search_terms, **options):
+        """Main entry point for program. Options are passed to the command, e.g. subtables for pinpoint"""
+        commands = {'pinpoint': self.pinpoint,
+                    'sweep': self.sweep,
+                    'harvest': self.harvest}
+        assert command in commands, "Invalid command. Supported command: 'pinpoint' for single profile in detail; 'sweep' for multiple profiles in outer page; 'harvest' for every profile of a sweep in detail"
+        return {'command':command,
+                'result':commands[command](search_terms, **options)}
+
+class HttpPersonalProfileScraper(HttpProfileScraper):
+    """Browserless scraper for personal site http://tracuunnt.gdt.gov.vn/tcnnt/mstcn.jsp"""
+    site = r'http://tracuunnt.gdt.gov.vn/tcnnt/mstcn.jsp'
+    field_name = {'taxnum': 'mst1',
+                  'name': 'fullname1',
+                  'address': 'address',
+                  'idnum': 'cmt2'}
+    max_page = 2
+
+class HttpBusinessProfileScraper(HttpProfileScraper):
+    """Browserless scraper for business site http://tracuunnt.gdt.gov.vn/tcnnt/mstdn.jsp"""
+    site = r'http://tracuunnt.gdt.gov.vn/tcnnt/mstdn.jsp'
+    field_name = {'taxnum': 'mst',
+                  'name': 'fullname',
+                  'address': 'address',
+                  'idnum': 'cmt'}
+    max_page = 9
+    subtables = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+    parallel_subtables = True
+
+    @metrics.timed('subtables')
+    def _scrape_subtables(self, subtables=None, doc=None):
+        """Fetch the sub-tables of the profile on doc, the current page by default, concurrently.
+        All of them by default"""
+        urls = pageparser.subtable_urls(self._doc if doc is None else doc, self.site)
+        assert len(urls) == 6, 'There must be 6 sub-tables'
+        selected = [name for name in self.subtables if not subtables or name in subtables]
+        def fetch(name):
+            logger.debug('Scraping sub-table=%s...', name)
+            content = self._retry(self._request, 'GET', urls[name]).content
+            with metrics.span('parse'):
+                return pageparser.parse_subtable(content)
+        if not self.parallel_subtables or len(selected) < 2:
+            return {name:fetch(name) for name in selected}
+        with ThreadPoolExecutor(len(selected)) as executor:
+            return dict(zip(selected, executor.map(metrics.carry(fetch), selected)))
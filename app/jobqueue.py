@@ -0,0 +1,447 @@
+"""Queue of lookups between the API and worker processes.
+
+The API puts a lookup and waits for its result; workers claim lookups under a lease, renew the lease while
+scraping and publish the result. A lookup whose lease expires, e.g. because its worker crashed, is claimed again,
+up to `max_attempts` claims.
+
+Two brokers implement the JobBroker interface. JobQueue keeps the lookups in a SQLite file, so that no server is
+needed; the file is opened in WAL mode, whose shared memory only works between processes of one host: the API
+and the workers, or their containers, must run on the same machine, and a network filesystem such as NFS or SMB
+is not safe. RedisJobQueue keeps them in a Redis server, so that workers can run on any host reaching it.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from cache import make_key
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# errors of a worker that the API raises again as UpstreamError, so that they answer 503
+UPSTREAM_ERRORS = ('UpstreamError', 'CaptchaRejected', 'PoolExhausted')
+
+class JobTimeout(Exception):
+    """No worker finished the lookup in time"""
+
+class JobFailed(Exception):
+    """The lookup failed in the worker"""
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+class JobBroker():
+    """Lookups waiting for, or leased by, a worker. A broker implements put, get, claim, renew, ack, nack,
+    purge, stats and close, and has the lease, timeout and poll attributes; the API waits for results with
+    wait() or call()"""
+    def wait(self, job_id, timeout=None):
+        """Return the result of a lookup once a worker published it. Raise JobFailed, or the UpstreamError
+        of the worker, if it failed and JobTimeout after `timeout` seconds"""
+        from ratelimit import UpstreamError
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            status, result, error, error_type = self.get(job_id)
+            if status == DONE:
+                return result
+            if status == FAILED:
+                raise (UpstreamError if error_type in UPSTREAM_ERRORS else JobFailed)(error)
+            if time.monotonic() > deadline:
+                raise JobTimeout(f'No worker finished lookup {job_id} in time, it is {status}')
+            time.sleep(self.poll)
+
+    def call(self, site, command, search_terms, **options):
+        """Lookup through the workers, with the signature of main.search_by"""
+        return self.wait(self.put(site, command, search_terms, options))
+
+class JobQueue(JobBroker):
+    """Broker keeping the lookups in a SQLite file shared by the processes of one host.
+
+    Args:
+        path (str): SQLite file shared by the API and the workers.
+        lease (float, optional): seconds a worker holds a lookup without renewing the lease. Defaults to 60.
+        max_attempts (int, optional): claims of a lookup before it fails. Defaults to 3.
+        timeout (float, optional): seconds the API waits for a result. Defaults to 300.
+        max_age (float, optional): seconds finished lookups are kept. Defaults to 1 hour.
+        poll (float, optional): seconds between two checks of the API for a result. Defaults to 0.1.
+    """
+    def __init__(self, path='queue/jobs.sqlite3', lease=60.0, max_attempts=3, timeout=300.0, max_age=3600.0,
+                 poll=0.1):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.max_age = max_age
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._puts = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, key TEXT, site TEXT, '
+                         'command TEXT, search_terms TEXT, options TEXT, status TEXT, attempts INTEGER, '
+                         'worker TEXT, lease_until REAL, result TEXT, error TEXT, error_type TEXT, '
+                         'created REAL, updated REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)')
+
+    def _transaction(self, fn, *args):
+        """Run fn(*args) in a write transaction, so that processes sharing the file take turns"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(*args)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return result
+
+    def put(self, site, command, search_terms, options=None):
+        """Queue a lookup and return its id. An identical lookup still queued or leased is shared"""
+        key = make_key(site, command, search_terms, options)
+        def put():
+            row = self._db.execute('SELECT id FROM jobs WHERE key=? AND status IN (?, ?)',
+                                   (key, QUEUED, LEASED)).fetchone()
+            if row is not None:
+                return row[0]
+            now = time.time()
+            return self._db.execute('INSERT INTO jobs (key, site, command, search_terms, options, status, attempts, '
+                                    'created, updated) VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)',
+                                    (key, site, command, json.dumps(search_terms, ensure_ascii=False),
+                                     json.dumps(options or {}, ensure_ascii=False), QUEUED, now, now)).lastrowid
+        job_id = self._transaction(put)
+        self._puts += 1
+        if not self._puts % 100: # only purge every 100 lookups
+            self.purge()
+        return job_id
+
+    def get(self, job_id):
+        """Return (status, result, error, error_type) of a lookup"""
+        with self._lock:
+            row = self._db.execute('SELECT status, result, error, error_type FROM jobs WHERE id=?',
+                                   (job_id,)).fetchone()
+        if row is None:
+            raise KeyError(job_id)
+        status, result, error, error_type = row
+        return status, json.loads(result) if result is not None else None, error, error_type
+
+    def claim(self, worker):
+        """Lease the oldest queued lookup, or one whose lease expired. Return it as a dict, or None"""
+        def claim():
+            now = time.time()
+            while True:
+                row = self._db.execute('SELECT id, site, command, search_terms, options, status, attempts FROM jobs '
+                                       'WHERE status=? OR (status=? AND lease_until<?) ORDER BY created LIMIT 1',
+                                       (QUEUED, LEASED, now)).fetchone()
+                if row is None:
+                    return None
+                job_id, site, command, search_terms, options, status, attempts = row
+                if status == LEASED:
+                    logger.warning('Lease of lookup %d expired on its attempt %d', job_id, attempts)
+                if attempts >= self.max_attempts:
+                    self._db.execute('UPDATE jobs SET status=?, error=?, error_type=?, updated=? WHERE id=?',
+                                     (FAILED, f'Lease expired {attempts} times', 'JobTimeout', now, job_id))
+                    continue
+                self._db.execute('UPDATE jobs SET status=?, worker=?, attempts=?, lease_until=?, updated=? '
+                                 'WHERE id=?', (LEASED, worker, attempts + 1, now + self.lease, now, job_id))
+                return {'id': job_id, 'site': site, 'command': command, 'search_terms': json.loads(search_terms),
+                        'options': json.loads(options), 'attempt': attempts + 1}
+        return self._transaction(claim)
+
+    def renew(self, job_ids, worker):
+        """Extend the leases of a worker. Return the ids it no longer holds"""
+        def renew():
+            now = time.time()
+            lost = []
+            for job_id in job_ids:
+                cursor = self._db.execute('UPDATE jobs SET lease_until=?, updated=? '
+                                          'WHERE id=? AND status=? AND worker=?',
+                                          (now + self.lease, now, job_id, LEASED, worker))
+                if not cursor.rowcount:
+                    lost.append(job_id)
+            return lost
+        return self._transaction(renew)
+
+    def ack(self, job_id, worker, result):
+        """Publish the result of a lookup. Return False if the worker lost its lease meanwhile"""
+        result = json.dumps(result, ensure_ascii=False)
+        def ack():
+            cursor = self._db.execute('UPDATE jobs SET status=?, result=?, updated=? '
+                                      'WHERE id=? AND status=? AND worker=?',
+                                      (DONE, result, time.time(), job_id, LEASED, worker))
+            return cursor.rowcount > 0
+        return self._transaction(ack)
+
+    def nack(self, job_id, worker, error, retry=False):
+        """Fail a lookup, or queue it again if retry and it has attempts left.
+        Return False if the worker lost its lease meanwhile"""
+        def nack():
+            row = self._db.execute('SELECT attempts FROM jobs WHERE id=? AND status=? AND worker=?',
+                                   (job_id, LEASED, worker)).fetchone()
+            if row is None:
+                return False
+            now = time.time()
+            if retry and row[0] < self.max_attempts:
+                self._db.execute('UPDATE jobs SET status=?, worker=NULL, lease_until=NULL, updated=? WHERE id=?',
+                                 (QUEUED, now, job_id))
+            else:
+                self._db.execute('UPDATE jobs SET status=?, error=?, error_type=?, updated=? WHERE id=?',
+                                 (FAILED, repr(error), type(error).__name__, now, job_id))
+            return True
+        return self._transaction(nack)
+
+    def purge(self):
+        """Delete the lookups finished more than max_age ago"""
+        with self._lock:
+            self._db.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated<?',
+                             (DONE, FAILED, time.time() - self.max_age))
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            oldest = self._db.execute('SELECT MIN(created) FROM jobs WHERE status=?', (QUEUED,)).fetchone()[0]
+            retried = self._db.execute('SELECT COUNT(*) FROM jobs WHERE attempts>1').fetchone()[0]
+        return {**{status: counts.get(status, 0) for status in (QUEUED, LEASED, DONE, FAILED)},
+                'retried': retried,
+                'oldest_queued': time.time() - oldest if oldest is not None else 0}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __str__(self):
+        return str(self.path)
+
+# Each script runs atomically in the Redis server, timed by its clock so that the hosts of the workers may disagree.
+# Keys under the prefix: next (last id), job:<id> (hash of a lookup), key:<key> (id of the queued or leased lookup
+# with that key), queued (ids by creation), leased (ids by end of lease), done and failed (ids by last update),
+# retried (ids claimed more than once)
+LUA_NOW = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local p = ARGV[1]
+"""
+
+LUA_PUT = LUA_NOW + """
+local existing = redis.call('GET', p .. ':key:' .. ARGV[2])
+if existing then
+    return tonumber(existing)
+end
+local id = redis.call('INCR', p .. ':next')
+redis.call('HSET', p .. ':job:' .. id, 'key', ARGV[2], 'site', ARGV[3], 'command', ARGV[4], 'search_terms', ARGV[5],
+           'options', ARGV[6], 'status', 'queued', 'attempts', 0, 'created', now, 'updated', now)
+redis.call('SET', p .. ':key:' .. ARGV[2], id)
+redis.call('ZADD', p .. ':queued', now, id)
+return id
+"""
+
+LUA_CLAIM = LUA_NOW + """
+local lease_until = now + tonumber(ARGV[3])
+while true do
+    local expired = 1
+    local ids = redis.call('ZRANGEBYSCORE', p .. ':leased', '-inf', now, 'LIMIT', 0, 1)
+    if #ids == 0 then
+        expired = 0
+        ids = redis.call('ZRANGE', p .. ':queued', 0, 0)
+        if #ids == 0 then
+            return false
+        end
+    end
+    local id = ids[1]
+    local job = p .. ':job:' .. id
+    redis.call('ZREM', p .. (expired == 1 and ':leased' or ':queued'), id)
+    local attempts = tonumber(redis.call('HGET', job, 'attempts'))
+    if attempts >= tonumber(ARGV[4]) then
+        redis.call('HSET', job, 'status', 'failed', 'error', 'Lease expired ' .. attempts .. ' times',
+                   'error_type', 'JobTimeout', 'updated', now)
+        redis.call('DEL', p .. ':key:' .. redis.call('HGET', job, 'key'))
+        redis.call('ZADD', p .. ':failed', now, id)
+    else
+        redis.call('HSET', job, 'status', 'leased', 'worker', ARGV[2], 'attempts', attempts + 1,
+                   'lease_until', lease_until, 'updated', now)
+        redis.call('ZADD', p .. ':leased', lease_until, id)
+        if attempts > 0 then
+            redis.call('SADD', p .. ':retried', id)
+        end
+        local job_fields = redis.call('HMGET', job, 'site', 'command', 'search_terms', 'options')
+        return {tonumber(id), attempts + 1, expired, job_fields[1], job_fields[2], job_fields[3], job_fields[4]}
+    end
+end
+"""
+
+LUA_RENEW = LUA_NOW + """
+local lease_until = now + tonumber(ARGV[3])
+local lost = {}
+for i = 4, #ARGV do
+    local job = p .. ':job:' .. ARGV[i]
+    local state = redis.call('HMGET', job, 'status', 'worker')
+    if state[1] == 'leased' and state[2] == ARGV[2] then
+        redis.call('HSET', job, 'lease_until', lease_until, 'updated', now)
+        redis.call('ZADD', p .. ':leased', lease_until, ARGV[i])
+    else
+        table.insert(lost, tonumber(ARGV[i]))
+    end
+end
+return lost
+"""
+
+LUA_ACK = LUA_NOW + """
+local job = p .. ':job:' .. ARGV[2]
+local state = redis.call('HMGET', job, 'status', 'worker', 'key')
+if state[1] ~= 'leased' or state[2] ~= ARGV[3] then
+    return 0
+end
+redis.call('HSET', job, 'status', 'done', 'result', ARGV[4], 'updated', now)
+redis.call('ZREM', p .. ':leased', ARGV[2])
+redis.call('ZADD', p .. ':done', now, ARGV[2])
+redis.call('DEL', p .. ':key:' .. state[3])
+return 1
+"""
+
+LUA_NACK = LUA_NOW + """
+local job = p .. ':job:' .. ARGV[2]
+local state = redis.call('HMGET', job, 'status', 'worker', 'key', 'attempts', 'created')
+if state[1] ~= 'leased' or state[2] ~= ARGV[3] then
+    return 0
+end
+redis.call('ZREM', p .. ':leased', ARGV[2])
+if ARGV[4] == '1' and tonumber(state[4]) < tonumber(ARGV[5]) then
+    redis.call('HSET', job, 'status', 'queued', 'updated', now)
+    redis.call('HDEL', job, 'worker', 'lease_until')
+    redis.call('ZADD', p .. ':queued', state[5], ARGV[2])
+else
+    redis.call('HSET', job, 'status', 'failed', 'error', ARGV[6], 'error_type', ARGV[7], 'updated', now)
+    redis.call('ZADD', p .. ':failed', now, ARGV[2])
+    redis.call('DEL', p .. ':key:' .. state[3])
+end
+return 1
+"""
+
+LUA_PURGE = LUA_NOW + """
+local before = now - tonumber(ARGV[2])
+for _, status in ipairs({'done', 'failed'}) do
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', p .. ':' .. status, '-inf', before)) do
+        redis.call('DEL', p .. ':job:' .. id)
+        redis.call('SREM', p .. ':retried', id)
+    end
+    redis.call('ZREMRANGEBYSCORE', p .. ':' .. status, '-inf', before)
+end
+"""
+
+class RedisJobQueue(JobBroker):
+    """Broker keeping the lookups in a Redis server, reachable from workers on any host. Require redis
+
+    Args:
+        url (str, optional): Redis server. Defaults to redis://localhost:6379/0.
+        prefix (str, optional): prefix of the keys of this queue. Defaults to 'jobs'.
+        client (optional): redis.Redis client decoding responses, used instead of url.
+        lease, max_attempts, timeout, max_age, poll: see JobQueue.
+    """
+    def __init__(self, url='redis://localhost:6379/0', prefix='jobs', lease=60.0, max_attempts=3, timeout=300.0,
+                 max_age=3600.0, poll=0.1, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.url = url
+        self.prefix = prefix
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.max_age = max_age
+        self.poll = poll
+        self._redis = client
+        self._puts = 0
+        self._put = client.register_script(LUA_PUT)
+        self._claim = client.register_script(LUA_CLAIM)
+        self._renew = client.register_script(LUA_RENEW)
+        self._ack = client.register_script(LUA_ACK)
+        self._nack = client.register_script(LUA_NACK)
+        self._purge = client.register_script(LUA_PURGE)
+
+    def put(self, site, command, search_terms, options=None):
+        """Queue a lookup and return its id. An identical lookup still queued or leased is shared"""
+        job_id = self._put(args=[self.prefix, make_key(site, command, search_terms, options), site, command,
+                                 json.dumps(search_terms, ensure_ascii=False),
+                                 json.dumps(options or {}, ensure_ascii=False)])
+        self._puts += 1
+        if not self._puts % 100: # only purge every 100 lookups
+            self.purge()
+        return int(job_id)
+
+    def get(self, job_id):
+        """Return (status, result, error, error_type) of a lookup"""
+        status, result, error, error_type = self._redis.hmget(f'{self.prefix}:job:{job_id}',
+                                                              'status', 'result', 'error', 'error_type')
+        if status is None:
+            raise KeyError(job_id)
+        return status, json.loads(result) if result is not None else None, error, error_type
+
+    def claim(self, worker):
+        """Lease the lookup whose lease expired first, else the oldest queued one. Return it as a dict, or None"""
+        row = self._claim(args=[self.prefix, worker, self.lease, self.max_attempts])
+        if row is None:
+            return None
+        job_id, attempt, expired, site, command, search_terms, options = row
+        if expired:
+            logger.warning('Lease of lookup %d expired on its attempt %d', job_id, attempt - 1)
+        return {'id': job_id, 'site': site, 'command': command, 'search_terms': json.loads(search_terms),
+                'options': json.loads(options), 'attempt': attempt}
+
+    def renew(self, job_ids, worker):
+        """Extend the leases of a worker. Return the ids it no longer holds"""
+        return list(self._renew(args=[self.prefix, worker, self.lease, *job_ids]))
+
+    def ack(self, job_id, worker, result):
+        """Publish the result of a lookup. Return False if the worker lost its lease meanwhile"""
+        return bool(self._ack(args=[self.prefix, job_id, worker, json.dumps(result, ensure_ascii=False)]))
+
+    def nack(self, job_id, worker, error, retry=False):
+        """Fail a lookup, or queue it again if retry and it has attempts left.
+        Return False if the worker lost its lease meanwhile"""
+        return bool(self._nack(args=[self.prefix, job_id, worker, int(retry), self.max_attempts,
+                                     repr(error), type(error).__name__]))
+
+    def purge(self):
+        """Delete the lookups finished more than max_age ago"""
+        self._purge(args=[self.prefix, self.max_age])
+
+    def stats(self):
+        pipe = self._redis.pipeline(transaction=False)
+        for status in (QUEUED, LEASED, DONE, FAILED):
+            pipe.zcard(f'{self.prefix}:{status}')
+        pipe.scard(f'{self.prefix}:retried')
+        pipe.zrange(f'{self.prefix}:queued', 0, 0, withscores=True)
+        pipe.time()
+        *counts, retried, oldest, (seconds, microseconds) = pipe.execute()
+        now = seconds + microseconds / 1e6
+        return {**dict(zip((QUEUED, LEASED, DONE, FAILED), counts)),
+                'retried': retried,
+                'oldest_queued': now - oldest[0][1] if oldest else 0}
+
+    def close(self):
+        self._redis.close()
+
+    def __str__(self):
+        return f'{self.url} {self.prefix}'
+
+BROKERS = {'sqlite': JobQueue,
+           'redis': RedisJobQueue}
+
+def create_queue(options):
+    """Return the broker of the 'queue' section of the config, or None if lookups run in the API process"""
+    options = dict(options or {})
+    if not options.pop('enabled', False):
+        return None
+    options.pop('worker', None)
+    broker = options.pop('broker', 'sqlite')
+    for name in ('path',) if broker == 'redis' else ('url', 'prefix'): # options of the other broker
+        options.pop(name, None)
+    return BROKERS[broker](**options)
@@ -1,37 +1,171 @@
 # -*- coding: utf-8 -*-
 
+import importlib
 import logging
-import logging.config
-from pathlib import Path
+import threading
 import utility
-from webdriver import BusinessProfileScraper, PersonalProfileScraper
-from solver import SolverManager
+import metrics
+import ratelimit
+from pool import PoolManager, TabFactory
+from cache import make_key
+from recordindex import RecordIndex
+from singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
-def run(site, command, term, value, config):
+# scraper classes by site as (module, class), imported on first use: selenium and the solver's
+# cv2 and numpy take most of the startup time, and only one engine is used
+DRIVERS = {'business': ('webdriver', 'BusinessProfileScraper'),
+           'personal': ('webdriver', 'PersonalProfileScraper')}
+HTTP_DRIVERS = {'business': ('httpscraper', 'HttpBusinessProfileScraper'),
+                'personal': ('httpscraper', 'HttpPersonalProfileScraper')}
+
+def scraper_class(drivers, site):
+    module, name = drivers[site]
+    return getattr(importlib.import_module(module), name)
+
+SOLVER = None
+_solver_lock = threading.Lock()
+# identical lookups in flight share one scrape
+FLIGHTS = SingleFlight()
+INDEX = None
+_index_lock = threading.Lock()
+
+def create_solver(config=None):
+    """Return the solver shared by all scrapers, loading its backend on first call"""
+    global SOLVER
+    with _solver_lock:
+        if SOLVER is None:
+            from solver import SolverManager, create_backend
+            config = utility.load_config() if config is None else config
+            solver_config = config.get('solver') or {'url': r"http://solver:8501/v1/models/solver:predict"}
+            SOLVER = SolverManager(backend=create_backend(solver_config),
+                                   confidence_threshold=solver_config.get('confidence_threshold', 0.0),
+                                   max_refresh=solver_config.get('max_refresh', 3))
+    return SOLVER
+
+def create_index(config=None):
+    """Return the index of scraped records shared by all lookups, or None if the 'index' section disables it"""
+    global INDEX
+    config = utility.load_config() if config is None else config
+    index_config = dict(config.get('index') or {})
+    if not index_config.pop('enabled', False):
+        return None
+    with _index_lock:
+        if INDEX is None:
+            INDEX = RecordIndex(**index_config)
+    return INDEX
+
+def index_result(site, command, search_terms, result, config, max_page=None):
+    """Store the records of a result in the index. A failure only costs the index an update"""
+    index = create_index(config)
+    if index is None:
+        return
+    try:
+        with metrics.span('index'):
+            index.ingest(site, command, search_terms, result, max_page)
+    except Exception:
+        logger.warning('Failed to index the result of %s', search_terms, exc_info=True)
+
+@metrics.timed('driver_start')
+def create_driver(site, config=None):
+    """Start a new webdriver for the site"""
     logger.info('Initialising webdriver...')
+    scraper_config = (config or {}).get('scraper') or {}
+    driver = scraper_class(DRIVERS, site)(solver=create_solver(config), headless=True, base_url=scraper_config.get('base_url'),
+                           tabs=scraper_config.get('tabs') or 1)
+    configure_driver(driver, site, config)
+    return driver
+
+def create_http_driver(site, config):
+    """Start a new browserless scraper for the site"""
+    scraper_config = config.get('scraper') or {}
+    driver = scraper_class(HTTP_DRIVERS, site)(solver=create_solver(config),
+                                base_url=scraper_config.get('base_url'),
+                                timeout=scraper_config.get('timeout'))
+    configure_driver(driver, site, config)
+    return driver
+
+def configure_driver(driver, site, config):
+    """Override class attributes of scrapers with the 'scraper' section of the config"""
+    scraper_config = (config or {}).get('scraper') or {}
+    for attribute in ('parallel_subtables', 'harvest_concurrency', 'prefetch_captcha'):
+        if attribute in scraper_config and hasattr(driver, attribute):
+            setattr(driver, attribute, scraper_config[attribute])
+    if 'blocked_resources' in scraper_config and hasattr(driver, 'block_resources'):
+        driver.block_resources(scraper_config['blocked_resources'])
+    max_page = (scraper_config.get('max_page') or {}).get(site)
+    if max_page:
+        driver.max_page = max_page
+
+def create_pools(config):
+    """Create one driver pool per site using the 'pool' section of the config.
+    Return None if the browserless engine is used, since it doesn't need to be pooled"""
+    if (config.get('scraper') or {}).get('engine') == 'http':
+        return None
+    factories = {site:(lambda site=site: create_driver(site, config)) for site in DRIVERS}
+    if ((config.get('scraper') or {}).get('tabs') or 1) > 1: # the pool sizes count tabs
+        factories = {site:TabFactory(factory) for site, factory in factories.items()}
+    return PoolManager(factories, config.get('pool'))
+
+def run(site, command, term, value, config, pools=None):
+    return run_terms(site, command, {term:value}, config, pools)
+
+def lease_driver(site, config, pools=None):
+    """Return a context manager giving a scraper for the site"""
     if site == 'business':
         logger.info('Navigating to mstdn.jsp')
-        run_driver = BusinessProfileScraper
     elif site == 'personal':
         logger.info('Navigating to mstcn.jsp')
-        run_driver = PersonalProfileScraper
-    with run_driver(solver=SolverManager(MODEL_API = r"http://solver:8501/v1/models/solver:predict"),
-                    headless=True) as driver:
+    if (config.get('scraper') or {}).get('engine') == 'http':
+        return create_http_driver(site, config)
+    elif pools is not None:
+        return pools.lease(site)
+    return create_driver(site, config)
+
+def run_terms(site, command, search_terms, config, pools=None, **options):
+    ratelimit.configure(config.get('ratelimit'))
+    with lease_driver(site, config, pools) as driver:
         logger.info('Start scraping...')
-        result = driver.run(command, {term:value})
-        search_keys = str({term:value})
+        result = driver.run(command, search_terms, **options)
+        index_result(site, command, search_terms, result, config, options.get('max_page') or driver.max_page)
+        search_keys = str(search_terms)
         result = {search_keys:result}
-        logger.info('Finished scraping. Spin down driver.')
+        logger.info('Finished scraping. Return driver.')
     return result
 
-def search(site, command, term, value):
-    config_path = Path(r'config')
-    config = utility.import_config(config_path)
-    utility.init_logger(config['logging'])
-    result = run(site, command, term, value, config)
+def iter_sweep(site, search_terms, pools=None, start_page=1, max_page=None):
+    """Yield the pages of a sweep as soon as they are scraped. See ProfileScraper.iter_sweep"""
+    config = utility.load_config()
+    ratelimit.configure(config.get('ratelimit'))
+    index = create_index(config)
+    with lease_driver(site, config, pools) as driver:
+        for page in driver.iter_sweep(search_terms, start_page, max_page):
+            if index is not None:
+                index.ingest_page(site, page['outer'])
+            yield page
+
+def search(site, command, term, value, pools=None):
+    return search_by(site, command, {term:value}, pools)
+
+def search_by(site, command, search_terms, pools=None, **options):
+    """Same as search but accept several search terms at once, e.g. {'name': ..., 'address': ...},
+    and options of the command, e.g. subtables=['chinhanh'] for pinpoint or harvest.
+    Concurrent identical searches are coalesced into one scrape"""
+    return FLIGHTS.run(make_key(site, command, search_terms, options), _search_by,
+                       site, command, search_terms, pools, **options)
+
+def _search_by(site, command, search_terms, pools=None, **options):
+    config = utility.load_config()
+    index = create_index(config)
+    if index is not None: # records scraped by earlier lookups may hold the whole answer
+        with metrics.span('index'):
+            answer = index.answer(site, command, search_terms, options.get('subtables'), options.get('max_page'))
+        if answer is not None:
+            logger.info('Answered from the index')
+            return {str(search_terms): answer}
+    result = run_terms(site, command, search_terms, config, pools, **options)
     return result
 
 if __name__ == '__main__':
-    search('business', 'pinpoint', 'name', 'hòa bình')
\ No newline at end of file
+    search('business', 'pinpoint', 'name', 'hòa bình')
@@ -0,0 +1,230 @@
+"""Timing of the phases of a lookup and Prometheus metrics.
+
+Code under `span(phase)` is timed into the `scraper_phase_seconds` histogram. Inside `trace()`, the time of each
+phase run by the same thread, or by a function passed to `carry()`, is also summed into a breakdown of that lookup. The captcha counters live here,
+so that recording them doesn't load the solver. State kept by other modules, such as the pools and the cache,
+is read when /metrics is scraped.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+REGISTRY = CollectorRegistry()
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+PHASE_SECONDS = Histogram('scraper_phase_seconds', 'Time spent in each phase of a lookup',
+                          ['phase'], buckets=BUCKETS, registry=REGISTRY)
+LOOKUP_SECONDS = Histogram('scraper_lookup_seconds', 'Time to serve a lookup, cache included',
+                           ['site', 'command', 'cache'], buckets=BUCKETS, registry=REGISTRY)
+
+_local = threading.local()
+_timings_lock = threading.Lock()
+
+@contextmanager
+def span(phase):
+    """Time a phase of the current lookup"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_SECONDS.labels(phase).observe(elapsed)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            with _timings_lock: # a carried function may add to the same breakdown
+                timings[phase] = timings.get(phase, 0) + elapsed
+
+def timed(phase):
+    """Decorator version of span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def trace():
+    """Collect the spans run by this thread into a dict of phase -> seconds.
+    Nested spans are counted in both phases"""
+    timings = {}
+    outer, _local.timings = getattr(_local, 'timings', None), timings
+    try:
+        yield timings
+    finally:
+        _local.timings = outer
+
+def carry(fn):
+    """Wrap fn so that its spans go to the trace of the calling thread, from whichever thread runs it.
+    Phases run in the background then add up to more than the lookup took, by the time they overlapped"""
+    timings = getattr(_local, 'timings', None)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer, _local.timings = getattr(_local, 'timings', None), timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.timings = outer
+    return wrapper
+
+def server_timing(timings):
+    """Format timings as a Server-Timing header, in milliseconds"""
+    return ', '.join(f'{phase};dur={seconds*1000:.1f}' for phase, seconds in timings.items())
+
+class CaptchaStats():
+    """Count how many captchas it takes to get one accepted by the site"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.solved = 0 # predictions made
+        self.refreshed = 0 # predictions skipped for low confidence
+        self.accepted = 0
+        self.rejected = 0
+        self.prefetched = 0 # answers solved in the background before they were needed
+        self.discarded = 0 # answers solved in the background but never needed
+        self.submissions = {} # submissions needed per accepted answer -> count
+
+    def record_refresh(self):
+        with self._lock:
+            self.refreshed += 1
+
+    def record_solve(self):
+        with self._lock:
+            self.solved += 1
+
+    def record_prefetch(self, used=True):
+        with self._lock:
+            if used:
+                self.prefetched += 1
+            else:
+                self.discarded += 1
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_accepted(self, submissions):
+        with self._lock:
+            self.accepted += 1
+            self.submissions[submissions] = self.submissions.get(submissions, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'solved': self.solved,
+                    'refreshed': self.refreshed,
+                    'accepted': self.accepted,
+                    'rejected': self.rejected,
+                    'prefetched': self.prefetched,
+                    'discarded': self.discarded,
+                    'accuracy': self.accepted / (self.accepted + self.rejected) if self.accepted + self.rejected else None,
+                    'solves_per_success': self.solved / self.accepted if self.accepted else None,
+                    'submissions_per_success': dict(sorted(self.submissions.items()))}
+
+CAPTCHA_STATS = CaptchaStats()
+
+class StatsCollector():
+    """Expose the stats() of the running components. Each source is a callable, evaluated on every scrape"""
+    def __init__(self, executor=None, pools=None, cache=None, captcha=None, limiter=None, flights=None, queue=None, index=None):
+        self.executor = executor
+        self.pools = pools
+        self.cache = cache
+        self.captcha = captcha
+        self.limiter = limiter
+        self.flights = flights
+        self.queue = queue
+        self.index = index
+
+    def collect(self):
+        if self.executor is not None:
+            stats = self.executor()
+            for name in ('running', 'queued'):
+                yield GaugeMetricFamily(f'executor_{name}', f'Lookups {name} in worker threads', value=stats[name])
+            counter = CounterMetricFamily('executor_tasks', 'Lookups handled by worker threads', labels=['outcome'])
+            for name in ('completed', 'failed', 'rejected'):
+                counter.add_metric([name], stats[name])
+            yield counter
+        if self.pools is not None:
+            size = GaugeMetricFamily('pool_drivers', 'Webdrivers alive', labels=['site'])
+            idle = GaugeMetricFamily('pool_idle_drivers', 'Webdrivers waiting for a lease', labels=['site'])
+            utilization = GaugeMetricFamily('pool_utilization', 'Leased fraction of the maximum pool size',
+                                            labels=['site'])
+            for site, stats in (self.pools() or {}).items():
+                size.add_metric([site], stats['size'])
+                idle.add_metric([site], stats['idle'])
+                utilization.add_metric([site], (stats['size'] - stats['idle']) / stats['max_size'])
+            yield from (size, idle, utilization)
+        if self.cache is not None:
+            stats = self.cache()
+            counter = CounterMetricFamily('cache_lookups', 'Cache lookups by state', labels=['state'])
+            for name, state in (('hits', 'HIT'), ('stale_hits', 'STALE'), ('misses', 'MISS')):
+                counter.add_metric([state], stats[name])
+            yield counter
+            entries = GaugeMetricFamily('cache_entries', 'Entries in each cache tier', labels=['tier'])
+            entries.add_metric(['memory'], stats['memory_entries'])
+            entries.add_metric(['disk'], stats['disk_entries'])
+            yield entries
+        if self.captcha is not None:
+            stats = self.captcha()
+            counter = CounterMetricFamily('captcha_attempts', 'Captchas by outcome', labels=['outcome'])
+            for name in ('solved', 'refreshed', 'accepted', 'rejected', 'prefetched', 'discarded'):
+                counter.add_metric([name], stats[name])
+            yield counter
+            if stats['accuracy'] is not None:
+                yield GaugeMetricFamily('captcha_accuracy', 'Fraction of submitted answers accepted by the site',
+                                        value=stats['accuracy'])
+        if self.limiter is not None:
+            stats = self.limiter()
+            yield GaugeMetricFamily('upstream_rate', 'Requests per second allowed toward the site', value=stats['rate'])
+            yield GaugeMetricFamily('upstream_in_flight', 'Requests to the site in flight', value=stats['in_flight'])
+            counter = CounterMetricFamily('upstream_requests', 'Requests to the site by outcome', labels=['outcome'])
+            for name in ('successes', 'failures', 'slow'):
+                counter.add_metric([name], stats[name])
+            yield counter
+            yield CounterMetricFamily('upstream_retries', 'Steps of lookups retried after a failure',
+                                      value=stats['retries'])
+        if self.flights is not None:
+            stats = self.flights()
+            yield GaugeMetricFamily('lookups_in_flight', 'Distinct lookups being scraped', value=stats['in_flight'])
+            counter = CounterMetricFamily('lookups_flights', 'Lookups by whether they scraped or joined an identical '
+                                          'lookup in flight', labels=['role'])
+            counter.add_metric(['leader'], stats['leaders'])
+            counter.add_metric(['coalesced'], stats['coalesced'])
+            yield counter
+        if self.queue is not None:
+            stats = self.queue()
+            jobs = GaugeMetricFamily('queue_jobs', 'Lookups of the job queue by status', labels=['status'])
+            for name in ('queued', 'leased', 'done', 'failed'):
+                jobs.add_metric([name], stats[name])
+            yield jobs
+            yield GaugeMetricFamily('queue_retried_jobs', 'Lookups of the job queue claimed more than once',
+                                    value=stats['retried'])
+            yield GaugeMetricFamily('queue_oldest_seconds', 'Age of the oldest lookup waiting for a worker',
+                                    value=stats['oldest_queued'])
+        if self.index is not None:
+            stats = self.index()
+            yield GaugeMetricFamily('index_records', 'Records in the local index', value=stats['records'])
+            counter = CounterMetricFamily('index_answers', 'Lookups by whether the local index answered them',
+                                          labels=['outcome'])
+            counter.add_metric(['hit'], stats['hits'])
+            counter.add_metric(['miss'], stats['misses'])
+            yield counter
+
+_collector = None
+_collector_lock = threading.Lock()
+
+def register(**sources):
+    """Register the stats sources, see StatsCollector.
+    Registering again, e.g. when the app starts again in the same process, replaces the previous sources"""
+    global _collector
+    with _collector_lock:
+        if _collector is not None:
+            REGISTRY.unregister(_collector)
+        _collector = StatsCollector(**sources)
+        REGISTRY.register(_collector)
+
+def latest():
+    """Return (body, content type) of the metrics in Prometheus text format"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,143 @@
+"""Functions to parse the pages returned by tracuunnt into list of dicts.
+
+Every function accepts the raw page (bytes or str), an already parsed lxml document, or a BeautifulSoup.
+Raw pages take the fast path: status messages are searched in the bytes and the tables are read with lxml XPath,
+without building a BeautifulSoup tree.
+"""
+import re
+from unicodedata import normalize
+from urllib.parse import urljoin
+import lxml.html
+
+# return codes of process_outer
+EMPTY = -1
+WRONG_CAPTCHA = 0
+
+STATUS_MESSAGES = (("Bạn chưa nhập đủ các thông tin cần thiết.", EMPTY),
+                   ("Không tìm thấy người nộp thuế nào phù hợp.", EMPTY),
+                   ("Không tìm thấy kết quả.", EMPTY),
+                   ("Vui lòng nhập đúng mã xác nhận!", WRONG_CAPTCHA))
+STATUS_BYTES = tuple((message.encode('utf-8'), status) for message, status in STATUS_MESSAGES)
+TABLE_XPATH = "//table[contains(concat(' ', normalize-space(@class), ' '), ' ta_border ')]"
+JS_URL = re.compile(r"""['"]([^'"]+\.jsp[^'"]*)['"]""")
+
+def normalize_nav_string(string):
+    return normalize('NFKC', string.text.strip())
+
+def normalize_text(element):
+    """normalize_nav_string for lxml elements"""
+    return normalize('NFKC', element.text_content().strip())
+
+def to_document(page):
+    """Parse raw page into lxml document. Parsed documents and soups are returned unchanged"""
+    if isinstance(page, bytes):
+        try: # lxml assumes latin-1 when the page doesn't declare its charset
+            return lxml.html.fromstring(page.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError): # let lxml read the declared charset
+            return lxml.html.fromstring(page)
+    if isinstance(page, str):
+        return lxml.html.fromstring(page)
+    return page
+
+def is_soup(page):
+    return hasattr(page, 'find_all')
+
+def find_status(page):
+    """Return EMPTY or WRONG_CAPTCHA if the page shows one of the status messages, otherwise None"""
+    if isinstance(page, bytes):
+        for message, status in STATUS_BYTES:
+            if message in page:
+                return status
+        if b'ta_border' in page:
+            return None
+        page = to_document(page) # not utf-8 or html entities, check decoded text
+    if is_soup(page):
+        text = page.get_text()
+    elif isinstance(page, str):
+        text = page
+    else:
+        text = page.text_content()
+    for message, status in STATUS_MESSAGES:
+        if message in text:
+            return status
+    return None
+
+def _rows_to_dicts(rows, cell_xpath='.//td'):
+    headers = [normalize_text(h) for h in rows[0].xpath('.//th')]
+    return [{h:d for h,d in zip(headers, (normalize_text(d) for d in row.xpath(cell_xpath)))} for row in rows[1:]]
+
+def process_outer(page):
+    """Process the outermost page right after submitted the answer and received the first response"""
+    if is_soup(page):
+        return _process_outer_soup(page)
+    status = find_status(page)
+    if status is not None:
+        return status
+    table = to_document(page).xpath(TABLE_XPATH)[0]
+    rows = table.xpath('.//tr')[:-1]
+    return _rows_to_dicts(rows)
+
+def parse_inner(page):
+    """Parse the inner table returned by clicking on a profile"""
+    if is_soup(page):
+        return _parse_inner_soup(page)
+    table = to_document(page).xpath(TABLE_XPATH)[0]
+    parse_result = []
+    for header in table.xpath('.//th'):
+        data = header.xpath('following-sibling::td[1]')
+        parse_result.append({normalize_text(header):normalize_text(data[0])})
+    return parse_result
+
+def parse_subtable(page):
+    """Parse the sub-tables linked from a business profile"""
+    if is_soup(page):
+        return _parse_subtable_soup(page)
+    return _rows_to_dicts(to_document(page).xpath('//tr'))
+
+def subtable_urls(page, base_url):
+    """Read the url opened by each of the '...' buttons on a business profile, keyed by sub-table name"""
+    urls = {}
+    for elem in to_document(page).xpath("//input[@value='...']"):
+        match = JS_URL.search(elem.get('onclick', ''))
+        if match:
+            url = urljoin(base_url, match.group(1))
+            urls[url.split('?')[0].split('/')[-1][:-4]] = url
+    return urls
+
+def _process_outer_soup(soup):
+    text = soup.get_text()
+    for message, status in STATUS_MESSAGES:
+        if message in text:
+            return status
+    parse_result = []
+    table = soup.find('table', attrs={'class':'ta_border'})
+    rows = table.find_all('tr')
+    rows = rows[:-1]
+    headers = rows[0]
+    headers = [normalize_nav_string(h) for h in headers.find_all('th')]
+    contents = rows[1:]
+    for data in contents:
+        data = (normalize_nav_string(d) for d in data.find_all('td'))
+        parse_result.append({h:d for h,d in zip(headers,data)})
+    return parse_result
+
+def _parse_inner_soup(soup):
+    parse_result = []
+    table = soup.find('table', attrs={'class':'ta_border'})
+    headers = table.find_all('th')
+    for header in headers:
+        data = normalize_nav_string(header.find_next_sibling('td'))
+        header = normalize_nav_string(header)
+        parse_result.append({header:data})
+    return parse_result
+
+def _parse_subtable_soup(soup):
+    parse_result = []
+    soup = soup.find_all('tr')
+    headers = soup[0]
+    headers = [normalize_nav_string(h) for h in headers.find_all('th')]
+    contents = soup[1:]
+    for data in contents:
+        data = (normalize_nav_string(d) for d in data.find_all('td'))
+        parse_result.append({h:d for h,d in zip(headers,data)})
+    return parse_result
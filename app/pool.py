@@ -0,0 +1,203 @@
+"""Pool of long-lived webdrivers so that each API call does not pay for Firefox startup"""
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class PoolExhausted(Exception):
+    """Raised when no driver becomes available before the lease timeout"""
+
+class DriverPool():
+    """Keep between `min_size` and `max_size` drivers alive for one site.
+
+    Drivers are created by `factory`, a callable without argument returning a ready-to-use scraper.
+    A leased driver is health-checked before being handed out, and is recycled after `max_uses` leases.
+    """
+    def __init__(self, factory, min_size=1, max_size=2, max_uses=50, lease_timeout=60):
+        if min_size > max_size:
+            raise ValueError('min_size must not be larger than max_size')
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_uses = max_uses
+        self.lease_timeout = lease_timeout
+        self._idle = queue.LifoQueue() # reuse the warmest driver first
+        self._uses = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return self._idle.qsize()
+
+    def _create(self):
+        driver = self.factory()
+        self._uses[id(driver)] = 0
+        return driver
+
+    def _destroy(self, driver):
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception: # driver may already be dead
+            logger.warning('Failed to quit driver cleanly', exc_info=True)
+        with self._lock:
+            self._size -= 1
+
+    def _reserve(self):
+        """Reserve a slot to create a new driver. Return False if pool is full"""
+        with self._lock:
+            if self._size >= self.max_size:
+                return False
+            self._size += 1
+            return True
+
+    def warm_up(self):
+        """Start drivers until the pool reaches `min_size`"""
+        while self._size < self.min_size and self._reserve():
+            try:
+                self._idle.put(self._create())
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                raise
+        logger.info('Driver pool warmed up with %d drivers', self._size)
+
+    @staticmethod
+    def is_healthy(driver):
+        """Check that the browser and its proxy still respond"""
+        try:
+            driver.current_url
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def reset(driver):
+        """Clear state left by previous lease"""
+        driver.clear_responses()
+
+    @metrics.timed('pool_acquire')
+    def acquire(self):
+        """Take a healthy driver from the pool, starting a new one if there is room"""
+        if self._closed:
+            raise RuntimeError('Pool is closed')
+        deadline = time.monotonic() + self.lease_timeout
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                if self._reserve():
+                    try:
+                        return self._create()
+                    except Exception:
+                        with self._lock:
+                            self._size -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(f'No driver available after {self.lease_timeout}s')
+                try:
+                    driver = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+            if self.is_healthy(driver):
+                return driver
+            logger.warning('Discard unhealthy driver')
+            self._destroy(driver)
+
+    def release(self, driver, discard=False):
+        """Give back a driver. Recycle it if it has been used too much or something went wrong"""
+        self._uses[id(driver)] = self._uses.get(id(driver), 0) + 1
+        if discard or self._closed or self._uses[id(driver)] >= self.max_uses:
+            self._destroy(driver)
+            return
+        try:
+            self.reset(driver)
+        except Exception:
+            self._destroy(driver)
+            return
+        self._idle.put(driver)
+
+    @contextmanager
+    def lease(self):
+        driver = self.acquire()
+        failed = False
+        try:
+            yield driver
+        except Exception:
+            failed = True
+            raise
+        finally: # also release when a generator holding the lease is closed early
+            self.release(driver, discard=failed)
+
+    def close(self):
+        """Quit all idle drivers. Leased drivers are quit when released"""
+        self._closed = True
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._destroy(driver)
+
+    def stats(self):
+        return {'size': self._size, 'idle': self.idle, 'min_size': self.min_size, 'max_size': self.max_size}
+
+class TabFactory():
+    """Factory handing out the tabs of shared browsers, so that a pool of size n needs n / tabs browsers.
+
+    `create` starts a browser whose `open_tab()` returns its next tab, or None when it has no tab left.
+    Each tab is a driver of the pool: it is leased, health-checked and recycled on its own.
+    """
+    def __init__(self, create):
+        self.create = create
+        self._browser = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            tab = None
+            if self._browser is not None:
+                try:
+                    tab = self._browser.open_tab()
+                except Exception: # browser died
+                    logger.warning('Failed to open a tab, starting a new browser', exc_info=True)
+            if tab is None:
+                self._browser = self.create()
+                tab = self._browser.open_tab()
+            return tab
+
+class PoolManager(dict):
+    """Hold one DriverPool per site"""
+    def __init__(self, factories, config=None):
+        super().__init__()
+        config = config or {}
+        defaults = {k:v for k,v in config.items() if k not in factories}
+        for site, factory in factories.items():
+            options = {**defaults, **(config.get(site) or {})}
+            self[site] = DriverPool(factory, **options)
+
+    def warm_up(self):
+        for site, pool in self.items():
+            logger.info('Warming up driver pool for site=%s', site)
+            pool.warm_up()
+
+    def lease(self, site):
+        return self[site].lease()
+
+    def close(self):
+        for pool in self.values():
+            pool.close()
+
+    def stats(self):
+        return {site:pool.stats() for site, pool in self.items()}
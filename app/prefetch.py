@@ -0,0 +1,71 @@
+"""Captchas solved in the background, ahead of the submission that needs them.
+
+A lookup used to fetch and solve each captcha only once the previous page was back and parsed, so that the
+solver's latency added up with the site's. A scraper can instead start the next captcha with CaptchaPrefetch
+while it waits for the site, and take the answer when it submits. Its phases are timed in the trace of the lookup:
+`captcha_prefetch` runs alongside the other phases, `captcha_wait` is the part of it the lookup still waited for.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from metrics import CAPTCHA_STATS
+
+logger = logging.getLogger(__name__)
+
+# threads mostly wait for the site or the solver, one per lookup in flight is plenty
+MAX_WORKERS = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def executor():
+    """Threads shared by every prefetch, started on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix='captcha-prefetch')
+        return _executor
+
+def _prefetch(solve, *args):
+    with metrics.span('captcha_prefetch'):
+        return solve(*args)
+
+def _record_discarded(future):
+    if future.exception() is None:
+        CAPTCHA_STATS.record_prefetch(used=False)
+
+class CaptchaPrefetch():
+    """At most one captcha of a scraper being solved in the background"""
+    def __init__(self):
+        self._future = None
+
+    @property
+    def pending(self):
+        return self._future is not None
+
+    def start(self, solve, *args):
+        """Run solve(*args) in the background. It returns the answer, or None to make the scraper solve anew"""
+        self.discard()
+        self._future = executor().submit(metrics.carry(_prefetch), solve, *args)
+
+    def take(self):
+        """Wait for the answer started last. Return None if there is none, or if it failed"""
+        future, self._future = self._future, None
+        if future is None:
+            return None
+        with metrics.span('captcha_wait'):
+            try:
+                answer = future.result()
+            except Exception as e: # the scraper falls back to solving the captcha in line
+                logger.info('Failed to prefetch a captcha: %r', e)
+                return None
+        if answer is not None:
+            CAPTCHA_STATS.record_prefetch()
+        return answer
+
+    def discard(self):
+        """Forget the pending answer, e.g. when the lookup ends or the captcha is replaced"""
+        future, self._future = self._future, None
+        if future is not None and not future.cancel(): # already solving
+            future.add_done_callback(_record_discarded)
@@ -0,0 +1,68 @@
+"""Batch preprocessing of raw captcha PNGs into model input, without per-image Python-level copies.
+
+Produces exactly what solver.preprocess_image produces for each image, but writes every image
+straight into one preallocated contiguous (N,64,128,1) batch.
+"""
+import cv2
+import numpy as np
+
+HEIGHT = 64
+WIDTH = 128
+KERNEL = np.full((3,3), 127, np.uint8)
+
+class Preprocessor():
+    """Reusable preprocessing pipeline. The output buffer grows to the largest batch seen and is reused,
+    so the returned batch is only valid until the next call"""
+    def __init__(self, height=HEIGHT, width=WIDTH, dtype=np.float32, pad=1):
+        self.height = height
+        self.width = width
+        self.dtype = dtype
+        self.pad = pad
+        self._buffer = np.zeros((0, height, width, 1), dtype)
+
+    def _batch_buffer(self, size):
+        if len(self._buffer) < size:
+            self._buffer = np.zeros((size, self.height, self.width, 1), self.dtype)
+        batch = self._buffer[:size]
+        batch.fill(0)
+        return batch
+
+    def _clean(self, raw):
+        """Decode, remove grid and trim border. Return a view on the decoded alpha channel,
+        or a padded copy when the captcha touches its edge. A blank captcha is returned as is"""
+        image = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_UNCHANGED)[:, :, -1]
+        image[-2:] = 0
+        image = cv2.morphologyEx(image, cv2.MORPH_OPEN, KERNEL)
+        columns = np.flatnonzero(image.any(axis=0))
+        rows = np.flatnonzero(image.any(axis=1))
+        if not len(rows):
+            return image
+        pad = self.pad
+        top, left = rows[0] - pad, columns[0] - pad
+        bottom, right = rows[-1] + 1 + pad, columns[-1] + 1 + pad
+        height, width = image.shape
+        if top >= 0 and left >= 0 and bottom <= height and right <= width:
+            return image[top:bottom, left:right]
+        return cv2.copyMakeBorder(image[max(top, 0):bottom, max(left, 0):right], max(-top, 0),
+                                  max(bottom - height, 0), max(-left, 0), max(right - width, 0),
+                                  cv2.BORDER_CONSTANT, value=0)
+
+    def _fit(self, image, out):
+        """Resize keeping ratio and write it centered into out, whose padding is already zero"""
+        img_h, img_w = image.shape
+        ratio = min(self.height / img_h, self.width / img_w)
+        new_w, new_h = int(img_w*ratio), int(img_h*ratio)
+        top = (self.height - new_h) // 2
+        left = (self.width - new_w) // 2
+        out[top:top+new_h, left:left+new_w] = cv2.resize(image, (new_w, new_h))
+
+    def __call__(self, raw_images):
+        """Turn a sequence of raw PNG bytes into a (N,height,width,1) batch"""
+        batch = self._batch_buffer(len(raw_images))
+        for raw, out in zip(raw_images, batch[:, :, :, 0]):
+            self._fit(self._clean(raw), out)
+        return batch
+
+def preprocess_batch(raw_images, dtype=np.float32):
+    """One-off version of Preprocessor. The batch is a new array"""
+    return Preprocessor(dtype=dtype)(raw_images)
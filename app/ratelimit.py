@@ -0,0 +1,172 @@
+"""Pacing of the requests sent to the site, shared by every scraper of the process, and retries of failed steps.
+
+The limiter keeps at most `concurrency` requests in flight and spaces them to `rate` requests per second.
+The rate adapts like TCP congestion control. Every `window` seconds, it is cut if too many requests failed or
+answered slower than `latency_target`, and raised if requests had to wait for their turn: doubled until the
+first cut (slow start), by `increase` afterwards. The aggregate throughput so stays close to what the site
+tolerates. A failed step of a lookup, e.g. one result page,
+is retried on its own with exponential backoff and jitter instead of failing the whole lookup.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    """The site failed to answer in time or refused to. The step may succeed later"""
+
+class CaptchaRejected(UpstreamError):
+    """The site rejected every captcha answer of a step, which happens when it throttles"""
+
+class AdaptiveLimiter():
+    """Shared gate for the requests sent to the site, see the module docstring.
+
+    Args:
+        rate (float): starting requests per second, adapted between `min_rate` and `max_rate`.
+        concurrency (int): requests in flight at once.
+        increase (float): requests per second added after a window without trouble, once out of slow start.
+        decrease (float): factor applied to the rate after a window where more than `error_threshold`
+            of the requests failed or were slow.
+        latency_target (float): seconds above which a response counts as a sign of overload.
+    """
+    def __init__(self, rate=4.0, min_rate=0.5, max_rate=16.0, concurrency=8, increase=0.5, decrease=0.5,
+                 latency_target=5.0, error_threshold=0.1, window=5.0):
+        if not 0 < min_rate <= rate <= max_rate:
+            raise ValueError('rate must be between min_rate and max_rate')
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        self.window = window
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._next = 0.0 # earliest start of the next request
+        self._window_start = time.monotonic()
+        self._window = {'requests': 0, 'troubles': 0, 'waits': 0}
+        self._slow_start = True
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.slow = 0
+        self.waited = 0.0
+
+    def pace(self, weight=1):
+        """Wait for the turn of `weight` requests"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + weight / self.rate
+            if start > now:
+                self.waited += start - now
+                self._window['waits'] += 1
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def request(self, weight=1):
+        """Hold a slot while sending `weight` requests to the site.
+        UpstreamError raised inside counts as a failure, other errors don't change the rate"""
+        self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            self.pace(weight)
+            start = time.monotonic()
+            try:
+                yield
+            except UpstreamError:
+                self.record(failed=True)
+                raise
+            # concurrent requests take as long as one, so only single requests tell the latency
+            self.record(time.monotonic() - start if weight == 1 else None)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def record(self, latency=None, failed=False):
+        """Count the outcome of a request, and adapt the rate at the end of a window"""
+        with self._lock:
+            slow = latency is not None and latency > self.latency_target
+            self.failures += failed
+            self.slow += slow and not failed
+            self.successes += not (failed or slow)
+            self._window['requests'] += 1
+            self._window['troubles'] += failed or slow
+            now = time.monotonic()
+            if now - self._window_start >= self.window:
+                self._adapt()
+                self._window_start = now
+                self._window = {'requests': 0, 'troubles': 0, 'waits': 0}
+
+    def _adapt(self):
+        window = self._window
+        if window['troubles'] > self.error_threshold * window['requests']:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._slow_start = False
+            logger.info('Slow down to %.2f requests/s: %d of %d requests failed or were slow', self.rate,
+                        window['troubles'], window['requests'])
+        elif window['waits']: # only speed up when the rate is what holds requests back
+            self.rate = min(self.max_rate, self.rate * 2 if self._slow_start else self.rate + self.increase)
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'in_flight': self.in_flight, 'concurrency': self.concurrency,
+                    'successes': self.successes, 'failures': self.failures, 'slow': self.slow,
+                    'waited': self.waited}
+
+class RetryPolicy():
+    """Retry a step up to `attempts` times in all, sleeping a random time up to
+    min(max_backoff, backoff * 2**retry) before each retry (exponential backoff with full jitter)"""
+    def __init__(self, attempts=3, backoff=1.0, max_backoff=30.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+
+    def delay(self, retry):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+    def call(self, step, *args, retry_on=(UpstreamError,), before_retry=None, **kwargs):
+        """Return step(*args, **kwargs), retried when it raises one of retry_on.
+        before_retry() restores what the step needs, e.g. reopens the site, and is retried with it"""
+        retry = 0
+        while True:
+            try:
+                if retry and before_retry is not None:
+                    before_retry()
+                return step(*args, **kwargs)
+            except retry_on as e:
+                if retry + 1 >= self.attempts:
+                    raise
+                delay = self.delay(retry)
+                logger.warning('%s failed: %r. Retry %d/%d in %.1fs', getattr(step, '__name__', step), e,
+                               retry + 1, self.attempts - 1, delay)
+                self.retries += 1
+                retry += 1
+                time.sleep(delay)
+
+LIMITER = AdaptiveLimiter()
+RETRY = RetryPolicy()
+_options = None
+
+def configure(options=None):
+    """Apply the 'ratelimit' section of the config. The adapted rate is kept if the section didn't change"""
+    global LIMITER, RETRY, _options
+    options = dict(options or {})
+    if options == _options:
+        return
+    _options = dict(options)
+    retry = options.pop('retry', None) or {}
+    LIMITER = AdaptiveLimiter(**options)
+    RETRY = RetryPolicy(**retry)
+
+def stats():
+    return {**LIMITER.stats(), 'retries': RETRY.retries}
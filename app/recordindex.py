@@ -0,0 +1,281 @@
+"""Local index of the taxpayer records scraped so far, in a SQLite file.
+
+Every record is stored once by tax number, with its outer row and, when it was scraped, its profile and
+sub-tables. Names and addresses are indexed by token, folded so that a search ignores case and Vietnamese
+diacritics: 'hoa binh' finds 'Hòa Bình'. search() answers such queries from the index alone.
+
+answer() serves lookups without the site when the index is sure to hold the whole answer. The results of every
+search sent to the site are remembered. A search is covered by a fresh one with the same value, or, when the
+earlier search got every page, by one whose value is contained in the new one: the site matches values as
+substrings, so 'hòa bình' only finds records already found by 'hòa'.
+"""
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from unicodedata import category, normalize
+from cache import normalize_value
+from export import iter_records
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 15 # records per page of results on the site
+TAXNUM_FIELDS = ('MST', 'Mã số thuế')
+NAME_FIELD = 'Tên người nộp thuế'
+ADDRESS_PREFIX = 'Địa chỉ'
+SUBTABLES = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+TOKEN = re.compile(r'\w+')
+
+def fold(text):
+    """Normalize text like pageparser.normalize_nav_string, then drop case and diacritics"""
+    text = normalize('NFD', normalize('NFKC', str(text)).casefold())
+    return ''.join(c for c in text if category(c) != 'Mn').replace('đ', 'd')
+
+def tokens(text):
+    return set(TOKEN.findall(fold(text)))
+
+def merge_inner(inner):
+    """Profile as one dict. The parsers return it as a list of {header: value}"""
+    if isinstance(inner, dict):
+        return inner
+    return {key: value for row in inner or () for key, value in row.items()}
+
+def record_fields(outer, inner):
+    """Return (taxnum, name, address) of a record"""
+    fields = {**merge_inner(inner), **(outer or {})}
+    taxnum = next((fields[key] for key in TAXNUM_FIELDS if fields.get(key)), None)
+    address = next((value for key, value in merge_inner(inner).items() if key.startswith(ADDRESS_PREFIX)), '')
+    return taxnum, fields.get(NAME_FIELD, ''), address
+
+def terms_key(search_terms):
+    return json.dumps(sorted((term, normalize_value(value)) for term, value in search_terms.items()),
+                      ensure_ascii=False)
+
+class RecordIndex():
+    """Records by site and tax number, with a token index of names and addresses.
+
+    Args:
+        path (str, optional): SQLite file. The index is kept in memory if None.
+        max_age (dict, optional): seconds a search result stays fresh for answer(), per command.
+            A command missing from it is never answered from the index.
+    """
+    default_max_age = {'pinpoint': 7*86400, 'sweep': 86400, 'harvest': 86400}
+    def __init__(self, path=None, max_age=None):
+        self.max_age = {**self.default_max_age, **(max_age or {})}
+        self._lock = threading.Lock()
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path or ':memory:'), check_same_thread=False, isolation_level=None,
+                                   timeout=30)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records (site TEXT, taxnum TEXT, outer TEXT, inner TEXT, '
+                         'sub TEXT, name TEXT, address TEXT, updated REAL, detailed REAL, '
+                         'PRIMARY KEY (site, taxnum))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tokens (site TEXT, field TEXT, token TEXT, taxnum TEXT, '
+                         'PRIMARY KEY (site, field, token, taxnum)) WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tokens_taxnum ON tokens (site, taxnum)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS searches (site TEXT, terms TEXT, term TEXT, value TEXT, '
+                         'taxnums TEXT, complete INTEGER, updated REAL, PRIMARY KEY (site, terms))')
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, site, outer, inner=None, sub=None, now=None):
+        """Insert or update a record, keeping what the new scrape didn't fetch. Return its tax number"""
+        taxnum, name, address = record_fields(outer, inner)
+        if not taxnum:
+            return None
+        row = self._db.execute('SELECT outer, inner, sub, address, detailed FROM records WHERE site=? AND taxnum=?',
+                               (site, taxnum)).fetchone()
+        detailed = now if inner is not None else None
+        if row is not None:
+            if outer is None:
+                outer = json.loads(row[0])
+            if inner is None:
+                inner, detailed = json.loads(row[1]) if row[1] else None, row[4]
+                address = address or row[3]
+            if row[2]:
+                sub = {**json.loads(row[2]), **(sub or {})}
+        self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (site, taxnum, json.dumps(outer, ensure_ascii=False),
+                          json.dumps(inner, ensure_ascii=False) if inner is not None else None,
+                          json.dumps(sub, ensure_ascii=False) if sub else None, name, address, now, detailed))
+        self._db.execute('DELETE FROM tokens WHERE site=? AND taxnum=?', (site, taxnum))
+        self._db.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?)',
+                             [(site, field, token, taxnum)
+                              for field, text in (('name', name), ('address', address)) for token in tokens(text)])
+        return taxnum
+
+    def ingest(self, site, command, search_terms, result, max_page=None):
+        """Store the records of a lookup result, as returned by ProfileScraper.run, and remember its search.
+        max_page is the page limit of a sweep or harvest, to tell whether it got every page"""
+        records = list(iter_records(command, (result or {}).get('result')))
+        now = time.time()
+        if command == 'pinpoint':
+            complete = len(records) < PAGE_SIZE
+        else:
+            complete = max_page is not None and len(records) < max_page * PAGE_SIZE
+        term, value = next(iter(search_terms.items())) if len(search_terms) == 1 else (None, None)
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                taxnums = [self._store(site, record.get('outer'), record.get('inner'), record.get('sub'), now)
+                           for record in records]
+                if None not in taxnums:
+                    self._db.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (site, terms_key(search_terms), term,
+                                      normalize_value(value) if term else None, json.dumps(taxnums),
+                                      int(complete), now))
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def ingest_page(self, site, outer):
+        """Store the records of one page of a streamed sweep"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for row in outer:
+                    self._store(site, row, now=now)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _records(self, site, taxnums):
+        """Records by tax number, as {taxnum: (outer, inner, sub, name, address, detailed)}"""
+        records = {}
+        for start in range(0, len(taxnums), 500): # stay below the number of SQL variables
+            chunk = taxnums[start:start + 500]
+            for row in self._db.execute('SELECT taxnum, outer, inner, sub, name, address, detailed FROM records '
+                                        f'WHERE site=? AND taxnum IN ({",".join("?" * len(chunk))})',
+                                        (site, *chunk)):
+                records[row[0]] = (json.loads(row[1]), json.loads(row[2]) if row[2] else None,
+                                   json.loads(row[3]) if row[3] else {}, row[4], row[5], row[6])
+        return records
+
+    def _covering_search(self, site, command, search_terms, fresh):
+        """Return (taxnums, exact) of the fresh search that holds every record of this one, or None"""
+        row = self._db.execute('SELECT taxnums, complete FROM searches WHERE site=? AND terms=? AND updated>?',
+                               (site, terms_key(search_terms), fresh)).fetchone()
+        if row is not None and (row[1] or command == 'pinpoint'):
+            return json.loads(row[0]), True
+        if len(search_terms) != 1 or command == 'pinpoint':
+            return None
+        (term, value), = search_terms.items()
+        if term not in ('name', 'address'):
+            return None
+        value = normalize_value(value)
+        # the longest value contained in this one found the fewest records
+        row = self._db.execute('SELECT taxnums FROM searches WHERE site=? AND term=? AND complete=1 AND updated>? '
+                               'AND instr(?, value) > 0 ORDER BY length(value) DESC LIMIT 1',
+                               (site, term, fresh, value)).fetchone()
+        return (json.loads(row[0]), False) if row is not None else None
+
+    def answer(self, site, command, search_terms, subtables=None, max_page=None):
+        """Return the result ProfileScraper.run would return, or None if the index may not hold all of it"""
+        if command not in self.max_age or max_page is not None:
+            self.misses += 1
+            return None
+        fresh = time.time() - self.max_age[command]
+        with self._lock:
+            covering = self._covering_search(site, command, search_terms, fresh)
+            records = self._records(site, covering[0]) if covering is not None else {}
+        result = self._answer(site, command, search_terms, subtables, fresh, covering, records)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {'command': command, 'result': result}
+
+    def _answer(self, site, command, search_terms, subtables, fresh, covering, records):
+        if covering is None:
+            return None
+        taxnums, exact = covering
+        if any(taxnum not in records for taxnum in taxnums):
+            return None
+        if not exact: # keep the records of the broader search that this one finds too
+            (term, value), = search_terms.items()
+            value = normalize_value(value)
+            field = 3 if term == 'name' else 4
+            if term == 'address' and any(not records[taxnum][4] for taxnum in taxnums):
+                return None # unknown address, can't tell whether the site would find it
+            taxnums = [taxnum for taxnum in taxnums if value in normalize_value(records[taxnum][field])]
+        if command == 'sweep':
+            return {'outer': renumber([records[taxnum][0] for taxnum in taxnums])}
+        wanted = [name for name in SUBTABLES if not subtables or name in subtables] if site == 'business' else []
+        if command == 'pinpoint': # only the first record of the page is detailed
+            if not taxnums:
+                return None # empty result: the lookup returns None, which can't be told apart from a miss
+            taxnums = taxnums[:PAGE_SIZE]
+            detail = self._detail(records[taxnums[0]], wanted, fresh)
+            if detail is None:
+                return None
+            return {'outer': [records[taxnum][0] for taxnum in taxnums], **detail}
+        details = [self._detail(records[taxnum], wanted, fresh) for taxnum in taxnums]
+        if None in details:
+            return None
+        return [{'outer': outer, **detail} for outer, detail in
+                zip(renumber([records[taxnum][0] for taxnum in taxnums]), details)]
+
+    @staticmethod
+    def _detail(record, wanted, fresh):
+        """{'inner': profile, 'sub': wanted sub-tables} of a record, or None if they are missing or too old"""
+        _, inner, sub, _, _, detailed = record
+        if inner is None or (detailed or 0) <= fresh or any(name not in sub for name in wanted):
+            return None
+        detail = {'inner': inner}
+        if wanted:
+            detail['sub'] = {name: sub[name] for name in wanted}
+        return detail
+
+    def search(self, site, query, field=None, limit=20):
+        """Records whose name or address, or only `field`, has a token starting with each token of the query,
+        ignoring case and diacritics. The first matches found are returned, shorter names first"""
+        words = tokens(query)
+        if not words:
+            return []
+        fields = (field,) if field else ('name', 'address')
+        where = f'WHERE t.site=? AND t.field IN ({",".join("?" * len(fields))}) AND t.token>=? AND t.token<?'
+        params = {word: (site, *fields, word, word + '\uffff') for word in words}
+        matches = []
+        with self._lock:
+            # walk the records holding the rarest word and check the other words on them
+            counts = {word: self._db.execute(f'SELECT COUNT(*) FROM (SELECT 1 FROM tokens t {where} LIMIT 10000)',
+                                             params[word]).fetchone()[0] for word in words}
+            rarest = min(words, key=counts.get)
+            if not counts[rarest]:
+                return []
+            others = words - {rarest}
+            for row in self._db.execute('SELECT DISTINCT r.taxnum, r.outer, r.inner, r.sub, r.name, r.address, '
+                                        'r.updated, r.detailed FROM tokens t JOIN records r '
+                                        f'ON r.site=t.site AND r.taxnum=t.taxnum {where}', params[rarest]):
+                found = set().union(*(tokens(text) for name, text in zip(('name', 'address'), row[4:6])
+                                      if name in fields))
+                if all(any(token.startswith(word) for token in found) for word in others):
+                    matches.append(row)
+                    if len(matches) >= limit * 5:
+                        break
+        matches.sort(key=lambda row: len(row[4]))
+        return [{'taxnum': taxnum, 'outer': json.loads(outer), 'inner': json.loads(inner) if inner else None,
+                 'sub': json.loads(sub) if sub else None, 'updated': updated, 'detailed': detailed}
+                for taxnum, outer, inner, sub, _, _, updated, detailed in matches[:limit]]
+
+    def stats(self):
+        with self._lock:
+            records = self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+            searches = self._db.execute('SELECT COUNT(*) FROM searches').fetchone()[0]
+        return {'records': records, 'searches': searches, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def renumber(rows):
+    """Number the outer rows from 1 like the site does, since they may come from different searches"""
+    return [{**row, 'STT': str(index)} if 'STT' in row else row for index, row in enumerate(rows, 1)]
@@ -0,0 +1,48 @@
+"""Coalescing of identical lookups in flight, so that a burst of the same search costs one scrape"""
+import threading
+from concurrent.futures import Future
+
+class SingleFlight():
+    """Run one call per key at a time. Identical calls arriving meanwhile wait for it and share its result,
+    or its exception"""
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Return the Future of the call in flight for key, or None. Joining counts as a coalesced call"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+            return future
+
+    def run(self, key, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), or the result of the identical call already in flight"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'leaders': self.leaders, 'coalesced': self.coalesced}
@@ -1,8 +1,20 @@
 """Functions and Class to manage I/O for Tensorflow Serving Webserver"""
 
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
 import cv2
 import numpy as np
 import requests as rq
+from requests.adapters import HTTPAdapter
+from preprocess import Preprocessor
+from metrics import CAPTCHA_STATS
+
+logger = logging.getLogger(__name__)
 
 VALID_CHAR = '2345678abcdefghkmnprwxy'
 VALID_SIZE = 5
@@ -35,15 +47,14 @@ def trim_border(image,pad=1):
         pad (int, optional): add zero-pixel border around the image. Defaults to 1.
 
     Returns:
-        image: image after trim and pad
+        image: image after trim and pad. A blank image is returned as is
     """
     column = np.nonzero(image.sum(axis=0))[0]
-    left = column.min()-pad
-    right = column.max()+1+pad
     row = np.nonzero(image.sum(axis=1))[0]
-    top = row.min()-pad
-    bottom = row.max()+1+pad
-    return image[top:bottom,left:right]
+    if not len(column):
+        return image
+    # pad with zeros rather than slicing past the content, which may touch the edge of the image
+    return np.pad(image[row.min():row.max()+1, column.min():column.max()+1], pad)
 
 def preprocess_raw_image(cv2_image, pad=1):
     """Standardize captcha image by consecutively apply remove_grid then trim
@@ -82,11 +93,15 @@ def image_to_list(image):
     img = np.expand_dims(img, -1)
     return img.tolist()
 
+def image_to_batch(image):
+    """reshape into correct shape (bs,height,width,channel) without converting to Python list"""
+    return np.asarray(image)[np.newaxis, :, :, np.newaxis]
+
 def preprocess_image(raw_input):
     img = decode_image(raw_input)
     img = preprocess_raw_image(img)
     img = resize_then_pad(img, 64, 128)
-    img = image_to_list(img)
+    img = image_to_batch(img)
     return img
 
 def to_categorical(y, num_classes=None, dtype='float32'):
@@ -137,6 +152,30 @@ def label_to_array(label, valid_char=VALID_CHAR, valid_num=VALID_SIZE):
         label_vector.append(valid_char.find(char))
     return to_categorical(label_vector, num_classes=len(valid_char))
 
+VALID_ARRAY = np.array(list(VALID_CHAR))
+
+def decode_labels(predictions, valid_array=VALID_ARRAY):
+    """Vectorized array_to_label over a (N,VALID_SIZE,len(VALID_CHAR)) batch. Return list of N strings"""
+    chars = valid_array[np.argmax(predictions, axis=-1)]
+    return chars.view(f'U{chars.shape[-1]}').ravel().tolist()
+
+def to_probabilities(predictions):
+    """Return predictions as per-character probabilities, applying softmax if the model outputs logits.
+    The shipped model applies one softmax over all VALID_SIZE*len(VALID_CHAR) outputs, so its characters
+    sum to about 1/VALID_SIZE each and are normalized instead"""
+    predictions = np.asarray(predictions, dtype=np.float32)
+    if (predictions >= 0).all():
+        return predictions / np.maximum(predictions.sum(axis=-1, keepdims=True), np.finfo(np.float32).tiny)
+    exp = np.exp(predictions - predictions.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+def decode_with_confidence(predictions, valid_array=VALID_ARRAY):
+    """Same as decode_labels but also return per-character probabilities (N,VALID_SIZE)
+    and overall confidence (N,), the probability that the whole label is right"""
+    probabilities = to_probabilities(predictions)
+    char_confidence = probabilities.max(axis=-1)
+    return decode_labels(probabilities, valid_array), char_confidence, char_confidence.prod(axis=-1)
+
 def array_to_label(array, trans_char=VALID_CHAR):
     """reverse from one-hot coded array to label
 
@@ -153,15 +192,274 @@ def array_to_label(array, trans_char=VALID_CHAR):
         result.append(trans_char[vector])
     return result
 
+PIXEL_JSON = ['[%d]' % i for i in range(256)] # a pixel of a single channel image
+
+def encode_json(batch, encoding='row'):
+    """Serialize a batch into a TF Serving REST request body.
+    'row' sends {"instances": ...}, 'columnar' sends {"inputs": ...}.
+    uint8 single channel images are written row by row from a lookup table instead of through tolist()"""
+    batch = np.asarray(batch)
+    key = {'row': 'instances', 'columnar': 'inputs'}[encoding]
+    if batch.dtype != np.uint8 or batch.ndim != 4 or batch.shape[-1] != 1:
+        return json.dumps({key:batch.tolist()}, separators=(',', ':'))
+    table = PIXEL_JSON
+    images = ('[%s]' % ','.join('[%s]' % ','.join([table[p] for p in row]) for row in image[:, :, 0].tolist())
+              for image in batch)
+    return '{"%s":[%s]}' % (key, ','.join(images))
+
+def decode_json(body):
+    """Read the predictions of a TF Serving REST response body"""
+    result = json.loads(body)
+    return np.asarray(result['predictions'] if 'predictions' in result else result['outputs'], dtype=np.float32)
+
+class RestBackend():
+    """Send images to Tensorflow Serving REST API through a keep-alive session"""
+    input_dtype = np.uint8 # integer pixels are shorter in JSON
+    def __init__(self, url=r"http://localhost:8501/v1/models/solver:predict", encoding='row', timeout=10):
+        self.url = url
+        self.encoding = encoding
+        self.timeout = timeout
+        self.session = rq.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=16))
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def predict_batch(self, batch):
+        """Predict a (N,64,128,1) batch and return a (N,VALID_SIZE,len(VALID_CHAR)) array"""
+        response = self.session.post(self.url, data=encode_json(batch, self.encoding), timeout=self.timeout)
+        response.raise_for_status()
+        return decode_json(response.content)
+
+def encode_tensor_proto(batch, tensor_proto_class, dtype_enum):
+    """Serialize a batch as float32 TensorProto with raw tensor_content"""
+    batch = np.ascontiguousarray(batch, dtype=np.float32)
+    proto = tensor_proto_class(dtype=dtype_enum, tensor_content=batch.tobytes())
+    for size in batch.shape:
+        proto.tensor_shape.dim.add(size=size)
+    return proto
+
+def decode_tensor_proto(proto):
+    shape = [dim.size for dim in proto.tensor_shape.dim]
+    if proto.tensor_content:
+        return np.frombuffer(proto.tensor_content, dtype=np.float32).reshape(shape)
+    return np.asarray(proto.float_val, dtype=np.float32).reshape(shape)
+
+class GrpcBackend():
+    """Send images to Tensorflow Serving gRPC PredictionService as binary TensorProto.
+    Require grpcio and tensorflow-serving-api"""
+    def __init__(self, target='localhost:8500', model_name='solver', signature='serving_default',
+                 input_name=None, output_name=None, timeout=10):
+        import grpc
+        from tensorflow.core.framework import tensor_pb2, types_pb2
+        from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+        self._tensor_proto = tensor_pb2.TensorProto
+        self._dt_float = types_pb2.DT_FLOAT
+        self._request_class = predict_pb2.PredictRequest
+        self.channel = grpc.insecure_channel(target)
+        self.stub = prediction_service_pb2_grpc.PredictionServiceStub(self.channel)
+        self.model_name = model_name
+        self.signature = signature
+        self.timeout = timeout
+        if not (input_name and output_name):
+            input_name, output_name = self._read_signature(input_name, output_name)
+        self.input_name = input_name
+        self.output_name = output_name
+
+    def _read_signature(self, input_name, output_name):
+        """Ask the server for the input and output names of the signature"""
+        from tensorflow_serving.apis import get_model_metadata_pb2
+        request = get_model_metadata_pb2.GetModelMetadataRequest()
+        request.model_spec.name = self.model_name
+        request.metadata_field.append('signature_def')
+        response = self.stub.GetModelMetadata(request, timeout=self.timeout)
+        signatures = get_model_metadata_pb2.SignatureDefMap()
+        response.metadata['signature_def'].Unpack(signatures)
+        signature = signatures.signature_def[self.signature]
+        return input_name or next(iter(signature.inputs)), output_name or next(iter(signature.outputs))
+
+    def predict_batch(self, batch):
+        request = self._request_class()
+        request.model_spec.name = self.model_name
+        request.model_spec.signature_name = self.signature
+        request.inputs[self.input_name].CopyFrom(encode_tensor_proto(batch, self._tensor_proto, self._dt_float))
+        response = self.stub.Predict(request, timeout=self.timeout)
+        return decode_tensor_proto(response.outputs[self.output_name])
+
+class TFLiteBackend():
+    """Run a TFLite conversion of the model in process. Require tflite_runtime or tensorflow"""
+    def __init__(self, model_path, num_threads=1):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=str(model_path), num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self._lock = threading.Lock() # an interpreter can only run one inference at a time
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch, dtype=self.input['dtype'])
+        with self._lock:
+            if tuple(self.input['shape']) != batch.shape:
+                self.interpreter.resize_tensor_input(self.input['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self.input = self.interpreter.get_input_details()[0]
+                self.output = self.interpreter.get_output_details()[0]
+            self.interpreter.set_tensor(self.input['index'], batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output['index']).copy()
+
+class OnnxBackend():
+    """Run an ONNX conversion of the model in process. Require onnxruntime"""
+    def __init__(self, model_path, num_threads=1):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(model_path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        return self.session.run(None, {self.input_name:batch})[0]
+
+class BatchingBackend():
+    """Collect images from concurrent callers for up to `max_delay` seconds or `max_size` images,
+    run them through the wrapped backend as one batch, then fan the predictions back out"""
+    def __init__(self, backend, max_size=8, max_delay=0.01):
+        self.backend = backend
+        self.input_dtype = getattr(backend, 'input_dtype', np.float32) # the images pass through unchanged
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.queue_time = 0.0 # total seconds images spent waiting for their batch
+        self.max_queue_time = 0.0
+        threading.Thread(target=self._worker, name='solver-batcher', daemon=True).start()
+
+    def predict_batch(self, batch):
+        futures = []
+        for image in np.asarray(batch):
+            future = Future()
+            self._queue.put((image, time.monotonic(), future))
+            futures.append(future)
+        return np.stack([future.result() for future in futures])
+
+    def _collect(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(items) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _worker(self):
+        while True:
+            items = self._collect()
+            start = time.monotonic()
+            try:
+                predictions = self.backend.predict_batch(np.stack([image for image, _, _ in items]))
+            except Exception as e:
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), prediction in zip(items, predictions):
+                future.set_result(prediction)
+            with self._lock:
+                self.batches += 1
+                self.images += len(items)
+                waits = [start - queued for _, queued, _ in items]
+                self.queue_time += sum(waits)
+                self.max_queue_time = max(self.max_queue_time, max(waits))
+
+    def stats(self):
+        with self._lock:
+            return {'batches': self.batches,
+                    'images': self.images,
+                    'mean_batch_size': self.images / self.batches if self.batches else 0,
+                    'mean_queue_time': self.queue_time / self.images if self.images else 0,
+                    'max_queue_time': self.max_queue_time}
+
+BACKENDS = {'rest': RestBackend,
+            'grpc': GrpcBackend,
+            'tflite': TFLiteBackend,
+            'onnx': OnnxBackend}
+
+def create_backend(config=None):
+    """Create the backend named in config['backend']. Fall back to REST if a local backend cannot be loaded"""
+    config = dict(config or {})
+    name = config.pop('backend', 'rest')
+    rest_config = {k:config.pop(k) for k in ('url', 'encoding') if k in config}
+    batch = config.pop('batch', None)
+    config.pop('confidence_threshold', None)
+    config.pop('max_refresh', None)
+    backend = None
+    if name != 'rest':
+        try:
+            backend = BACKENDS[name](**config)
+        except Exception:
+            logger.exception('Failed to load solver backend %s. Fall back to REST', name)
+    if backend is None:
+        backend = RestBackend(**rest_config)
+    if batch:
+        backend = BatchingBackend(backend, **batch)
+    return backend
+
+Answer = namedtuple('Answer', ['label', 'char_confidence', 'confidence'])
+
 class SolverManager():
-    """Manage I/O for Solver"""
-    def __init__(self, MODEL_API = r"http://localhost:8501/v1/models/solver:predict"):
+    """Manage I/O for Solver.
+
+    Args:
+        backend: object with predict_batch method. Defaults to RestBackend(MODEL_API).
+        confidence_threshold (float, optional): scrapers refresh the captcha instead of submitting
+            an answer whose confidence is lower. Defaults to 0, always submit.
+        max_refresh (int, optional): refresh at most this many times in a row. Defaults to 3.
+    """
+    def __init__(self, MODEL_API = r"http://localhost:8501/v1/models/solver:predict", backend=None,
+                 confidence_threshold=0.0, max_refresh=3):
         self.API = MODEL_API
-        
+        self.backend = backend or RestBackend(MODEL_API)
+        self.confidence_threshold = confidence_threshold
+        self.max_refresh = max_refresh
+        self._local = threading.local() # preprocessing buffers are reused, one per thread
+
+    def _preprocessor(self):
+        if not hasattr(self._local, 'preprocessor'):
+            self._local.preprocessor = Preprocessor(dtype=getattr(self.backend, 'input_dtype', np.float32))
+        return self._local.preprocessor
+
     def predict(self, raw_input):
-        image = preprocess_image(raw_input)
-        with rq.post(self.API, json={'instances':image}) as response:
-            json_result = response.json()
-        return ''.join(array_to_label(np.array(json_result['predictions'])[0]))
-    
+        return self.predict_many([raw_input])[0]
+
+    def predict_many(self, raw_inputs):
+        """Solve several captchas with one prediction call"""
+        return [answer.label for answer in self.solve_many(raw_inputs)]
+
+    def solve(self, raw_input):
+        """Solve a captcha. Return Answer(label, char_confidence, confidence)"""
+        return self.solve_many([raw_input])[0]
+
+    def solve_many(self, raw_inputs):
+        batch = self._preprocessor()(raw_inputs)
+        predictions = self.backend.predict_batch(batch)
+        labels, char_confidence, confidence = decode_with_confidence(predictions)
+        for _ in raw_inputs:
+            CAPTCHA_STATS.record_solve()
+        return [Answer(label, chars.tolist(), float(conf))
+                for label, chars, conf in zip(labels, char_confidence, confidence)]
+
+    def is_confident(self, answer):
+        return answer.confidence >= self.confidence_threshold
 
+    def stats(self):
+        stats = {'captcha': CAPTCHA_STATS.stats()}
+        if hasattr(self.backend, 'stats'):
+            stats['backend'] = self.backend.stats()
+        return stats
@@ -1,6 +1,9 @@
 """Useful functions and class to manage input/output and config"""
 import csv
+import io
 import logging
+import logging.config
+import threading
 from pathlib import Path
 import yaml
 
@@ -21,9 +24,66 @@ def import_config(config_folder=None):
         Config.create_template('template.yaml',r'config')
         Config.loads_yaml(r'config')
     else:
-        Config.loads_yaml(config_folder)
+        Config.loads_yaml(config_path)
     return Config
 
+_config = None
+_config_lock = threading.Lock()
+
+def load_config(config_folder=None):
+    """Return the config shared by the process. It is loaded, and logging configured, on first call only"""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = import_config(config_folder)
+            init_logger(_config['logging'])
+        return _config
+
+class ConfigWatcher():
+    """Reload a config in place when the yaml files of its folder change, polling every `interval` seconds.
+
+    Sections read on each lookup, such as scraper, ratelimit or logging through `on_change(config)`, follow the
+    files. Objects built from the config at startup, such as the pools or the executor, are not rebuilt.
+    """
+    def __init__(self, config, config_folder=None, interval=2.0, on_change=None):
+        self.config = config
+        self.folder = Path(config_folder or r'config')
+        self.interval = interval
+        self.on_change = on_change
+        self._stop = threading.Event()
+        self._mtimes = self._scan()
+        self._thread = threading.Thread(target=self._run, name='config-watcher', daemon=True)
+
+    def _scan(self):
+        return {path: path.stat().st_mtime_ns for path in self.folder.glob('*.yaml')}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                mtimes = self._scan()
+                if mtimes != self._mtimes:
+                    self._mtimes = mtimes
+                    self.reload()
+            except Exception: # e.g. a file saved half-way, keep the current config
+                logger.warning('Failed to reload config', exc_info=True)
+
+    def reload(self):
+        new = ConfigManager()
+        new.loads_yaml(self.folder)
+        self.config.update(new) # in place, so that every holder of the config sees the new values
+        for section in set(self.config) - set(new):
+            del self.config[section]
+        logger.warning('Config reloaded from %s', self.folder)
+        if self.on_change is not None:
+            self.on_change(self.config)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
 class ConfigManager(dict):
     """Convinient way to load and manage all configuration files.
     This is just a bigger dict with some convinient methods.
@@ -71,3 +131,38 @@ def generate_from_csv(file_object):
     reader = csv.DictReader(file_object)
     for i,row in enumerate(reader):
         yield i,row
+
+def generate_from_xlsx(file_object):
+    """Same as generate_from_csv but for the first sheet of a xlsx file. Require openpyxl"""
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_object, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        headers = [str(h) for h in next(rows, ())]
+        for i,row in enumerate(rows):
+            yield i,{h:('' if d is None else str(d)) for h,d in zip(headers,row)}
+    finally:
+        workbook.close()
+
+def generate_from_xls(file_object):
+    """Same as generate_from_csv but for the first sheet of a xls file. Require xlrd"""
+    import xlrd
+    workbook = xlrd.open_workbook(file_contents=file_object.read(), on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        headers = [str(h) for h in sheet.row_values(0)]
+        for i in range(1, sheet.nrows):
+            yield i-1,{h:str(d) for h,d in zip(headers,sheet.row_values(i))}
+    finally:
+        workbook.release_resources()
+
+def generate_from_file(file_object):
+    """Sniff the signature of a binary file object then yield its rows as (index, dict)"""
+    signature = file_object.read(8)
+    file_object.seek(0)
+    if check_xls(signature):
+        yield from generate_from_xls(file_object)
+    elif check_xlsx(signature):
+        yield from generate_from_xlsx(file_object)
+    else:
+        yield from generate_from_csv(io.TextIOWrapper(file_object, encoding='utf-8-sig', newline=''))
@@ -1,9 +1,31 @@
 # -*- coding: utf-8 -*-
 import os
+import asyncio
+import base64
+import json
+import logging
+import queue
+import threading
+import time
 from enum import Enum
-from fastapi import FastAPI
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from uvicorn import run
-from main import search
+import utility
+import metrics
+import ratelimit
+import export
+import main
+from main import search_by, iter_sweep, create_pools, create_solver, create_index, FLIGHTS
+from bulk import JobManager
+from cache import ResultCache, MISS, STALE, make_key
+from executor import BoundedExecutor, ExecutorSaturated
+from pool import PoolExhausted
+from ratelimit import UpstreamError
+from jobqueue import create_queue, JobTimeout
+from metrics import CAPTCHA_STATS
 
 class Site(str, Enum):
     """Specify which site to scrape"""
@@ -12,9 +34,22 @@ class Site(str, Enum):
 
 class Command(str, Enum):
     """Scrape will only get the 1st result from the search term, 
-    while scan will gather as much information outside as possible without ever going into details"""
+    while scan will gather as much information outside as possible without ever going into details.
+    Harvest sweeps then gets every result in detail"""
     pinpoint = 'pinpoint'
     sweep = 'sweep'
+    harvest = 'harvest'
+
+class IndexField(str, Enum):
+    """Field of the records searched in the local index"""
+    name = 'name'
+    address = 'address'
+
+class ExportFormat(str, Enum):
+    """File format of an export"""
+    csv = 'csv'
+    parquet = 'parquet'
+    arrow = 'arrow'
 
 class SearchTerms(Enum):
     """Search terms corresponding to its associated field"""
@@ -23,11 +58,338 @@ class SearchTerms(Enum):
     address = 'address'
     idnum = 'idnum'
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
+pools = None
+remote = None # job queue to the worker processes, if lookups don't run in this process
+watcher = None
+executor = None
+jobs = None
+cache = None
+
+SUBTABLES = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+
+def lookup(site, command, search_terms, **options):
+    if remote is not None:
+        return FLIGHTS.run(make_key(site, command, search_terms, options), remote.call,
+                           site, command, search_terms, **options)
+    return search_by(site, command, search_terms, pools, **options)
+
+def traced_lookup(site, command, search_terms, options):
+    """Lookup and store the result in cache. Return it with the time spent in each phase"""
+    with metrics.trace() as timings:
+        result = cache.lookup(site, command, search_terms, lookup, options)
+    return result, timings
+
+def traced_fetch(site, command, search_terms, options):
+    """Read the disk tier of the cache, and lookup on a miss. Return (result, state, age, timings)"""
+    result, state, age = cache.get(site, command, search_terms, options)
+    if state == MISS:
+        result, timings = traced_lookup(site, command, search_terms, options)
+        return result, state, age, timings
+    if state == STALE:
+        cache.refresh(site, command, search_terms, lookup, executor.submit, options)
+    return result, state, age, {}
+
+def cached_lookup(site, command, search_terms):
+    """Lookup used by bulk jobs, which already run inside a worker"""
+    return cache.fetch(site, command, search_terms, lookup, schedule=executor.submit)[0]
+
+def apply_config(config):
+    """Follow the sections of a reloaded config that are not read on each lookup"""
+    utility.init_logger(config['logging'])
+    ratelimit.configure(config.get('ratelimit'))
+
+def warm_up(config):
+    """Load the solver and start webdrivers ahead of the first lookup"""
+    try:
+        if remote is None:
+            create_solver(config)
+        if pools is not None:
+            pools.warm_up()
+    except Exception: # lookups will try again
+        logger.exception('Warm-up failed')
+
+@app.on_event('startup')
+def start_workers():
+    """Start worker threads, then the solver and webdrivers in background so that the API answers at once"""
+    global pools, remote, executor, jobs, cache, watcher
+    config = utility.load_config()
+    executor = BoundedExecutor(**(config.get('executor') or {}))
+    remote = create_queue(config.get('queue'))
+    index = create_index(config)
+    pools = create_pools(config) if remote is None else None
+    cache = ResultCache(**(config.get('cache') or {}))
+    jobs = JobManager(executor, cached_lookup, **(config.get('bulk') or {}))
+    ratelimit.configure(config.get('ratelimit'))
+    metrics.register(executor=executor.stats, pools=pools.stats if pools is not None else None,
+                     cache=cache.stats, captcha=CAPTCHA_STATS.stats, limiter=ratelimit.stats, flights=FLIGHTS.stats,
+                     queue=remote.stats if remote is not None else None,
+                     index=index.stats if index is not None else None)
+    reload = config.get('reload') or {}
+    if reload.get('watch'):
+        watcher = utility.ConfigWatcher(config, interval=reload.get('interval', 2), on_change=apply_config).start()
+    threading.Thread(target=warm_up, args=(config,), name='warm-up', daemon=True).start()
+
+@app.on_event('shutdown')
+def stop_workers():
+    if watcher is not None:
+        watcher.stop()
+    if executor is not None:
+        executor.shutdown()
+    if pools is not None:
+        pools.close()
+    if remote is not None:
+        remote.close()
+
+@app.get(r'/api/v1/jobs/{job_id}')
+async def job_status(job_id: str):
+    """Progress of a bulk job"""
+    if job_id not in jobs.jobs:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return jobs.jobs[job_id].stats()
+
+@app.get(r'/api/v1/jobs/{job_id}/results')
+def job_results(job_id: str):
+    """Stream the results of a bulk job as NDJSON, one line per row as soon as it finishes"""
+    if job_id not in jobs.jobs:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return StreamingResponse(jobs.stream(job_id), media_type='application/x-ndjson')
+
+@app.get(r'/api/v1/jobs/{job_id}/export')
+def job_export(job_id: str, format: ExportFormat = ExportFormat.csv):
+    """Download the results of a bulk job as one flat row per record, written as the rows finish.
+    Rows that failed have only input_row, search and error"""
+    if job_id not in jobs.jobs:
+        raise HTTPException(status_code=404, detail='Job not found')
+    writer = create_writer(format)
+    return export_response(export.result_rows(jobs.stream(job_id)), writer, format, job_id)
+
+@app.post(r'/api/v1/{site}/{command}/bulk')
+async def create_job(site: Site, command: Command, request: Request):
+    """Start a bulk job. Accept either a CSV/XLS/XLSX file uploaded as form field 'file'
+    whose columns are search terms, or a JSON list of {term: value}"""
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        if 'file' not in form:
+            raise HTTPException(status_code=422, detail="Missing form field 'file'")
+        job = jobs.create_from_file(site.value, command.value, form['file'].file)
+    else:
+        rows = await request.json()
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise HTTPException(status_code=422, detail='Body must be a list of {term: value}')
+        job = jobs.create_from_list(site.value, command.value, rows)
+    return job.stats()
+
+def encode_cursor(site, search_terms, next_page):
+    """Opaque token to resume a sweep stream at next_page"""
+    state = json.dumps({'site': site, 'search_terms': search_terms, 'next_page': next_page}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(state.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return state['site'], state['search_terms'], int(state['next_page'])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=422, detail='Invalid cursor')
+
+class SweepPages():
+    """Run a sweep in a worker thread and iterate over its pages while it goes, or the exception that ended it.
+    The worker keeps at most `ahead` pages in advance of the reader. Once closed, even if it was never read
+    from, e.g. the client went away before the first page, the sweep stops at its next page"""
+    done = object()
+    def __init__(self, site, search_terms, start_page, max_page, ahead=2):
+        self._pages = queue.Queue(ahead)
+        self._stop = threading.Event()
+        executor.submit(self._produce, site, search_terms, start_page, max_page)
+
+    def _put(self, item):
+        """Wait for room in the queue. Return False if the reader is gone"""
+        while not self._stop.is_set():
+            try:
+                self._pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, site, search_terms, start_page, max_page):
+        sweep = iter_sweep(site, search_terms, pools, start_page, max_page)
+        try:
+            for page in sweep:
+                if not self._put(page): # release the driver
+                    break
+        except Exception as e:
+            self._put(e)
+        finally:
+            sweep.close()
+            self._put(self.done)
+
+    def __iter__(self):
+        try:
+            while True:
+                page = self._pages.get()
+                if page is self.done:
+                    return
+                yield page
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+
+def stream_sweep(pages, site, search_terms, start_page):
+    """Yield the SweepPages of a sweep as NDJSON lines while it goes.
+    Every line carries the cursor to resume after it; a failure ends the stream with an error line"""
+    cursor = encode_cursor(site, search_terms, start_page)
+    for page in pages:
+        if isinstance(page, Exception):
+            yield json.dumps({'error': repr(page), 'cursor': cursor}, ensure_ascii=False) + '\n'
+            continue
+        cursor = encode_cursor(site, search_terms, page['next_page']) if page['next_page'] else None
+        yield json.dumps({'page': page['page'], 'outer': page['outer'], 'cursor': cursor},
+                         ensure_ascii=False) + '\n'
+
+def create_writer(format):
+    try:
+        return export.create_writer(format.value)
+    except export.UnsupportedFormat as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+def export_response(rows, writer, format, filename, background=None):
+    """Download rows of export.SCHEMA as a file written while the rows come"""
+    return StreamingResponse(export.export(rows, writer=writer), media_type=export.FORMATS[format.value],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}.{format.value}"'},
+                             background=background)
+
+@app.get(r'/api/v1/{site}/index')
+def search_index(site: Site, q: str, field: Optional[IndexField] = None, limit: int = 20):
+    """Search the records scraped so far, without the site. Every word of q must start a word of the name
+    or address, or only of field, ignoring case and diacritics"""
+    index = create_index()
+    if index is None:
+        raise HTTPException(status_code=404, detail='The index is disabled')
+    start = time.perf_counter()
+    records = index.search(site.value, q, field.value if field is not None else None, min(max(limit, 1), 200))
+    return {'records': records, 'took': time.perf_counter() - start}
+
+@app.get(r'/api/v1/{site}/sweep/stream')
+def stream_records(site: Site, term: Optional[SearchTerms] = None, value: Optional[str] = None,
+                   cursor: Optional[str] = None, max_page: Optional[int] = None):
+    """Sweep page by page as NDJSON {page, outer, cursor}. Pass the cursor of the last line received
+    to resume an interrupted sweep; cursor is null on the last page"""
+    if cursor:
+        cursor_site, search_terms, start_page = decode_cursor(cursor)
+        if cursor_site != site.value:
+            raise HTTPException(status_code=422, detail='Cursor belongs to another site')
+    elif term is not None and value is not None:
+        search_terms, start_page = {term.value:value}, 1
+    else:
+        raise HTTPException(status_code=422, detail='Either term and value, or cursor is required')
+    try:
+        pages = SweepPages(site.value, search_terms, start_page, max_page)
+    except ExecutorSaturated:
+        raise HTTPException(status_code=429, detail='Too many lookups in progress. Retry later.',
+                            headers={'Retry-After': '5'})
+    # the background task also runs when the client went away before the first line
+    return StreamingResponse(stream_sweep(pages, site.value, search_terms, start_page),
+                             media_type='application/x-ndjson', background=BackgroundTask(pages.close))
+
+@app.get(r'/api/v1/{site}/sweep/export')
+def export_records(site: Site, term: SearchTerms, value: str, format: ExportFormat = ExportFormat.csv,
+                   max_page: Optional[int] = None):
+    """Sweep and download the records as a file written page by page. A failure cuts the download short"""
+    search_terms = {term.value:value}
+    writer = create_writer(format)
+    try:
+        pages = SweepPages(site.value, search_terms, 1, max_page)
+    except ExecutorSaturated:
+        raise HTTPException(status_code=429, detail='Too many lookups in progress. Retry later.',
+                            headers={'Retry-After': '5'})
+    def checked():
+        for page in pages:
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    return export_response(export.page_rows(checked(), search_terms), writer, format, f'{site.value}-sweep',
+                           background=BackgroundTask(pages.close))
+
+def parse_subtables(site, command, subtables):
+    if site != Site.business or command == Command.sweep:
+        raise HTTPException(status_code=422, detail='subtables only applies to business pinpoint or harvest')
+    names = [name.strip() for name in subtables.split(',') if name.strip()]
+    invalid = [name for name in names if name not in SUBTABLES]
+    if invalid:
+        raise HTTPException(status_code=422, detail=f'Unknown sub-tables {invalid}. Valid: {list(SUBTABLES)}')
+    return sorted(names, key=SUBTABLES.index)
 
 @app.get(r'/api/v1/{site}/{command}')
-async def scrape_record(site: Site, command: Command, term: SearchTerms, value):
-    return search(site.value, command.value, term.value, value)
+async def scrape_record(site: Site, command: Command, term: SearchTerms, value, response: Response,
+                        subtables: Optional[str] = None, timings: bool = False):
+    """subtables: comma separated sub-tables to include in a business pinpoint or harvest, e.g. 'nganhkinhdoanh,chinhanh'.
+    All of them by default.
+    timings: return {'result': ..., 'timings': {phase: seconds}} instead of the bare result"""
+    start = time.perf_counter()
+    search_terms = {term.value:value}
+    options = {}
+    if subtables:
+        options['subtables'] = parse_subtables(site, command, subtables)
+    # the disk tier is read by the worker, so that SQLite doesn't block the event loop
+    result, state, age = cache.get(site.value, command.value, search_terms, options, disk=False)
+    breakdown = {}
+    try:
+        flight = FLIGHTS.join(make_key(site.value, command.value, search_terms, options)) if state == MISS else None
+        if flight is not None: # the same lookup is already running, wait for it without taking a worker
+            result = await asyncio.wrap_future(flight)
+            response.headers['X-Coalesced'] = '1'
+        elif state == MISS:
+            result, state, age, breakdown = await executor.run(traced_fetch, site.value, command.value,
+                                                               search_terms, options)
+        elif state == STALE:
+            cache.refresh(site.value, command.value, search_terms, lookup, executor.submit, options)
+    except ExecutorSaturated:
+        raise HTTPException(status_code=429, detail='Too many lookups in progress. Retry later.',
+                            headers={'Retry-After': '5'})
+    except PoolExhausted:
+        raise HTTPException(status_code=503, detail='No webdriver available. Retry later.',
+                            headers={'Retry-After': '5'})
+    except JobTimeout:
+        raise HTTPException(status_code=503, detail='No worker finished the lookup in time. Retry later.',
+                            headers={'Retry-After': '30'})
+    except UpstreamError as e:
+        raise HTTPException(status_code=503, detail=f'The site failed to answer: {e}. Retry later.',
+                            headers={'Retry-After': '30'})
+    response.headers['X-Cache'] = state
+    if age is not None:
+        response.headers['Age'] = str(int(age))
+    breakdown['total'] = time.perf_counter() - start
+    metrics.LOOKUP_SECONDS.labels(site.value, command.value, state).observe(breakdown['total'])
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(breakdown)
+        return {'result': result, 'timings': breakdown}
+    return result
+
+@app.get(r'/api/v1/status')
+def status():
+    """Report the load of worker threads and webdriver pools. Not async: the stats run SQLite queries"""
+    index = create_index()
+    solver = main.SOLVER # never loaded here, e.g. the API of the distributed mode has none
+    return {'executor': executor.stats(),
+            'pools': pools.stats() if pools is not None else {},
+            'cache': cache.stats(),
+            'solver': solver.stats() if solver is not None else {'captcha': CAPTCHA_STATS.stats()},
+            'ratelimit': ratelimit.stats(),
+            'flights': FLIGHTS.stats(),
+            'queue': remote.stats() if remote is not None else {},
+            'index': index.stats() if index is not None else {}}
+
+@app.get(r'/metrics')
+def prometheus_metrics():
+    """Metrics in Prometheus text format"""
+    body, content_type = metrics.latest()
+    return Response(body, media_type=content_type)
 
 @app.get(r'/')
 async def greet():
@@ -1,27 +1,207 @@
 # %%
+import base64
+import functools
+import inspect
 import logging
+import re
+import threading
+import time
 from abc import abstractmethod
-from unicodedata import normalize
-from bs4 import BeautifulSoup as bs
+from contextlib import closing, contextmanager
+from urllib.parse import urljoin
 from seleniumwire import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.remote.command import Command
+import metrics
+import pageparser
+import ratelimit
+from capture import ResponseRing
+from prefetch import CaptchaPrefetch
+from ratelimit import UpstreamError, CaptchaRejected
+from metrics import CAPTCHA_STATS
 
 logger = logging.getLogger(__name__)
 
-def normalize_nav_string(string):
-    return normalize('NFKC', string.text.strip())
+# Run the javascript of every profile link with form submission captured instead of sent,
+# then restore the forms. Return [action, urlencoded body] of each profile
+DETAIL_FORMS_JS = """
+var forms = Array.from(document.forms);
+var saved = forms.map(function (form) {return Array.from(form.elements).map(function (e) {return e.value;});});
+var submit = HTMLFormElement.prototype.submit;
+var captured = [];
+HTMLFormElement.prototype.submit = function () {
+    captured.push([this.action, new URLSearchParams(new FormData(this)).toString()]);
+};
+try {
+    document.querySelectorAll("a[href^='javascript:submitform']").forEach(function (link) {
+        eval(decodeURIComponent(link.getAttribute('href').slice('javascript:'.length)));
+    });
+} finally {
+    HTMLFormElement.prototype.submit = submit;
+    forms.forEach(function (form, i) {
+        Array.from(form.elements).forEach(function (e, j) {e.value = saved[i][j];});
+    });
+}
+return captured;
+"""
+
+# Fetch [url, body or null] requests from inside the page, sharing its cookies, at most arguments[1] at a time.
+# Return the base64 encoded bodies in the same order
+FETCH_ALL_JS = """
+var jobs = arguments[0], limit = arguments[1], done = arguments[arguments.length - 1];
+var results = new Array(jobs.length), next = 0;
+function encode(buffer) {
+    var bytes = new Uint8Array(buffer), chunks = [];
+    for (var i = 0; i < bytes.length; i += 0x8000) {
+        chunks.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000)));
+    }
+    return btoa(chunks.join(''));
+}
+function work() {
+    if (next >= jobs.length) {return Promise.resolve();}
+    var index = next++, job = jobs[index];
+    var init = {credentials: 'same-origin', method: job[1] === null ? 'GET' : 'POST'};
+    if (job[1] !== null) {
+        init.body = job[1];
+        init.headers = {'Content-Type': 'application/x-www-form-urlencoded'};
+    }
+    return fetch(job[0], init).then(function (response) {
+        if (!response.ok) {throw new Error(job[0] + ' returned ' + response.status);}
+        return response.arrayBuffer();
+    }).then(function (buffer) {results[index] = encode(buffer); return work();});
+}
+var workers = [];
+for (var i = 0; i < Math.min(limit, jobs.length); i++) {workers.push(work());}
+Promise.all(workers).then(function () {done(results);}, function (error) {done({error: String(error)});});
+"""
+
+# Tell whether the tab shows a new document, ready to be used, and stamp it as arguments[1].
+# arguments[0] is the stamp of the previous document, which may also come back from the history
+NEW_DOCUMENT_JS = """
+if (window.__scraperDoc === arguments[0] || document.readyState === 'loading') {return false;}
+window.__scraperDoc = arguments[1];
+return true;
+"""
+
+CAPTCHA_PATTERN = r'.+captcha.png.+'
+
+# Tabs other than the first load the site from their own host, tab<n>.<site host>, so that the browser keeps
+# their cookies, hence their sessions and captchas, apart. The proxy sends their requests to the real host.
+TAB_HOST = re.compile(r'(^|//)tab(\d+)\.')
+TAB_HEADER = 'X-Scraper-Tab'
+
+def tab_url(url, tab):
+    """Address of url inside a tab"""
+    return url if not tab else url.replace('//', f'//tab{tab}.', 1)
+
+def untab(value):
+    """Return (url or host header on the real site, tab)"""
+    match = TAB_HOST.search(value)
+    if not match:
+        return value, 0
+    return value[:match.start()] + match.group(1) + value[match.end():], int(match.group(2))
+
+class TabState():
+    """Window of a tab, its copy of the site url, the responses that its lookup waits for and its next captcha"""
+    def __init__(self, handle, site, scopes, ring_size):
+        self.handle = handle
+        self.site = site
+        self.responses = ResponseRing(scopes, ring_size)
+        self.page_mark = 0
+        self.document = 0
+        self.prefetch = CaptchaPrefetch()
+
+class TabView():
+    """One tab of a ProfileScraper, used like a scraper of its own from any thread.
+
+    Every method call runs in the tab. Lookups in different tabs of a browser run concurrently: they only
+    take turns to send WebDriver commands, and wait for the site and the solver at the same time.
+    """
+    def __init__(self, driver, tab):
+        self.driver = driver
+        self.tab = tab
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with self.driver.using_tab(self.tab):
+                result = attr(*args, **kwargs)
+            return self._bind(result) if inspect.isgenerator(result) else result
+        return call
+
+    def _bind(self, generator):
+        """Resume the generator in the tab, e.g. iter_sweep"""
+        with closing(generator):
+            while True:
+                with self.driver.using_tab(self.tab):
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                yield item
+
+    @property
+    def current_url(self):
+        with self.driver.using_tab(self.tab):
+            return self.driver.current_url
+
+    def quit(self):
+        """Close the tab. The browser quits with its last tab"""
+        self.driver.release_tab(self.tab)
 
 class ProfileScraper(webdriver.Firefox):
-    """Abstract class for scraper"""
-    scopes = None
+    """Abstract class for scraper.
+
+    Only responses matching `capture_scopes` go through the proxy's interception. They are kept in a small
+    ResponseRing instead of selenium-wire's request storage, and requests matching `blocked_resources` are
+    answered by the proxy without reaching the site.
+
+    With `tabs` > 1, `open_tab()` hands out up to that many TabViews running lookups concurrently in one browser.
+    Each tab has its own session on the site, its own ring, and every command of a thread goes to its tab.
+
+    Every page of results comes with the captcha of the next submission. With `prefetch_captcha`, a sweep solves
+    it in the background as soon as the browser received it, while the page is parsed and consumed.
+    """
+    capture_scopes = None
     site = None
+    page_pattern = None
     field_xpath = None
-    def __init__(self, *args, headless=True, solver=None, **kwargs):
+    fetch_timeout = 30
+    harvest_concurrency = 4
+    wait_timeout = 10
+    ring_size = 8
+    prefetch_captcha = False
+    # images, stylesheets and fonts of the pages, the captcha excepted
+    blocked_resources = (r'\.(css|gif|jpe?g|png|ico|svg|woff2?|ttf)(\?.*)?$',)
+    # the ring replaces selenium-wire's storage, which keeps every request otherwise
+    seleniumwire_options = {'request_storage': 'memory', 'request_storage_max_size': 0, 'disable_encoding': True}
+    def __init__(self, *args, headless=True, solver=None, base_url=None, tabs=1, **kwargs):
         options = Options()
         options.headless = headless
+        if tabs > 1: # navigation returns at once so that a tab waiting for the site doesn't hold the others
+            options.page_load_strategy = 'none'
+        kwargs.setdefault('seleniumwire_options', dict(self.seleniumwire_options))
         super().__init__(options=options, *args, **kwargs)
-        if not all((self.scopes, self.site, self.field_xpath)):
-            raise NotImplementedError("Attributes 'scopes', 'site', 'field_xpath' must all be implemented")
+        if not all((self.capture_scopes, self.site, self.page_pattern, self.field_xpath)):
+            raise NotImplementedError("Attributes 'capture_scopes', 'site', 'page_pattern', 'field_xpath' must all be implemented")
+        if base_url: # e.g. a local stand-in server
+            self.site = urljoin(base_url, self.site.split('/')[-1])
+        self.tabs = tabs
+        self._browser_lock = threading.RLock()
+        self._local = threading.local()
+        self._window = self.current_window_handle
+        self._open_tabs = set()
+        self._next_tab = 0
+        self._closed = False
+        self._tabs = {0: TabState(self._window, self.site, self.capture_scopes, self.ring_size)}
+        self.execute_script(NEW_DOCUMENT_JS, None, 0)
+        self.request_interceptor = self._intercept_request
+        self.response_interceptor = self._capture_response
+        self.block_resources(self.blocked_resources)
         if not solver:
             raise NotImplementedError("Must specify a solver first")
         else:
@@ -34,18 +214,235 @@ class ProfileScraper(webdriver.Firefox):
         """
         self.solver = solver
 
+    def block_resources(self, patterns):
+        """Answer requests matching patterns from the proxy, unless they are in the capture scopes"""
+        self.blocked_resources = tuple(patterns or ())
+        if self.tabs > 1: # every request of a tab must be sent to the real host
+            self.scopes = ['.*']
+        else:
+            self.scopes = list(self.capture_scopes) + list(self.blocked_resources)
+
+    @property
+    def _tab(self):
+        """State of the tab of the current thread, the first one by default"""
+        return self._tabs[getattr(self._local, 'tab', 0)]
+
+    @property
+    def _responses(self):
+        return self._tab.responses
+
+    @property
+    def _page_mark(self):
+        return self._tab.page_mark
+
+    @_page_mark.setter
+    def _page_mark(self, mark):
+        self._tab.page_mark = mark
+
+    @contextmanager
+    def using_tab(self, tab):
+        """Run the commands of the current thread in a tab"""
+        outer = getattr(self._local, 'tab', 0)
+        self._local.tab = tab
+        try:
+            yield
+        finally:
+            self._local.tab = outer
+
+    def execute(self, driver_command, params=None):
+        """Send every command to the window of the tab of the current thread. Tabs take turns command by command"""
+        if not hasattr(self, '_tabs'): # still starting
+            return super().execute(driver_command, params)
+        with self._browser_lock:
+            if driver_command == Command.SWITCH_TO_WINDOW:
+                self._window = params['handle']
+            elif driver_command != Command.QUIT and self._tab.handle != self._window:
+                super().execute(Command.SWITCH_TO_WINDOW, {'handle': self._tab.handle})
+                self._window = self._tab.handle
+            response = super().execute(driver_command, params)
+            if driver_command == Command.CLOSE:
+                self._window = None
+            return response
+
+    def open_tab(self):
+        """Hand out the next tab of the browser as a TabView, or None when every tab was handed out.
+        Tabs are not reused once closed, so that the browser quits, and frees its memory, with its last tab"""
+        with self._browser_lock:
+            if self._closed or self._next_tab >= self.tabs:
+                return None
+            tab, self._next_tab = self._next_tab, self._next_tab + 1
+            if tab not in self._tabs:
+                self.switch_to.new_window('tab')
+                self._tabs[tab] = TabState(self._window, tab_url(self.site, tab), self.capture_scopes, self.ring_size)
+                with self.using_tab(tab):
+                    self.execute_script(NEW_DOCUMENT_JS, None, 0)
+            self._open_tabs.add(tab)
+        return TabView(self, tab)
+
+    def release_tab(self, tab):
+        """Close a tab handed out by open_tab. The browser quits with the last open tab"""
+        with self._browser_lock:
+            self._open_tabs.discard(tab)
+            if self._open_tabs:
+                with self.using_tab(tab):
+                    self.close()
+                return
+            self._closed = True # closing the last window would end the session anyway
+        self.quit()
+
+    def clear_responses(self):
+        """Forget the responses captured so far, e.g. before handing the driver to another lookup"""
+        self._tab.prefetch.discard()
+        self._responses.clear()
+        self._page_mark = 0
+        del self.requests
+
+    def _intercept_request(self, request):
+        url, tab = untab(request.url)
+        if tab:
+            request.url = url
+            for header in ('Host', 'Origin', 'Referer'):
+                if header in request.headers:
+                    value = untab(request.headers[header])[0]
+                    del request.headers[header]
+                    request.headers[header] = value
+            request.headers[TAB_HEADER] = str(tab)
+        if not self._is_captured(url) and any(re.search(pattern, url) for pattern in self.blocked_resources):
+            request.abort(error_code=204)
+
+    def _is_captured(self, url):
+        return any(re.search(scope, url) for scope in self.capture_scopes)
+
+    def _capture_response(self, request, response):
+        tab = int(request.headers.get(TAB_HEADER) or 0)
+        if tab: # keep the browser on the host of the tab
+            if 'Location' in response.headers:
+                location = tab_url(response.headers['Location'], tab)
+                del response.headers['Location']
+                response.headers['Location'] = location
+            cookies = response.headers.get_all('Set-Cookie') or []
+            if cookies:
+                del response.headers['Set-Cookie']
+                for cookie in cookies:
+                    response.headers['Set-Cookie'] = re.sub(r';\s*domain=[^;]*', '', cookie, flags=re.IGNORECASE)
+        if tab in self._tabs:
+            self._tabs[tab].responses.add(request.url, response.body)
+
+    def _mark(self):
+        """Remember the responses received so far, before loading a new page"""
+        self._page_mark = self._responses.mark()
+        return self._page_mark
+
+    @metrics.timed('wait_response')
+    def _wait_response(self, pattern, after, latest=False):
+        """Body of the response to pattern received after mark"""
+        try:
+            return self._responses.wait(pattern, after, self.wait_timeout, latest)
+        except TimeoutException as e:
+            raise UpstreamError(e.msg) from e
+
+    def _wait_document(self):
+        """Wait until the tab shows a new document that can be used.
+        Navigation doesn't wait for the page to load when the browser has several tabs"""
+        tab = self._tab
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                if self.execute_script(NEW_DOCUMENT_JS, tab.document, tab.document + 1):
+                    tab.document += 1
+                    return
+            except WebDriverException: # the old document is being unloaded
+                pass
+            if time.monotonic() > deadline:
+                raise UpstreamError(f'Timed out after {self.wait_timeout}s waiting for a new page')
+            time.sleep(0.05)
+
+    def _navigate(self, action, *args):
+        """Run an action loading a new page in the tab. Return the body of the page once it can be used"""
+        mark = self._mark()
+        with ratelimit.LIMITER.request():
+            action(*args)
+            page = self._wait_response(self.page_pattern, mark)
+        self._wait_document()
+        return page
+
+    def _retry(self, step, *args, before_retry=None):
+        """Run one step of a lookup, retrying it alone when the site fails"""
+        return ratelimit.RETRY.call(step, *args, retry_on=(UpstreamError, TimeoutException), before_retry=before_retry)
+
+    @metrics.timed('open')
+    def _open(self):
+        self._tab.prefetch.discard() # the captcha solved belongs to the page being left
+        self._navigate(self.get, self._tab.site)
+
+    @metrics.timed('captcha_fetch')
     def _get_captcha_image(self):
-        """Capture the captcha returned by server, then decode and preprocess to a (1,64,128,1) Tensor"""
-        for request in self.requests[::-1]:
-            if 'captcha' in request.url:
-                return request.response.body
+        """Return the last captcha loaded by the current page"""
+        return self._wait_response(CAPTCHA_PATTERN, self._page_mark, latest=True)
+
+    def _refresh_captcha(self):
+        """Ask the site for a new captcha, which is cheaper than submitting a doubtful answer"""
+        ratelimit.LIMITER.pace()
+        self._mark()
+        self.execute_script("var img = document.querySelector(\"img[src*='captcha']\");"
+                            "img.src = img.src.split('&_=')[0] + '&_=' + Date.now();")
 
-    def _answer_captcha(self):
-        """Use model to predict characters in captcha"""
-        img = self._get_captcha_image()
-        answer = self.solver.predict(img)
-        return answer
+    def _answer_captcha(self, renew=False):
+        """Use model to predict characters in captcha.
+        If the solver is not confident enough, refresh the captcha instead of submitting a likely wrong answer.
+        Start with a new captcha if renew"""
+        if renew:
+            self._refresh_captcha()
+        if not hasattr(self.solver, 'solve'):
+            image = self._get_captcha_image()
+            with metrics.span('solve'):
+                return self.solver.predict(image)
+        refresh = 0
+        while True:
+            image = self._get_captcha_image()
+            with metrics.span('solve'):
+                answer = self.solver.solve(image)
+            if self.solver.is_confident(answer) or refresh >= self.solver.max_refresh:
+                return answer.label
+            logger.debug('Refresh captcha. Confidence=%.3f', answer.confidence)
+            CAPTCHA_STATS.record_refresh()
+            refresh += 1
+            self._refresh_captcha()
+
+    def _solve_loaded(self, responses, mark):
+        """Solve the captcha loaded with the page after mark, from any thread.
+        Return None if the solver is not confident, since only the tab's thread can refresh it"""
+        image = responses.wait(CAPTCHA_PATTERN, mark, self.wait_timeout, latest=True)
+        with metrics.span('solve'):
+            if not hasattr(self.solver, 'solve'):
+                return self.solver.predict(image)
+            answer = self.solver.solve(image)
+        if self.solver.is_confident(answer) or not self.solver.max_refresh:
+            return answer.label
+        logger.debug('Refresh captcha. Confidence=%.3f', answer.confidence)
+        CAPTCHA_STATS.record_refresh()
+        return None
+
+    def _prefetch_captcha(self):
+        """Start solving the captcha of the page just loaded while the lookup goes on"""
+        self._tab.prefetch.start(self._solve_loaded, self._responses, self._page_mark)
+
+    def _next_answer(self):
+        """Answer of the prefetched captcha, or of the current captcha"""
+        prefetch = self._tab.prefetch
+        if not prefetch.pending:
+            return self._answer_captcha()
+        answer = prefetch.take()
+        return answer if answer is not None else self._answer_captcha(renew=True)
 
+    @staticmethod
+    def _record_captcha(outer, attempt):
+        if outer == pageparser.WRONG_CAPTCHA:
+            CAPTCHA_STATS.record_rejected()
+        else:
+            CAPTCHA_STATS.record_accepted(attempt + 1)
+
+    @metrics.timed('submit')
     def _submit_captcha(self, answer, click=True):
         elem = self.find_element_by_xpath("//input[@id='captcha']")
         elem.send_keys(answer)
@@ -62,44 +459,46 @@ class ProfileScraper(webdriver.Firefox):
             elems[profile_index].click()
 
     def _goto_next_page(self, next_page):
-        """Go to next page"""
-        next_elem = self.find_element_by_xpath(f"//a[@href='javascript:gotoPage({next_page})']")
-        next_elem.click()
+        """Go to next page. Call the page script directly when there is no link, e.g. when resuming a sweep"""
+        next_elems = self.find_elements_by_xpath(f"//a[@href='javascript:gotoPage({next_page})']")
+        if next_elems:
+            next_elems[0].click()
+        else:
+            self.execute_script('gotoPage(arguments[0]);', next_page)
         
-    def _process_outer(self, soup):
-        """Process the outermost page right after submitted the answer and received the first response"""
-        text = soup.get_text()
-        # all of these checks are expensive. Consider improving
-        if "Bạn chưa nhập đủ các thông tin cần thiết." in text:
-            return -1
-        elif "Không tìm thấy người nộp thuế nào phù hợp." in text:
-            return -1
-        elif "Không tìm thấy kết quả." in text:
-            return -1
-        elif "Vui lòng nhập đúng mã xác nhận!" in text:
-            return 0
-        parse_result = []
-        table = soup.find('table', attrs={'class':'ta_border'})
-        rows = table.find_all('tr')
-        rows = rows[:-1]
-        headers = rows[0]
-        headers = [normalize_nav_string(h) for h in headers.find_all('th')]
-        contents = rows[1:]
-        for data in contents:
-            data = (normalize_nav_string(d) for d in data.find_all('td'))
-            parse_result.append({h:d for h,d in zip(headers,data)})
-        return parse_result
+    def _fetch_all(self, jobs):
+        """Fetch [url, body] pairs from the current page, up to harvest_concurrency at a time.
+        Body is None for GET. Return the raw bodies"""
+        if not jobs:
+            return []
+        self.set_script_timeout(self.fetch_timeout * len(jobs))
+        with ratelimit.LIMITER.request(weight=len(jobs)):
+            try:
+                results = self.execute_async_script(FETCH_ALL_JS, jobs, self.harvest_concurrency)
+            except TimeoutException as e:
+                raise UpstreamError(e.msg) from e
+            if isinstance(results, dict):
+                raise UpstreamError(results['error'])
+        return [base64.b64decode(result) for result in results]
+
+    def _fetch_profiles(self):
+        """Raw pages of every profile linked from the current page, fetched without leaving it"""
+        return [pageparser.to_document(page) for page in self._fetch_all(self.execute_script(DETAIL_FORMS_JS))]
+
+    @metrics.timed('details')
+    def _fetch_details(self, subtables=None):
+        return [{'inner': self._parse_inner(doc)} for doc in self._fetch_profiles()]
+
+    @metrics.timed('parse')
+    def _process_outer(self, page):
+        """Process the outermost page right after submitted the answer and received the first response.
+        Accept raw page body or BeautifulSoup"""
+        return pageparser.process_outer(page)
 
-    def _parse_inner(self, soup):
+    @metrics.timed('parse')
+    def _parse_inner(self, page):
         """Parse the inner table returned by clicking on a profile"""
-        parse_result = []
-        table = soup.find('table', attrs={'class':'ta_border'})
-        headers = table.find_all('th')
-        for header in headers:
-            data = normalize_nav_string(header.find_next_sibling('td'))
-            header = normalize_nav_string(header)
-            parse_result.append({header:data})
-        return parse_result
+        return pageparser.parse_inner(page)
 
     def _send_search_terms(self, search_terms):
         """Send the search terms to approriate field. Accept dict-like object"""
@@ -110,26 +509,116 @@ class ProfileScraper(webdriver.Firefox):
             elem.clear() # field persists data during session, no matter where you are
             elem.send_keys(value)
 
+    def _start(self, search_terms):
+        """Open the search form and fill in the search terms"""
+        self._open()
+        self._send_search_terms(search_terms) # the site never clears its data in field so don't need to resend every loop
+
+    def _search_outer(self, search_terms, page=1, ahead=False):
+        """Solve captcha and submit until the site accepts the answer, from the search form or from the previous
+        page of results. Return the parsed outer table, -1 if it is empty.
+        If ahead, another captcha will likely be needed and the one loaded with the page is solved meanwhile"""
+        attempt = 0
+        while True:
+            if attempt > self.max_attempts:
+                ratelimit.LIMITER.record(failed=True)
+                raise CaptchaRejected(f'Captcha rejected {attempt} times in a row')
+            answer = self._next_answer()
+            if page == 1:
+                doc = self._navigate(self._submit_captcha, answer)
+            else:
+                self._submit_captcha(answer, False)
+                doc = self._navigate(self._goto_next_page, page)
+            if ahead:
+                self._prefetch_captcha()
+            outer = self._process_outer(doc)
+            self._record_captcha(outer, attempt)
+            if outer != 0: # captcha accepted
+                return outer
+            attempt += 1
+            if page > 1: # going back may load another captcha
+                self._tab.prefetch.discard()
+                self.back()
+                self._wait_document()
+
+    def _search_page(self, search_terms, page=1, ahead=False):
+        """Search a page of results. Retry it from a reopened search form when the site fails"""
+        return self._retry(self._search_outer, search_terms, page, ahead, before_retry=lambda: self._start(search_terms))
+
+    def _open_detail(self, search_terms):
+        """Go to the first profile found. Search again before retrying, since the page is unknown after a failure"""
+        def search_again():
+            self._start(search_terms)
+            self._search_outer(search_terms)
+        return self._parse_inner(self._retry(self._navigate, self._goto_detail, before_retry=search_again))
+
     @abstractmethod
     def pinpoint(self, search_terms):
         """Method to scrape a single profile in detail"""
 
-    @abstractmethod
-    def sweep(self, search_terms):
+    def iter_sweep(self, search_terms, start_page=1, max_page=None):
+        """Scrape multiple records in outer page, yielding each page as soon as it is parsed:
+        {'page': n, 'outer': rows, 'next_page': n+1 or None when it was the last page}.
+        A full last page is followed by an empty one, the only way to tell it was the last.
+        Start from start_page to resume an interrupted sweep"""
+        max_page = max_page or self.max_page
+        logger.info("Sweep all profiles produced under search terms ... Search terms=%s", str(search_terms))
+        self._retry(self._start, search_terms)
+        next_page = start_page
+        try:
+            while True:
+                # past the first page, the sweep likely goes on: solve the next captcha as soon as it is loaded
+                ahead = self.prefetch_captcha and start_page < next_page < max_page
+                outer = self._search_page(search_terms, next_page, ahead)
+                if outer == -1: # empty table
+                    logger.info('Finished sweeping. Record is empty.')
+                    if next_page > 1: # the previous page was full, tell the caller there is none after it
+                        yield {'page': next_page, 'outer': [], 'next_page': None}
+                    return
+                last = len(outer) < 15 or next_page >= max_page # page contains max 15 profiles
+                if not last and self.prefetch_captcha and not self._tab.prefetch.pending:
+                    self._prefetch_captcha() # at least while the page is consumed
+                yield {'page': next_page, 'outer': outer, 'next_page': None if last else next_page + 1}
+                if last:
+                    return
+                next_page += 1
+        finally: # e.g. the last page was short, or the sweep was interrupted
+            self._tab.prefetch.discard()
+
+    def sweep(self, search_terms, max_page=None):
         """Method to scrape multiple records in outer page"""
+        parse_result = []
+        for page in self.iter_sweep(search_terms, max_page=max_page):
+            parse_result += page['outer']
+        logger.info('Finished sweeping. %d records found', len(parse_result))
+        return {'outer':parse_result}
         
-    def run(self, command, search_terms):
-        """Main entry point for program"""
+    def harvest(self, search_terms, subtables=None, max_page=None):
+        """Sweep once, then fetch the detail of every record found within the same browser session.
+        Details of each page are fetched from inside the page, up to harvest_concurrency at a time"""
+        parse_result = []
+        for page in self.iter_sweep(search_terms, max_page=max_page):
+            if not page['outer']: # the page after a full last one, nothing to fetch from it
+                continue
+            for outer, detail in zip(page['outer'], self._retry(self._fetch_details, subtables)):
+                parse_result.append({'outer': outer, **detail})
+        logger.info('Finished harvesting. %d records found', len(parse_result))
+        return parse_result
+
+    def run(self, command, search_terms, **options):
+        """Main entry point for program. Options are passed to the command, e.g. subtables for pinpoint"""
         commands = {'pinpoint': self.pinpoint,
-                    'sweep': self.sweep}
-        assert command in commands, "Invalid command. Supported command: 'pinpoint' for single profile in detail; 'sweep' for multiple profiles in outer page"
+                    'sweep': self.sweep,
+                    'harvest': self.harvest}
+        assert command in commands, "Invalid command. Supported command: 'pinpoint' for single profile in detail; 'sweep' for multiple profiles in outer page; 'harvest' for every profile of a sweep in detail"
         return {'command':command,
-                'result':commands[command](search_terms)}
+                'result':commands[command](search_terms, **options)}
         
 class PersonalProfileScraper(ProfileScraper):
     """Scraper for personal site http://tracuunnt.gdt.gov.vn/tcnnt/mstcn.jsp"""
-    scopes = ['.+captcha.png.+', '.+mstcn.jsp$']
+    capture_scopes = ['.+captcha.png.+', '.+mstcn.jsp$']
     site = r'http://tracuunnt.gdt.gov.vn/tcnnt/mstcn.jsp'
+    page_pattern = r'.+/mstcn.jsp$'
     field_xpath = {'taxnum': "//input[@name='mst1']",
                    'name': "//input[@name='fullname1']",
                    'address': "//input[@name='address']",
@@ -139,178 +628,82 @@ class PersonalProfileScraper(ProfileScraper):
     max_attempts = 5
     def pinpoint(self, search_terms):
         logger.info("Pinpoint a single profile ... Search terms=%s", str(search_terms))
-        self.get(self.site)
+        self._retry(self._start, search_terms)
         parse_result = {}
-        attempt = 0
-        
-        self._send_search_terms(search_terms) # the site never clears its data in field so don't need to resend every loop
-        while True:
-            assert attempt <= self.max_attempts, """Maximum loop reached. Either captcha solver has problem or there are some edge cases that the program failed to catch. Please record the search terms and submit an issue on Github"""
-            answer = self._answer_captcha()
-            del self.requests # avoid catching previous request
-            self._submit_captcha(answer)
-            req = self.wait_for_request(r'.+/mstcn.jsp$')
-            soup = bs(req.response.body,'lxml')
-            outer = self._process_outer(soup)
-            if outer == 0: # captcha failed
-                attempt += 1
-                continue
-            elif outer == -1: # empty table
-                logger.info('Finished scraping. Record is empty.')
-                return None
-            break
+        outer = self._search_page(search_terms)
+        if outer == -1: # empty table
+            logger.info('Finished scraping. Record is empty.')
+            return None
         
         parse_result['outer'] = outer
-        del self.requests
-        self._goto_detail()
-        req = self.wait_for_request(r'.+/mstcn.jsp$')
-        soup = bs(req.response.body,'lxml')
-        parse_result['inner'] = self._parse_inner(soup)
+        parse_result['inner'] = self._open_detail(search_terms)
         
-        del self.requests # final clean before exit
         logger.info('Finished scraping. Record is present.')
         return parse_result
     
-    def sweep(self, search_terms):
-        logger.info("Sweep all profiles produced under search terms ... Search terms=%s", str(search_terms))
-        self.get(self.site)
-        parse_result = []
-        attempt = 0
-        next_page = 1
-        
-        self._send_search_terms(search_terms) # the site never clears its data in field so don't need to resend every loop
-        while True:
-            assert attempt <= self.max_attempts, """Maximum loop reached. Either captcha solver has problem or there are some edge cases that the program failed to catch. Please record the search terms and submit an issue on Github"""
-            answer = self._answer_captcha()
-            del self.requests # avoid catching previous request.
-            if next_page == 1:
-                self._submit_captcha(answer)
-            else:
-                self._submit_captcha(answer, False)
-                self._goto_next_page(next_page)
-            req = self.wait_for_request(r'.+/mstcn.jsp$')
-            soup = bs(req.response.body,'lxml')
-            outer = self._process_outer(soup)
-            if outer == 0: # captcha failed
-                attempt += 1
-                if next_page > 1:
-                    self.back()
-                continue
-            elif outer == -1: # empty table
-                logger.info('Finished sweeping. Record is empty.')
-                break
-            parse_result += outer
-            next_page += 1
-            if len(outer) < 15 or next_page > self.max_page: # page contains max 15 profiles
-                break
-            attempt = 0
-        logger.info('Finished sweeping. %d records found', len(parse_result))
-        return {'outer':parse_result}
-
 class BusinessProfileScraper(ProfileScraper):
     """Scraper for business site http://tracuunnt.gdt.gov.vn/tcnnt/mstdn.jsp"""
-    scopes = ['.+captcha.png.+', '.+mstdn.jsp$', '.+doanhnghiepchuquan.jsp$', '.+chinhanh.jsp$',
+    capture_scopes = ['.+captcha.png.+', '.+mstdn.jsp$', '.+doanhnghiepchuquan.jsp$', '.+chinhanh.jsp$',
               '.+tructhuoc.jsp$', '.+daidien.jsp$', '.+loaithue.jsp$', '.+nganhkinhdoanh.jsp$']
     site = r'http://tracuunnt.gdt.gov.vn/tcnnt/mstdn.jsp'
+    page_pattern = r'.+/mstdn.jsp$'
     field_xpath = {'taxnum': "//input[@name='mst']",
                    'name': "//input[@name='fullname']",
                    'address': "//input[@name='address']",
                    'idnum':"//input[@name='cmt']"}
     
-    def _parse_subtable(self, soup):
-        parse_result = []
-        soup = soup.find_all('tr')
-        headers = soup[0]
-        headers = [normalize_nav_string(h) for h in headers.find_all('th')]
-        contents = soup[1:]
-        for data in contents:
-            data = (normalize_nav_string(d) for d in data.find_all('td'))
-            parse_result.append({h:d for h,d in zip(headers,data)})
-        return parse_result
-    
+    subtables = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+    parallel_subtables = True
+
+    @metrics.timed('parse')
+    def _parse_subtable(self, page):
+        return pageparser.parse_subtable(page)
+
+    @metrics.timed('details')
+    def _fetch_details(self, subtables=None):
+        """Fetch every profile linked from the current page, then the selected sub-tables of all of them at once"""
+        docs = self._fetch_profiles()
+        selected = [name for name in self.subtables if not subtables or name in subtables]
+        urls = [pageparser.subtable_urls(doc, self.current_url) for doc in docs]
+        pages = iter(self._fetch_all([[doc_urls[name], None] for doc_urls in urls for name in selected]))
+        return [{'inner': self._parse_inner(doc), 'sub': {name:self._parse_subtable(next(pages)) for name in selected}}
+                for doc in docs]
+
+    @metrics.timed('subtables')
+    def _scrape_subtables(self, subtables=None):
+        """Scrape the sub-tables inside a profile, all of them by default.
+        With parallel_subtables, every button is clicked before waiting so the browser fetches them concurrently"""
+        sub = {}
+        mark = self._responses.mark()
+        elems = self.find_elements_by_xpath("//input[@value='...']")
+        assert len(elems) == 6, 'There must be 6 sub-tables'
+        selected = [(ele, name) for ele, name in zip(elems, self.subtables) if not subtables or name in subtables]
+        with ratelimit.LIMITER.request(weight=len(selected)):
+            if self.parallel_subtables:
+                for ele, _ in selected:
+                    ele.click()
+            for ele, name in selected:
+                logger.debug('Scraping sub-table=%s...', name)
+                if not self.parallel_subtables:
+                    ele.click()
+                sub[name] = self._wait_response(rf'.+/{name}.jsp$', mark)
+        return {name:self._parse_subtable(page) for name, page in sub.items()}
+
     max_page = 9
     max_attempts = 5
-    def pinpoint(self, search_terms):
+    def pinpoint(self, search_terms, subtables=None):
         logger.info("Pinpoint a single profile ... Search terms=%s", str(search_terms))
-        self.get(self.site)
+        self._retry(self._start, search_terms)
         parse_result = {}
-        attempt = 0
-        
-        self._send_search_terms(search_terms) # the site never clears its data in field so don't need to resend every loop
-        while True:
-            assert attempt <= self.max_attempts, """Maximum loop reached. Either captcha solver has problem or there are some edge cases that the program failed to catch. Please record the search terms and submit an issue on Github"""
-            answer = self._answer_captcha()
-            del self.requests # avoid catching previous request
-            self._submit_captcha(answer)
-            req = self.wait_for_request(r'.+/mstdn.jsp$')
-            soup = bs(req.response.body,'lxml')
-            outer = self._process_outer(soup)
-            if outer == 0: # captcha failed
-                attempt += 1
-                continue
-            elif outer == -1: # empty table
-                logger.info('Finished scraping. Record is empty.')
-                return None
-            break
+        outer = self._search_page(search_terms)
+        if outer == -1: # empty table
+            logger.info('Finished scraping. Record is empty.')
+            return None
         
         parse_result['outer'] = outer
-        del self.requests
-        self._goto_detail()
-        req = self.wait_for_request(r'.+/mstdn.jsp$')
-        soup = bs(req.response.body,'lxml')
-        parse_result['inner'] = self._parse_inner(soup)
+        parse_result['inner'] = self._open_detail(search_terms)
         
-        # working on subtables inside each profile
-        sub = {}
-        elems = self.find_elements_by_xpath("//input[@value='...']")
-        elems_pattern = [r'.+/doanhnghiepchuquan.jsp$', r'.+/chinhanh.jsp$', r'.+/tructhuoc.jsp$', 
-                         r'.+/daidien.jsp$', r'.+/loaithue.jsp$', r'.+/nganhkinhdoanh.jsp$']
-        assert len(elems) == 6, 'There must be 6 sub-tables'
-        for ele, pattern in zip(elems, elems_pattern):
-            logger.debug('Scraping sub-table=%s...', pattern[3:-5])
-            ele.click()
-            req = self.wait_for_request(pattern)
-            header = req.url.split('/')[-1][:-4]
-            soup = bs(req.response.body, 'lxml')
-            sub[header] = self._parse_subtable(soup)
-        parse_result['sub'] = sub
+        parse_result['sub'] = self._retry(self._scrape_subtables, subtables)
         
-        del self.requests # final clean before exit
         logger.info('Finished scraping. Record is present.')
         return parse_result
-    
-    def sweep(self, search_terms):
-        logger.info("Sweep all profiles produced under search terms ... Search terms=%s", str(search_terms))
-        self.get(self.site)
-        parse_result = []
-        attempt = 0
-        next_page = 1
-        
-        self._send_search_terms(search_terms) # the site never clears its data in field so don't need to resend every loop
-        while True:
-            assert attempt <= self.max_attempts, """Maximum loop reached. Either captcha solver has problem or there are some edge cases that the program failed to catch. Please record the search terms and submit an issue on Github"""
-            answer = self._answer_captcha()
-            del self.requests # avoid catching previous request
-            if next_page == 1:
-                self._submit_captcha(answer)
-            else:
-                self._submit_captcha(answer, False)
-                self._goto_next_page(next_page)
-            req = self.wait_for_request(r'.+/mstdn.jsp$')
-            soup = bs(req.response.body,'lxml')
-            outer = self._process_outer(soup)
-            if outer == 0: # captcha failed
-                attempt += 1
-                if next_page > 1:
-                    self.back()
-                continue
-            elif outer == -1: # empty table
-                logger.info('Finished sweeping. Record is empty.')
-                break
-            parse_result += outer
-            next_page += 1
-            if len(outer) < 15 or next_page > self.max_page: # page contains max 15 profiles
-                break
-            attempt = 0
-        logger.info('Finished sweeping. %d records found', len(parse_result))
-        return {'outer':parse_result}
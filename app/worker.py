@@ -0,0 +1,132 @@
+"""Worker process of the distributed mode: claim lookups from the job queue, scrape them and publish the results.
+
+Usage: python worker.py [--concurrency N] [--name NAME]
+
+Run from the app folder like the API, with the same config. With the sqlite broker, run it on the host of the API:
+the queue file can't be shared over a network filesystem. With the redis broker, run it on any host reaching the
+Redis server.
+SIGTERM or Ctrl+C stops claiming lookups and lets the running ones finish.
+"""
+import argparse
+import logging
+import signal
+import threading
+import utility
+import ratelimit
+from jobqueue import create_queue, worker_name
+from main import search_by, create_pools, create_solver
+from pool import PoolExhausted
+from ratelimit import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+class Worker():
+    """Run `concurrency` lookups of the queue at once through lookup(site, command, search_terms, **options),
+    renewing their leases until they are published. Lookups failing with UpstreamError or PoolExhausted are
+    queued again while they have attempts left, other failures are final"""
+    def __init__(self, jobs, lookup, concurrency=2, name=None, poll=0.5):
+        self.jobs = jobs
+        self.lookup = lookup
+        self.concurrency = concurrency
+        self.name = name or worker_name()
+        self.poll = poll
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stop_heartbeat = threading.Event() # set once the running lookups are over, see run()
+        self.succeeded = 0
+        self.failed = 0
+
+    def _heartbeat(self):
+        while not self._stop_heartbeat.wait(self.jobs.lease / 3):
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                for job_id in self.jobs.renew(held, self.name):
+                    logger.warning('Lost the lease of lookup %d, another worker may run it', job_id)
+            except Exception: # e.g. the file is locked for too long, try again on next beat
+                logger.warning('Failed to renew leases', exc_info=True)
+
+    def _run_job(self, job):
+        with self._lock:
+            self._held.add(job['id'])
+        try:
+            result = self.lookup(job['site'], job['command'], job['search_terms'], **job['options'])
+        except Exception as e:
+            retry = isinstance(e, (UpstreamError, PoolExhausted))
+            logger.warning('Lookup %d failed on attempt %d: %r', job['id'], job['attempt'], e)
+            with self._lock:
+                self.failed += 1
+            self.jobs.nack(job['id'], self.name, e, retry=retry)
+        else:
+            with self._lock:
+                self.succeeded += 1
+            if not self.jobs.ack(job['id'], self.name, result):
+                logger.warning('Lookup %d finished after its lease expired', job['id'])
+        finally:
+            with self._lock:
+                self._held.discard(job['id'])
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self.jobs.claim(self.name)
+            except Exception:
+                logger.warning('Failed to claim a lookup', exc_info=True)
+                job = None
+            if job is None:
+                self._stop.wait(self.poll)
+                continue
+            self._run_job(job)
+
+    def run(self):
+        """Work until stop() is called, then wait for the running lookups, renewing their leases meanwhile"""
+        logger.info('Worker %s running %d lookups at once from %s', self.name, self.concurrency, self.jobs)
+        heartbeat = threading.Thread(target=self._heartbeat, name='heartbeat', daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self._work, name=f'worker-{i}') for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive(): # join with a timeout so that signals are handled
+                    thread.join(0.5)
+        finally:
+            self._stop_heartbeat.set()
+            heartbeat.join()
+        logger.info('Worker %s stopped: %d succeeded, %d failed', self.name, self.succeeded, self.failed)
+
+    def stop(self):
+        self._stop.set()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, help="lookups run at once. Defaults to queue.worker.concurrency")
+    parser.add_argument('--name', help='name of the worker in the queue. Defaults to host:pid')
+    args = parser.parse_args()
+
+    config = utility.load_config()
+    jobs = create_queue({**(config.get('queue') or {}), 'enabled': True})
+    worker_config = (config.get('queue') or {}).get('worker') or {}
+    ratelimit.configure(config.get('ratelimit'))
+    create_solver(config)
+    pools = create_pools(config)
+    if pools is not None:
+        pools.warm_up()
+    def lookup(site, command, search_terms, **options):
+        return search_by(site, command, search_terms, pools, **options)
+    worker = Worker(jobs, lookup, concurrency=args.concurrency or worker_config.get('concurrency', 2),
+                    name=args.name, poll=worker_config.get('poll', 0.5))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: worker.stop())
+    try:
+        worker.run()
+    finally:
+        if pools is not None:
+            pools.close()
+        jobs.close()
+
+if __name__ == '__main__':
+    main()
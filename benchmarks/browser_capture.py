@@ -0,0 +1,64 @@
+"""Per-lookup wall time and proxy memory of the browser engine, with and without capture filtering.
+
+Usage: python browser_capture.py [--mode both|filtered|unfiltered] [--lookups 20] [--latency MS] [--site business]
+
+filtered is the default setup of the scrapers: only the capture scopes go through the proxy's interception,
+into a small ring, and images/stylesheets are blocked. unfiltered captures every request into selenium-wire's
+default storage and loads everything, like the scrapers used to.
+Needs Firefox and geckodriver. The selenium-wire proxy runs inside this process, so its memory is the growth
+of the resident set size of this process. Each mode runs in its own process.
+"""
+import argparse
+import subprocess
+import sys
+import time
+from common import summarize
+from load_test import rss_mb, search_values
+from replay_server import serve, OracleSolver
+from webdriver import BusinessProfileScraper, PersonalProfileScraper
+
+DRIVERS = {'business': BusinessProfileScraper,
+           'personal': PersonalProfileScraper}
+
+def make_driver(site, mode, base_url):
+    if mode == 'unfiltered':
+        driver = DRIVERS[site](solver=OracleSolver(), base_url=base_url, seleniumwire_options={})
+        driver.block_resources(())
+        driver.scopes = [] # capture everything
+    else:
+        driver = DRIVERS[site](solver=OracleSolver(), base_url=base_url)
+    return driver
+
+def run(args):
+    _, base_url = serve(latency=args.latency / 1000)
+    values = search_values(args.lookups + 1, seed=1)
+    driver = make_driver(args.site, args.mode, base_url)
+    try:
+        driver.pinpoint({'name': values[0]}) # first page load fills Firefox caches
+        rss_start = rss_mb()
+        timings = []
+        for value in values[1:]:
+            start = time.perf_counter()
+            driver.pinpoint({'name': value})
+            timings.append(time.perf_counter() - start)
+        summarize(f'{args.mode} pinpoint', timings)
+        print(f'{args.mode:<28} rss growth={rss_mb() - rss_start:.1f}MB rss={rss_mb():.1f}MB '
+              f'stored requests={len(driver.requests)}')
+    finally:
+        driver.quit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('both', 'filtered', 'unfiltered'), default='both')
+    parser.add_argument('--lookups', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added by the server to every response')
+    parser.add_argument('--site', choices=('business', 'personal'), default='business')
+    args = parser.parse_args()
+    if args.mode != 'both':
+        return run(args)
+    for mode in ('unfiltered', 'filtered'):
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--lookups', str(args.lookups),
+                        '--latency', str(args.latency), '--site', args.site], check=True)
+
+if __name__ == '__main__':
+    main()
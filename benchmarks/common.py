@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmark scripts"""
+import random
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+APP_DIR = Path(__file__).resolve().parent.parent / 'app'
+sys.path.insert(0, str(APP_DIR))
+
+import cv2
+from solver import VALID_CHAR, VALID_SIZE
+
+def random_label(rng=random):
+    return ''.join(rng.choice(VALID_CHAR) for _ in range(VALID_SIZE))
+
+def make_captcha(label, seed=None):
+    """Draw a captcha resembling the site's one: dark text and a light grid on the alpha channel of a PNG"""
+    rng = np.random.default_rng(seed)
+    alpha = np.zeros((50, 130), np.uint8)
+    alpha[::8, :] = 60 # grid lines, removed by solver.remove_grid
+    alpha[:, ::8] = 60
+    x = 8
+    for char in label:
+        y = int(rng.integers(32, 42))
+        cv2.putText(alpha, char, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 255, 2)
+        x += int(rng.integers(20, 26))
+    image = np.zeros((50, 130, 4), np.uint8)
+    image[:, :, 3] = alpha
+    return cv2.imencode('.png', image)[1].tobytes()
+
+def load_captchas(folder=None, count=200, seed=0):
+    """Load PNG files from a folder, or generate `count` synthetic captchas. Return list of (label, bytes)"""
+    if folder:
+        return [(path.stem, path.read_bytes()) for path in sorted(Path(folder).glob('*.png'))]
+    rng = random.Random(seed)
+    return [(label, make_captcha(label, seed=i)) for i, label in enumerate(random_label(rng) for _ in range(count))]
+
+def timeit(fn, *args, repeat=1):
+    """Return the list of wall time in seconds of each call"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def summarize(name, timings, unit=1e3, suffix='ms'):
+    timings = np.asarray(timings) * unit
+    print(f'{name:<28} n={len(timings):<6} mean={timings.mean():8.3f}{suffix} '
+          f'p50={np.percentile(timings, 50):8.3f}{suffix} p95={np.percentile(timings, 95):8.3f}{suffix}')
@@ -0,0 +1,258 @@
+"""End-to-end load test of the scrapers against the replay server: throughput, latency percentiles and memory.
+
+Usage: python load_test.py [--mode search|api] [--engine http|browser] [--site business] [--command pinpoint]
+                           [--concurrency 4] [--requests 100] [--latency MS] [--errors 0.0] [--accuracy 1.0]
+                           [--rate 4] [--max-rate 16] [--workers N] [--no-index] [--prefetch] [--json FILE]
+
+search mode calls main.search_by from worker threads, api mode sends HTTP requests to webapi served by uvicorn.
+Both run in this process, with a config made from app/template.yaml in a temporary folder.
+With --workers, the API sends lookups through the job queue to that many workers, run as threads of this
+process with their own connection to the queue file.
+Captchas are answered by OracleSolver unless --solver-url points to a real model.
+Phases are the seconds summed over the run in each phase of the lookups. Background phases such as
+captcha_prefetch overlap the others, captcha_wait is the part of them that lookups waited for.
+Memory is the resident set size of this process, so it doesn't include Firefox processes of the browser engine.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import requests as rq
+import yaml
+from common import APP_DIR
+from pages import WORDS
+from replay_server import serve, OracleSolver
+import main as app_main
+import metrics
+import ratelimit
+from solver import CAPTCHA_STATS
+
+def rss_mb():
+    """Current resident set size"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def search_values(count, repeat=0.0, seed=0):
+    """Search values, a `repeat` fraction of them already seen before"""
+    rng = random.Random(seed)
+    values = []
+    for i in range(count):
+        if values and rng.random() < repeat:
+            values.append(rng.choice(values))
+        else:
+            values.append(f'{" ".join(rng.sample(WORDS, 2))} {i}')
+    return values
+
+def write_config(folder, args, base_url):
+    """Write the config folder of the app, from the template and the options of the run"""
+    config = yaml.safe_load((APP_DIR / 'template.yaml').read_bytes())
+    config['scraper'].update({'engine': args.engine, 'base_url': base_url})
+    config['pool'] = {'min_size': 1, 'max_size': args.concurrency, 'lease_timeout': 300}
+    config['executor'] = {'max_workers': args.concurrency, 'max_queue': args.requests}
+    config['cache'] = {'path': None}
+    config['ratelimit'].update({k:v for k, v in (('rate', args.rate), ('max_rate', args.max_rate)) if v is not None})
+    config['bulk'] = {'folder': str(Path(folder) / 'jobs')}
+    # options added after the first callers, e.g. startup.py, default to a run without them
+    config['index']['enabled'] = not getattr(args, 'no_index', False)
+    config['scraper']['prefetch_captcha'] = getattr(args, 'prefetch', False)
+    if getattr(args, 'workers', 0):
+        config['queue'].update({'enabled': True, 'path': str(Path(folder) / 'queue' / 'jobs.sqlite3')})
+        config['queue']['worker']['concurrency'] = max(1, args.concurrency // args.workers)
+    if args.solver_url:
+        config['solver'] = {**(config.get('solver') or {}), 'backend': 'rest', 'url': args.solver_url}
+    for logger in config['logging']['loggers'].values():
+        logger['level'] = 'WARNING'
+    (Path(folder) / 'config').mkdir(parents=True, exist_ok=True)
+    for section, values in config.items():
+        with open(Path(folder) / 'config' / f'{section}.yaml', 'w') as f:
+            yaml.dump(values, f, allow_unicode=True)
+    return config
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_api():
+    """Serve webapi with uvicorn in a background thread. Return its url"""
+    import uvicorn
+    import webapi
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(webapi.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f'http://127.0.0.1:{port}'
+
+def search_lookup(args, config):
+    """Lookup through main.search_by. Return (lookup, close)"""
+    pools = app_main.create_pools(config)
+    if pools is not None:
+        pools.warm_up()
+    def lookup(value):
+        return app_main.search_by(args.site, args.command, {args.term: value}, pools)
+    def close():
+        if pools is not None:
+            pools.close()
+    return lookup, close
+
+def start_workers(args, config):
+    """Run the workers of the job queue in background threads. Return a function stopping them"""
+    from jobqueue import create_queue
+    from worker import Worker
+    pools = app_main.create_pools(config)
+    def lookup(site, command, search_terms, **options):
+        # not search_by: its coalescing would join the lookup of the API waiting for this very worker
+        return app_main.run_terms(site, command, search_terms, config, pools, **options)
+    workers = [Worker(create_queue(config['queue']), lookup, name=f'worker-{i}', **config['queue']['worker'])
+               for i in range(args.workers)]
+    for worker in workers:
+        threading.Thread(target=worker.run, daemon=True).start()
+    def stop():
+        for worker in workers:
+            worker.stop()
+        if pools is not None:
+            pools.close()
+    return stop
+
+def api_lookup(args, config):
+    """Lookup through the web API. Return (lookup, close)"""
+    stop_workers = start_workers(args, config) if args.workers else None
+    server, url = start_api()
+    local = threading.local()
+    def lookup(value):
+        if not hasattr(local, 'session'):
+            local.session = rq.Session()
+        response = local.session.get(f'{url}/api/v1/{args.site}/{args.command}',
+                                     params={'term': args.term, 'value': value}, timeout=600)
+        response.raise_for_status()
+        return response.json()
+    def close():
+        server.should_exit = True
+        if stop_workers is not None:
+            stop_workers()
+    return lookup, close
+
+def drive(lookup, values, concurrency):
+    """Call lookup(value) for every value from `concurrency` threads. Return latencies and errors"""
+    def timed(value):
+        start = time.perf_counter()
+        try:
+            lookup(value)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        return time.perf_counter() - start, error
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(timed, values))
+
+def phase_seconds():
+    """Seconds spent so far in each phase, from the scraper_phase_seconds histogram"""
+    return {sample.labels['phase']: sample.value for metric in metrics.PHASE_SECONDS.collect()
+            for sample in metric.samples if sample.name.endswith('_sum')}
+
+def report(args, results, elapsed, rss_start, phases_start=None):
+    latencies = np.asarray([latency for latency, error in results if error is None])
+    errors = [error for _, error in results if error is not None]
+    phases_start = phases_start or {}
+    summary = {'mode': args.mode, 'engine': args.engine, 'site': args.site, 'command': args.command,
+               'concurrency': args.concurrency, 'prefetch': args.prefetch, 'requests': len(results), 'errors': len(errors),
+               'elapsed': elapsed, 'throughput': len(latencies) / elapsed,
+               'latency': {f'p{p}': float(np.percentile(latencies, p)) if len(latencies) else None
+                           for p in (50, 90, 95, 99)},
+               'latency_max': float(latencies.max()) if len(latencies) else None,
+               'rss_start_mb': rss_start, 'rss_end_mb': rss_mb(), 'rss_peak_mb': peak_rss_mb(),
+               'captcha': CAPTCHA_STATS.stats(), 'ratelimit': ratelimit.stats(), 'flights': app_main.FLIGHTS.stats(),
+               'phases': {phase: seconds - phases_start.get(phase, 0) for phase, seconds in phase_seconds().items()}}
+    print(f"{args.mode}/{args.engine} {args.site} {args.command} concurrency={args.concurrency}")
+    print(f"requests={len(results)} errors={len(errors)} elapsed={elapsed:.2f}s "
+          f"throughput={summary['throughput']:.2f} lookups/s")
+    if len(latencies):
+        print('latency ' + ' '.join(f'{name}={value*1000:.1f}ms' for name, value in summary['latency'].items())
+              + f" max={summary['latency_max']*1000:.1f}ms")
+    print(f"rss start={rss_start:.1f}MB end={summary['rss_end_mb']:.1f}MB peak={summary['rss_peak_mb']:.1f}MB")
+    print(f"captcha accuracy={summary['captcha']['accuracy']} "
+          f"solves per success={summary['captcha']['solves_per_success']} "
+          f"prefetched={summary['captcha']['prefetched']} discarded={summary['captcha']['discarded']}")
+    print('phases ' + ' '.join(f'{phase}={seconds:.2f}s' for phase, seconds in sorted(summary['phases'].items())))
+    print(f"site rate={summary['ratelimit']['rate']:.2f}/s failures={summary['ratelimit']['failures']} "
+          f"retries={summary['ratelimit']['retries']} waited={summary['ratelimit']['waited']:.1f}s")
+    print(f"scrapes={summary['flights']['leaders']} coalesced={summary['flights']['coalesced']}")
+    if app_main.INDEX is not None:
+        summary['index'] = app_main.INDEX.stats()
+        print('index ' + ' '.join(f'{name}={value}' for name, value in summary['index'].items()))
+    if args.workers:
+        import webapi
+        summary['queue'] = webapi.remote.stats()
+        print('queue ' + ' '.join(f'{name}={value}' for name, value in summary['queue'].items()
+                                  if name != 'oldest_queued'))
+    for error in sorted(set(errors))[:5]:
+        print('error:', error)
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, indent=2))
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('search', 'api'), default='search')
+    parser.add_argument('--engine', choices=('http', 'browser'), default='http')
+    parser.add_argument('--site', choices=('business', 'personal'), default='business')
+    parser.add_argument('--command', choices=('pinpoint', 'sweep', 'harvest'), default='pinpoint')
+    parser.add_argument('--term', choices=('taxnum', 'name', 'address', 'idnum'), default='name')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=0, help='lookups run before measuring')
+    parser.add_argument('--repeat', type=float, default=0.0, help='fraction of repeated values, i.e. cache hits')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added by the server to every response')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of pages the server answers 503')
+    parser.add_argument('--rate', type=float, help='starting requests per second of the rate limiter')
+    parser.add_argument('--max-rate', type=float, help='maximum requests per second of the rate limiter')
+    parser.add_argument('--no-index', action='store_true', help='scrape every lookup, without the local index')
+    parser.add_argument('--prefetch', action='store_true', help='solve the next captcha of sweeps in the background')
+    parser.add_argument('--workers', type=int, default=0, help='api mode: workers of the job queue')
+    parser.add_argument('--base-url', help='use a replay server already running instead of starting one')
+    parser.add_argument('--captchas', help='folder of real captchas named <label>.png')
+    parser.add_argument('--accuracy', type=float, default=1.0, help='accuracy of the oracle solver')
+    parser.add_argument('--solver-delay', type=float, default=0, help='milliseconds per captcha of the oracle solver')
+    parser.add_argument('--solver-url', help='REST url of a real solver instead of the oracle solver')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the summary to this file')
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if not base_url:
+        _, base_url = serve(captchas=args.captchas, latency=args.latency / 1000, errors=args.errors, seed=args.seed)
+    if not args.solver_url:
+        app_main.SOLVER = OracleSolver(args.accuracy, args.solver_delay / 1000, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir) # the app reads ./config
+    config = write_config(workdir, args, base_url)
+    values = search_values(args.warmup + args.requests, args.repeat, args.seed)
+    lookup, close = api_lookup(args, config) if args.mode == 'api' else search_lookup(args, config)
+    try:
+        if args.warmup:
+            drive(lookup, values[:args.warmup], args.concurrency)
+        rss_start = rss_mb()
+        phases_start = phase_seconds()
+        start = time.perf_counter()
+        results = drive(lookup, values[args.warmup:], args.concurrency)
+        report(args, results, time.perf_counter() - start, rss_start, phases_start)
+    finally:
+        close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""HTML pages resembling the ones served by tracuunnt, used as fixtures by the benchmarks and the replay server"""
+import random
+
+OUTER_HEADERS = ('STT', 'MST', 'Tên người nộp thuế', 'Cơ quan thuế', 'Số CMT/Thẻ căn cước',
+                 'Ngày thay đổi thông tin gần nhất', 'Ghi chú')
+INNER_HEADERS = ('Mã số thuế', 'Tên người nộp thuế', 'Địa chỉ trụ sở', 'Cơ quan thuế quản lý',
+                 'Ngày cấp MST', 'Ngày đóng MST', 'Loại hình kinh tế', 'Tình trạng')
+SUBTABLES = ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue', 'nganhkinhdoanh')
+SUBTABLE_HEADERS = ('STT', 'Mã', 'Tên', 'Ghi chú')
+WORDS = ('Công ty', 'TNHH', 'Cổ phần', 'Thương mại', 'Dịch vụ', 'Hòa Bình', 'Sài Gòn', 'Hà Nội', 'Xây dựng', 'Đầu tư')
+STREETS = ('Lê Lợi', 'Trần Hưng Đạo', 'Nguyễn Huệ', 'Hai Bà Trưng', 'Điện Biên Phủ')
+
+def random_profile(rng=random, taxnum=None):
+    taxnum = taxnum or ''.join(rng.choice('0123456789') for _ in range(10))
+    name = ' '.join(rng.sample(WORDS, 4))
+    address = f'{rng.randint(1, 300)} {rng.choice(STREETS)}, Quận {rng.randint(1, 12)}'
+    return {'Mã số thuế': taxnum, 'Tên người nộp thuế': name, 'Địa chỉ trụ sở': address,
+            'Cơ quan thuế quản lý': 'Cục Thuế TP Hồ Chí Minh', 'Ngày cấp MST': '01/01/2010',
+            'Ngày đóng MST': '', 'Loại hình kinh tế': 'Công ty TNHH', 'Tình trạng': 'NNT đang hoạt động'}
+
+def outer_row(index, profile):
+    return (index, profile['Mã số thuế'], profile['Tên người nộp thuế'], profile['Cơ quan thuế quản lý'],
+            '', '01/01/2020', '')
+
+def _cells(tag, values):
+    return ''.join(f'<{tag}>{value}</{tag}>' for value in values)
+
+def form(site, message='', body='', page=1, captcha_uid='0'):
+    """The search form page. `body` is inserted after the form like the site does with results"""
+    return f'''<html><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+<link rel="stylesheet" href="/tcnnt/css/style.css"><script src="/tcnnt/js/common.js"></script>
+<script>function gotoPage(page) {{document.myform.page.value = page; document.myform.submit();}}</script>
+<script>function submitform(tin) {{document.myform.tin.value = tin; document.myform.submit();}}</script></head>
+<body><form name="myform" action="{site}" method="post">
+<input type="text" name="mst" value=""><input type="text" name="fullname" value="">
+<input type="text" name="mst1" value=""><input type="text" name="fullname1" value="">
+<input type="text" name="address" value=""><input type="text" name="cmt" value=""><input type="text" name="cmt2" value="">
+<input type="hidden" name="page" value="{page}"><input type="hidden" name="tin" value="">
+<input type="text" name="captcha" id="captcha" value=""><img src="/tcnnt/captcha.png?uid={captcha_uid}">
+<input type="button" class="subBtn" value="Tra cứu" onclick="document.myform.submit()">
+</form><p class="message">{message}</p>{body}<img src="/tcnnt/images/logo.gif"></body></html>'''
+
+def outer_table(rows, page=1, pages=1):
+    header = f'<tr>{_cells("th", OUTER_HEADERS)}</tr>'
+    link = '<a href="javascript:submitform(&#39;{0}&#39;)">{0}</a>'
+    content = ''.join(f'<tr>{_cells("td", [row[0], link.format(row[1]), *row[2:]])}</tr>' for row in rows)
+    navigation = ''.join(f'<a href="javascript:gotoPage({p})">{p}</a> ' for p in range(1, pages+1) if p != page)
+    return f'<table class="ta_border">{header}{content}<tr><td colspan="7">{navigation}</td></tr></table>'
+
+def inner_table(profile):
+    rows = ''.join(f'<tr><th>{header}</th><td>{profile.get(header, "")}</td></tr>' for header in INNER_HEADERS)
+    buttons = ''.join(f'<input type="button" value="..." onclick="window.open(&#39;{name}.jsp?tin={profile["Mã số thuế"]}&#39;)">'
+                      for name in SUBTABLES)
+    return f'<table class="ta_border">{rows}</table>{buttons}'
+
+def subtable(rows):
+    header = f'<tr>{_cells("th", SUBTABLE_HEADERS)}</tr>'
+    content = ''.join(f'<tr>{_cells("td", row)}</tr>' for row in rows)
+    return f'<html><head><meta charset="utf-8"></head><body><table>{header}{content}</table></body></html>'
+
+def sample_pages(seed=0):
+    """One page of each kind, as bytes"""
+    rng = random.Random(seed)
+    profiles = [random_profile(rng) for _ in range(15)]
+    site = '/tcnnt/mstdn.jsp'
+    return {'outer': form(site, body=outer_table([outer_row(i+1, p) for i, p in enumerate(profiles)], 1, 9)).encode(),
+            'inner': form(site, body=inner_table(profiles[0])).encode(),
+            'subtable': subtable([(i, f'{i:04}', ' '.join(rng.sample(WORDS, 3)), '') for i in range(10)]).encode(),
+            'empty': form(site, 'Không tìm thấy người nộp thuế nào phù hợp.').encode(),
+            'wrong_captcha': form(site, 'Vui lòng nhập đúng mã xác nhận!').encode()}
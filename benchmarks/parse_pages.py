@@ -0,0 +1,52 @@
+"""Per-page parse time and memory of the BeautifulSoup path against the raw bytes/lxml path of pageparser.
+
+Usage: python parse_pages.py [--fixtures DIR] [--repeat N]
+DIR contains saved pages named <kind>*.html where kind is outer, inner, subtable, empty or wrong_captcha.
+Memory is the peak of the Python heap seen by tracemalloc, which doesn't include libxml2 allocations.
+"""
+import argparse
+import time
+import tracemalloc
+from pathlib import Path
+from bs4 import BeautifulSoup as bs
+from common import summarize
+from pages import sample_pages
+import pageparser
+
+PARSERS = {'outer': pageparser.process_outer,
+           'empty': pageparser.process_outer,
+           'wrong_captcha': pageparser.process_outer,
+           'inner': pageparser.parse_inner,
+           'subtable': pageparser.parse_subtable}
+
+def load_fixtures(folder):
+    if not folder:
+        return sample_pages()
+    return {kind:path.read_bytes() for kind in PARSERS for path in sorted(Path(folder).glob(f'{kind}*.html'))[:1]}
+
+def measure(fn, body, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(body)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return timings, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    for kind, body in load_fixtures(args.fixtures).items():
+        parse = PARSERS[kind]
+        assert parse(body) == parse(bs(body, 'lxml')), f'{kind}: both paths must return the same result'
+        for name, fn in (('soup', lambda b: parse(bs(b, 'lxml'))), ('lxml', parse)):
+            timings, peak = measure(fn, body, args.repeat)
+            summarize(f'{kind} {name} (peak {peak//1024}KB)', timings)
+
+if __name__ == '__main__':
+    main()
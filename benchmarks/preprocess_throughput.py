@@ -0,0 +1,48 @@
+"""Per-core throughput of captcha preprocessing and label decoding: legacy per-image path vs batch path.
+
+Usage: python preprocess_throughput.py [--images DIR] [--count N] [--batch N]
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+from common import load_captchas
+from preprocess import Preprocessor
+from solver import preprocess_image, image_to_list, decode_image, preprocess_raw_image, resize_then_pad, \
+    array_to_label, decode_labels, VALID_CHAR, VALID_SIZE
+
+def legacy(raw):
+    img = decode_image(raw)
+    img = preprocess_raw_image(img)
+    img = resize_then_pad(img, 64, 128)
+    return image_to_list(img)
+
+def throughput(name, fn, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(items)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {len(items)*repeat/elapsed:12.0f} items/s/core')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='folder of captcha PNG')
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    cv2.setNumThreads(1) # measure one core
+
+    raws = [img for _, img in load_captchas(args.images, args.count)]
+    batches = [raws[i:i+args.batch] for i in range(0, len(raws), args.batch)]
+    preprocessor = Preprocessor()
+    throughput('legacy preprocess + tolist', lambda items: [legacy(raw) for raw in items], raws, args.repeat)
+    throughput('legacy preprocess_image', lambda items: [preprocess_image(raw) for raw in items], raws, args.repeat)
+    throughput(f'Preprocessor batch={args.batch}', lambda items: [preprocessor(b) for b in batches], raws, args.repeat)
+
+    predictions = np.random.default_rng(0).random((len(raws), VALID_SIZE, len(VALID_CHAR)), dtype=np.float32)
+    throughput('legacy array_to_label', lambda items: [''.join(array_to_label(p)) for p in items], predictions, args.repeat)
+    throughput('decode_labels', decode_labels, predictions, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Local stand-in for tracuunnt.gdt.gov.vn, to load-test the scrapers without touching the real site.
+
+Usage: python replay_server.py [--port 8765] [--latency MS] [--captchas DIR] [--fixtures DIR]
+Then set scraper.base_url to http://localhost:8765/tcnnt/
+
+It serves the search forms of mstdn.jsp and mstcn.jsp, captchas, result pages with pagination,
+profiles, sub-tables and the static assets of the pages. Every session (JSESSIONID cookie) must answer
+the last captcha it downloaded, like on the site. The label of each captcha is written in a tEXt chunk
+of the PNG so that OracleSolver can answer without a model.
+
+Results are generated from the search value, so the same search always gives the same records.
+Values containing 'empty' never match anything. Saved pages named outer*.html, inner*.html and
+subtable*.html in the fixtures folder are served instead of generated ones. With --errors, that fraction
+of the pages and captchas is answered 503, like the site does when it throttles.
+"""
+import argparse
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+from common import load_captchas
+from pages import form, outer_table, outer_row, inner_table, subtable, random_profile, SUBTABLES, WORDS
+from solver import SolverManager, Answer, CAPTCHA_STATS
+
+PAGE_SIZE = 15
+EMPTY_MESSAGES = ('Không tìm thấy người nộp thuế nào phù hợp.', 'Không tìm thấy kết quả.')
+WRONG_CAPTCHA = 'Vui lòng nhập đúng mã xác nhận!'
+SEARCH_FIELDS = {'mstdn': ('mst', 'fullname', 'address', 'cmt'),
+                 'mstcn': ('mst1', 'fullname1', 'address', 'cmt2')}
+ASSETS = {'/tcnnt/css/style.css': ('text/css', b'body {font-family: Arial;}\n' * 200),
+          '/tcnnt/js/common.js': ('application/javascript', b'function noop() {}\n' * 500),
+          '/tcnnt/images/logo.gif': ('image/gif', b'GIF89a' + bytes(4096))}
+
+def add_label(png, label):
+    """Insert a tEXt chunk holding the label right after the IHDR chunk"""
+    data = b'label\x00' + label.encode('ascii')
+    chunk = struct.pack('>I', len(data)) + b'tEXt' + data + struct.pack('>I', zlib.crc32(b'tEXt' + data))
+    return png[:33] + chunk + png[33:] # 8 bytes signature + 25 bytes IHDR
+
+def read_label(png):
+    start = png.find(b'tEXtlabel\x00', 0, 256)
+    if start < 4:
+        return ''
+    length = struct.unpack('>I', png[start-4:start])[0]
+    return png[start+10:start+4+length].decode('ascii')
+
+def seeded(*keys):
+    return random.Random(zlib.crc32('|'.join(map(str, keys)).encode('utf-8')))
+
+class OracleSolver(SolverManager):
+    """Solver answering with the label written by the replay server.
+
+    Args:
+        accuracy (float, optional): fraction of right answers, the others have their last character changed.
+        delay (float, optional): seconds spent per captcha, to mimic a model.
+    """
+    def __init__(self, accuracy=1.0, delay=0.0, seed=0, confidence_threshold=0.0, max_refresh=3):
+        self.backend = None
+        self.accuracy = accuracy
+        self.delay = delay
+        self.confidence_threshold = confidence_threshold
+        self.max_refresh = max_refresh
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def solve_many(self, raw_inputs):
+        if self.delay:
+            time.sleep(self.delay * len(raw_inputs))
+        answers = []
+        for raw in raw_inputs:
+            label = read_label(raw)
+            with self._lock:
+                right = self._rng.random() < self.accuracy
+            if not right:
+                label = label[:-1] + ('x' if label[-1:] != 'x' else 'y')
+            CAPTCHA_STATS.record_solve()
+            answers.append(Answer(label, [1.0] * len(label), 1.0))
+        return answers
+
+    def stats(self):
+        return {'captcha': CAPTCHA_STATS.stats()}
+
+class ReplaySite():
+    """State of the stand-in site: captchas to serve, the captcha expected from each session and the fixtures"""
+    def __init__(self, captchas=None, fixtures=None, latency=0.0, max_results=40, errors=0.0, seed=0):
+        self.captchas = [(label, add_label(png, label)) for label, png in load_captchas(captchas, seed=seed)]
+        self.fixtures = {}
+        for kind in ('outer', 'inner', 'subtable'):
+            paths = sorted(Path(fixtures).glob(f'{kind}*.html')) if fixtures else []
+            if paths:
+                self.fixtures[kind] = paths[0].read_bytes()
+        self.latency = latency
+        self.max_results = max_results
+        self.errors = errors
+        self._rng = random.Random(seed)
+        self._expected = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def new_captcha(self, session):
+        with self._lock:
+            label, png = self._rng.choice(self.captchas)
+            self._expected[session] = label
+            self.requests += 1
+        return png
+
+    def fails(self):
+        """Whether to answer the current request with an error"""
+        if not self.errors:
+            return False
+        with self._lock:
+            return self._rng.random() < self.errors
+
+    def check_captcha(self, session, answer):
+        with self._lock:
+            return answer and self._expected.pop(session, None) == answer
+
+    def taxnums(self, value):
+        """Tax numbers found by a search"""
+        if not value or 'empty' in value.lower():
+            return []
+        rng = seeded('search', value.casefold())
+        count = 0 if rng.random() < 0.1 else rng.randint(1, self.max_results)
+        return [''.join(rng.choice('0123456789') for _ in range(10)) for _ in range(count)]
+
+    def search_page(self, site, value, page):
+        taxnums = self.taxnums(value)
+        if not taxnums:
+            return form(site, seeded('message', value).choice(EMPTY_MESSAGES))
+        if 'outer' in self.fixtures:
+            return self.fixtures['outer']
+        pages = (len(taxnums) - 1) // PAGE_SIZE + 1
+        if page > pages:
+            return form(site, EMPTY_MESSAGES[1])
+        rows = [outer_row(index + 1, random_profile(seeded('profile', taxnum), taxnum))
+                for index, taxnum in enumerate(taxnums) if (page - 1) * PAGE_SIZE <= index < page * PAGE_SIZE]
+        return form(site, body=outer_table(rows, page, pages), page=page)
+
+    def detail_page(self, site, taxnum):
+        if 'inner' in self.fixtures:
+            return self.fixtures['inner']
+        return form(site, body=inner_table(random_profile(seeded('profile', taxnum), taxnum)))
+
+    def subtable_page(self, name, taxnum):
+        if 'subtable' in self.fixtures:
+            return self.fixtures['subtable']
+        rng = seeded(name, taxnum)
+        rows = [(i + 1, f'{i:04}', ' '.join(rng.sample(WORDS, 3)), '') for i in range(rng.choice((0, 0, 1, 3, 10)))]
+        return subtable(rows)
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the site
+    site = None # ReplaySite, set by serve()
+
+    def log_message(self, *args):
+        pass
+
+    def _session(self):
+        """Return (session id, whether it is new). Must be called once per request"""
+        match = re.search(r'JSESSIONID=(\w+)', self.headers.get('Cookie', ''))
+        return (match.group(1), False) if match else (uuid.uuid4().hex, True)
+
+    def _send(self, body, content_type='text/html; charset=UTF-8', status=200):
+        if self.site.latency:
+            time.sleep(self.site.latency)
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.new_session:
+            self.send_header('Set-Cookie', f'JSESSIONID={self.session}; Path=/tcnnt')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.session, self.new_session = self._session()
+        url = urlsplit(self.path)
+        name = url.path.rsplit('/', 1)[-1][:-4]
+        if url.path in ASSETS:
+            content_type, body = ASSETS[url.path]
+            return self._send(body, content_type)
+        if self.site.fails():
+            return self._send('Service Unavailable', 'text/plain', 503)
+        if url.path.endswith('captcha.png'):
+            return self._send(self.site.new_captcha(self.session), 'image/png')
+        if name in SEARCH_FIELDS:
+            return self._send(form(url.path))
+        if name in SUBTABLES:
+            return self._send(self.site.subtable_page(name, parse_qs(url.query).get('tin', [''])[0]))
+        self._send('Not found', 'text/plain', 404)
+
+    def do_POST(self):
+        self.session, self.new_session = self._session()
+        url = urlsplit(self.path)
+        name = url.path.rsplit('/', 1)[-1][:-4]
+        if name not in SEARCH_FIELDS:
+            return self._send('Not found', 'text/plain', 404)
+        length = int(self.headers.get('Content-Length', 0))
+        values = {key:value[0] for key, value in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        if self.site.fails():
+            return self._send('Service Unavailable', 'text/plain', 503)
+        if values.get('tin'): # opening a profile doesn't need a captcha
+            return self._send(self.site.detail_page(url.path, values['tin']))
+        if not self.site.check_captcha(self.session, values.get('captcha')):
+            return self._send(form(url.path, WRONG_CAPTCHA))
+        value = ' '.join(values[field] for field in SEARCH_FIELDS[name] if values.get(field))
+        page = int(values.get('page') or 1)
+        self._send(self.site.search_page(url.path, value, page))
+
+def serve(port=0, **options):
+    """Start the server in a background thread. Return (server, base_url)"""
+    handler = type('Handler', (ReplayHandler,), {'site': ReplaySite(**options)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/tcnnt/'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    parser.add_argument('--captchas', help='folder of real captchas named <label>.png. Synthetic ones by default')
+    parser.add_argument('--fixtures', help='folder of saved pages served instead of generated ones')
+    parser.add_argument('--max-results', type=int, default=40, help='maximum records found by a search')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of pages and captchas answered 503')
+    args = parser.parse_args()
+    server, base_url = serve(args.port, captchas=args.captchas, fixtures=args.fixtures,
+                             latency=args.latency / 1000, max_results=args.max_results, errors=args.errors)
+    print(f'Serving on {base_url}mstdn.jsp and {base_url}mstcn.jsp. Set scraper.base_url to {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
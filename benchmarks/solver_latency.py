@@ -0,0 +1,44 @@
+"""Compare per-captcha latency of the solver backends.
+
+Usage: python solver_latency.py [--rest URL] [--tflite PATH] [--onnx PATH] [--images DIR] [--count N]
+"""
+import argparse
+import time
+from common import load_captchas, summarize, timeit
+from solver import SolverManager, RestBackend, TFLiteBackend, OnnxBackend, preprocess_image
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rest', help='TF Serving predict url, e.g. http://localhost:8501/v1/models/solver:predict')
+    parser.add_argument('--tflite', help='path to the converted .tflite model')
+    parser.add_argument('--onnx', help='path to the converted .onnx model')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--images', help='folder of captcha PNG named after their label')
+    parser.add_argument('--count', type=int, default=200)
+    args = parser.parse_args()
+
+    captchas = load_captchas(args.images, args.count)
+    summarize('preprocess', [t for _, img in captchas for t in timeit(preprocess_image, img)])
+    backends = {}
+    if args.rest:
+        backends['rest'] = RestBackend(args.rest)
+    if args.tflite:
+        backends['tflite'] = TFLiteBackend(args.tflite, args.threads)
+    if args.onnx:
+        backends['onnx'] = OnnxBackend(args.onnx, args.threads)
+    for name, backend in backends.items():
+        solver = SolverManager(backend=backend)
+        solver.predict(captchas[0][1]) # warm up
+        timings = []
+        correct = 0
+        for label, img in captchas:
+            start = time.perf_counter()
+            answer = solver.predict(img)
+            timings.append(time.perf_counter() - start)
+            correct += answer == label
+        summarize(f'{name} predict', timings)
+        if args.images:
+            print(f'{name} accuracy: {correct/len(captchas):.2%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Microbenchmark of the encode/decode paths of the solver clients, and optionally of a full round-trip.
+
+Usage: python solver_transport.py [--batch N] [--rest URL] [--grpc TARGET]
+"""
+import argparse
+import json
+import numpy as np
+from common import load_captchas, summarize, timeit
+from solver import (RestBackend, GrpcBackend, encode_json, decode_json, encode_tensor_proto,
+                    decode_tensor_proto, preprocess_image, VALID_CHAR, VALID_SIZE)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--rest', help='TF Serving REST predict url')
+    parser.add_argument('--grpc', help='TF Serving gRPC target, e.g. localhost:8500')
+    args = parser.parse_args()
+
+    batch = np.concatenate([preprocess_image(img) for _, img in load_captchas(count=args.batch)])
+    predictions = np.random.default_rng(0).random((args.batch, VALID_SIZE, len(VALID_CHAR)), dtype=np.float32)
+
+    # legacy path: nested list built with tolist() and posted through requests' json=
+    summarize('json legacy encode', timeit(lambda: json.dumps({'instances':batch.tolist()}), repeat=args.repeat))
+    for encoding in ('row', 'columnar'):
+        body = encode_json(batch, encoding)
+        summarize(f'json {encoding} encode ({len(body)//1024}KB)', timeit(encode_json, batch, encoding, repeat=args.repeat))
+    body = json.dumps({'predictions':predictions.tolist()}).encode()
+    summarize('json decode', timeit(decode_json, body, repeat=args.repeat))
+    try:
+        from tensorflow.core.framework import tensor_pb2, types_pb2
+    except ImportError:
+        print('tensorflow protos not installed, skip TensorProto')
+    else:
+        proto = encode_tensor_proto(batch, tensor_pb2.TensorProto, types_pb2.DT_FLOAT)
+        size = proto.ByteSize() // 1024
+        summarize(f'tensorproto encode ({size}KB)', timeit(encode_tensor_proto, batch, tensor_pb2.TensorProto,
+                                                           types_pb2.DT_FLOAT, repeat=args.repeat))
+        out = encode_tensor_proto(predictions, tensor_pb2.TensorProto, types_pb2.DT_FLOAT)
+        summarize('tensorproto decode', timeit(decode_tensor_proto, out, repeat=args.repeat))
+
+    backends = {}
+    if args.rest:
+        backends['rest'] = RestBackend(args.rest)
+    if args.grpc:
+        backends['grpc'] = GrpcBackend(args.grpc)
+    for name, backend in backends.items():
+        backend.predict_batch(batch) # open the connection
+        summarize(f'{name} round-trip', timeit(backend.predict_batch, batch, repeat=args.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Boot time of the API and config overhead per lookup.
+
+Usage: python startup.py [--runs 5] [--calls 200]
+
+import: wall time of `import webapi` in a fresh interpreter, and whether it loaded selenium or cv2.
+first answer: wall time from starting `uvicorn webapi:app` to its first answer of `/`, with the http engine
+against a local replay server.
+config per lookup: reading the config folder and configuring logging on each lookup, as lookups used to,
+against the config shared by the process.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+from common import APP_DIR, summarize
+from load_test import free_port, write_config
+from replay_server import serve
+
+IMPORT_PROBE = ('import sys, time; start = time.perf_counter(); import webapi; '
+                'print(time.perf_counter() - start, "selenium" in sys.modules, "cv2" in sys.modules)')
+
+def time_import(runs):
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=APP_DIR, check=True,
+                             capture_output=True, text=True).stdout.split()
+        timings.append(float(out[0]))
+    summarize('import webapi', timings)
+    print(f'{"":<28} selenium loaded={out[1]} cv2 loaded={out[2]}')
+
+def time_first_answer(runs, workdir):
+    env = {**os.environ, 'PYTHONPATH': str(APP_DIR)}
+    timings = []
+    for _ in range(runs):
+        port = free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'webapi:app', '--port', str(port),
+                                    '--log-level', 'warning'], cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+                    break
+                except OSError:
+                    if process.poll() is not None:
+                        raise RuntimeError('uvicorn exited before answering')
+                    time.sleep(0.01)
+            timings.append(time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+    summarize('first answer of /', timings)
+
+def time_config(calls, workdir):
+    os.chdir(workdir) # the app reads ./config
+    import utility
+    def per_lookup():
+        config = utility.import_config()
+        utility.init_logger(config['logging'])
+    for name, fn in (('config per lookup', per_lookup), ('shared config', utility.load_config)):
+        timings = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        summarize(name, timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='processes started for each boot measure')
+    parser.add_argument('--calls', type=int, default=200, help='config loads for the overhead measure')
+    args = parser.parse_args()
+
+    _, base_url = serve()
+    workdir = tempfile.mkdtemp(prefix='startup_')
+    # a REST solver needs no model to load, the captchas are not sent anyway
+    write_config(workdir, SimpleNamespace(engine='http', concurrency=2, requests=16, rate=None, max_rate=None,
+                                          solver_url='http://127.0.0.1:9/'), base_url)
+    time_import(args.runs)
+    time_first_answer(args.runs, workdir)
+    time_config(args.calls, workdir)
+
+if __name__ == '__main__':
+    main()
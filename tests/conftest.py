@@ -0,0 +1,66 @@
+"""Fixtures shared by the tests. They run the app against benchmarks/replay_server.py, so that no site,
+browser or solver model is needed"""
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+sys.path.insert(0, str(ROOT / 'app'))
+
+from replay_server import serve, OracleSolver
+
+@pytest.fixture(scope='session')
+def replay():
+    """The stand-in site, as (server, base_url). server.RequestHandlerClass.site holds its state"""
+    server, base_url = serve()
+    yield server, base_url
+    server.shutdown()
+
+@pytest.fixture(scope='session')
+def site_values(replay):
+    """Return a search value whose search finds `count` records on the replay server"""
+    site = replay[0].RequestHandlerClass.site
+    def find(count):
+        return next(value for value in (f'tìm {i}' for i in range(10000)) if len(site.taxnums(value)) == count)
+    return find
+
+@pytest.fixture(scope='session')
+def client(replay, tmp_path_factory):
+    """TestClient of webapi with the http engine, configured like load_test does, in a temporary folder.
+    The config is loaded once per process, so every test of the session shares it"""
+    from fastapi.testclient import TestClient
+    from load_test import write_config
+    import main
+    workdir = tmp_path_factory.mktemp('app')
+    write_config(workdir, SimpleNamespace(engine='http', concurrency=2, requests=8, rate=100, max_rate=100,
+                                          solver_url=None, no_index=False, workers=0, prefetch=False),
+                 replay[1])
+    main.SOLVER = OracleSolver()
+    cwd = os.getcwd()
+    os.chdir(workdir) # the app reads ./config
+    try:
+        import webapi
+        with TestClient(webapi.app) as client:
+            yield client
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture
+def redis_client():
+    """Redis server at TEST_REDIS_URL, else fakeredis if it is installed with Lua support"""
+    url = os.environ.get('TEST_REDIS_URL')
+    if url:
+        redis = pytest.importorskip('redis')
+        return redis.Redis.from_url(url, decode_responses=True)
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa') # runs the scripts of the queue
+    return fakeredis.FakeRedis(decode_responses=True)
+
+@pytest.fixture
+def unthrottled(monkeypatch):
+    """Let scrapers used outside of the app hit the replay server as fast as the app tests do"""
+    import ratelimit
+    monkeypatch.setattr(ratelimit, 'LIMITER', ratelimit.AdaptiveLimiter(rate=100, max_rate=100))
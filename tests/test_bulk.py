@@ -0,0 +1,50 @@
+import json
+import threading
+import time
+from bulk import JobManager
+from executor import BoundedExecutor
+
+def results(client, job_id):
+    response = client.get(f'/api/v1/jobs/{job_id}/results')
+    assert response.status_code == 200
+    return sorted((json.loads(line) for line in response.text.splitlines()), key=lambda line: line['row'])
+
+def test_json_rows_are_streamed_back(client, site_values):
+    rows = [{'name': site_values(2)}, {'unknown': 'x'}, {'name': site_values(1)}]
+    job = client.post('/api/v1/business/sweep/bulk', json=rows).json()
+    lines = results(client, job['id'])
+    assert [line['row'] for line in lines] == [0, 1, 2]
+    assert 'error' in lines[1] and 'error' not in lines[0] and 'error' not in lines[2]
+    assert len(next(iter(lines[0]['result'].values()))['result']['outer']) == 2
+    status = client.get(f'/api/v1/jobs/{job["id"]}').json()
+    assert (status['status'], status['total'], status['succeeded'], status['failed']) == ('done', 3, 2, 1)
+
+def test_csv_upload(client, site_values):
+    value = site_values(4)
+    csv = f'name,address\n{value},\n'.encode('utf-8')
+    job = client.post('/api/v1/business/sweep/bulk', files={'file': ('rows.csv', csv, 'text/csv')}).json()
+    [line] = results(client, job['id'])
+    assert line['search_terms'] == {'name': value}
+
+def test_invalid_requests(client):
+    assert client.post('/api/v1/business/sweep/bulk', json={'name': 'a'}).status_code == 422
+    assert client.get('/api/v1/jobs/unknown').status_code == 404
+    assert client.get('/api/v1/jobs/unknown/results').status_code == 404
+
+def test_rows_of_a_job_run_at_most_concurrency_at_once(tmp_path):
+    running, peak, lock = [0], [0], threading.Lock()
+    def lookup(site, command, search_terms):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return search_terms
+    executor = BoundedExecutor(8, 8)
+    jobs = JobManager(executor, lookup, folder=tmp_path, concurrency=2)
+    job = jobs.create_from_list('business', 'sweep', [{'name': str(i)} for i in range(10)])
+    lines = list(jobs.stream(job.id, poll=0.01))
+    assert len(lines) == 10 and job.status == 'done'
+    assert peak[0] == 2
+    executor.shutdown()
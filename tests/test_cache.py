@@ -0,0 +1,78 @@
+import threading
+import time
+import cache
+from cache import ResultCache, FRESH, STALE, MISS
+
+def test_fresh_then_stale_then_miss(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    results = ResultCache(ttl={'sweep': 10}, stale_ttl=5)
+    results.set('business', 'sweep', {'name': 'Hòa Bình'}, {'outer': []})
+    assert results.get('business', 'sweep', {'name': ' hòa  BÌNH'}) == ({'outer': []}, FRESH, 0)
+    now[0] += 12
+    assert results.get('business', 'sweep', {'name': 'hòa bình'})[1] == STALE
+    now[0] += 5
+    assert results.get('business', 'sweep', {'name': 'hòa bình'}) == (None, MISS, None)
+    assert (results.hits, results.stale_hits, results.misses) == (1, 1, 1)
+
+def test_options_are_part_of_the_key():
+    results = ResultCache()
+    results.set('business', 'pinpoint', {'name': 'a'}, 1, {'subtables': ['chinhanh']})
+    assert results.get('business', 'pinpoint', {'name': 'a'})[1] == MISS
+    assert results.get('business', 'pinpoint', {'name': 'a'}, {'subtables': ['chinhanh']})[0] == 1
+
+def test_disk_tier_survives_the_process(tmp_path):
+    path = tmp_path / 'cache.sqlite3'
+    ResultCache(path=path).set('personal', 'pinpoint', {'taxnum': '01'}, {'outer': [1]})
+    assert ResultCache(path=path).get('personal', 'pinpoint', {'taxnum': '01'})[:2] == ({'outer': [1]}, FRESH)
+
+def test_memory_tier_is_bounded():
+    results = ResultCache(memory_size=2)
+    for value in 'abc':
+        results.set('business', 'sweep', {'name': value}, value)
+    assert results.get('business', 'sweep', {'name': 'a'})[1] == MISS
+    assert results.get('business', 'sweep', {'name': 'c'})[1] == FRESH
+
+def test_stale_entry_is_served_and_refreshed_once(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    results = ResultCache(ttl={'sweep': 10})
+    results.set('business', 'sweep', {'name': 'a'}, 'old')
+    now[0] += 11
+    scheduled = []
+    lookup = lambda site, command, search_terms: 'new'
+    assert results.fetch('business', 'sweep', {'name': 'a'}, lookup, scheduled.append)[:2] == ('old', STALE)
+    results.fetch('business', 'sweep', {'name': 'a'}, lookup, scheduled.append)
+    assert len(scheduled) == 1 # a refresh is already on its way
+    scheduled[0]()
+    assert results.get('business', 'sweep', {'name': 'a'})[:2] == ('new', FRESH)
+
+def test_miss_calls_the_lookup():
+    results = ResultCache()
+    calls = []
+    def lookup(site, command, search_terms, **options):
+        calls.append(options)
+        return 'value'
+    assert results.fetch('business', 'pinpoint', {'name': 'a'}, lookup, options={'subtables': ['daidien']}) \
+        == ('value', MISS, 0)
+    assert calls == [{'subtables': ['daidien']}]
+    assert cache.make_key('business', 'pinpoint', {'name': 'A'}) == cache.make_key('business', 'pinpoint', {'name': 'a'})
+
+def test_memory_only_get_leaves_the_disk_to_the_caller(tmp_path):
+    path = tmp_path / 'cache.sqlite3'
+    ResultCache(path=path).set('business', 'sweep', {'name': 'a'}, 'value')
+    results = ResultCache(path=path)
+    assert results.get('business', 'sweep', {'name': 'a'}, disk=False) == (None, MISS, None)
+    assert results.misses == 0
+    assert results.get('business', 'sweep', {'name': 'a'})[:2] == ('value', FRESH)
+    assert results.get('business', 'sweep', {'name': 'a'}, disk=False)[:2] == ('value', FRESH)
+
+def test_memory_tier_is_not_blocked_by_a_disk_write(tmp_path):
+    results = ResultCache(path=tmp_path / 'cache.sqlite3')
+    results.set('business', 'sweep', {'name': 'a'}, 'value')
+    found = []
+    with results._db_lock: # e.g. a worker waiting for a commit
+        reader = threading.Thread(target=lambda: found.append(results.get('business', 'sweep', {'name': 'a'}, disk=False)))
+        reader.start()
+        reader.join(5)
+    assert found and found[0][:2] == ('value', FRESH)
@@ -0,0 +1,32 @@
+import threading
+import pytest
+from selenium.common.exceptions import TimeoutException
+from capture import ResponseRing
+
+def test_only_scoped_responses_are_kept_up_to_size():
+    ring = ResponseRing([r'captcha\.png', r'\.jsp'], size=2)
+    assert not ring.add('http://site/style.css', b'css')
+    for i in range(3):
+        assert ring.add(f'http://site/captcha.png?{i}', b'png')
+    ring.add('http://site/mstdn.jsp', b'page')
+    assert ring.stats() == {'responses': 3, 'bytes': 10}
+    ring.clear()
+    assert ring.stats() == {'responses': 0, 'bytes': 0}
+
+def test_wait_for_the_response_after_the_mark():
+    ring = ResponseRing([r'captcha\.png'])
+    ring.add('http://site/captcha.png?old', b'old')
+    mark = ring.mark()
+    ring.add('http://site/captcha.png?1', b'first')
+    ring.add('http://site/captcha.png?2', b'second')
+    assert ring.wait('captcha', mark) == b'first'
+    assert ring.wait('captcha', mark, latest=True) == b'second'
+    assert ring.wait('captcha') == b'old'
+
+def test_wait_blocks_until_the_response_arrives():
+    ring = ResponseRing([r'\.jsp'])
+    mark = ring.mark()
+    threading.Timer(0.05, ring.add, ('http://site/mstdn.jsp', b'page')).start()
+    assert ring.wait(r'mstdn\.jsp', mark, timeout=5) == b'page'
+    with pytest.raises(TimeoutException):
+        ring.wait(r'mstdn\.jsp', ring.mark(), timeout=0.05)
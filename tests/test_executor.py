@@ -0,0 +1,30 @@
+import threading
+import pytest
+import webapi
+from executor import BoundedExecutor, ExecutorSaturated
+
+def test_rejects_beyond_workers_and_queue():
+    executor = BoundedExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    futures = [executor.submit(release.wait, 5) for _ in range(2)]
+    with pytest.raises(ExecutorSaturated):
+        executor.submit(release.wait, 5)
+    release.set()
+    assert all(future.result(5) for future in futures)
+    stats = executor.stats()
+    assert (stats['completed'], stats['rejected'], stats['running'], stats['queued']) == (2, 1, 0, 0)
+    executor.submit(lambda: None).result(5) # slots are given back
+    executor.shutdown()
+
+def test_api_answers_429_when_saturated(client, monkeypatch):
+    saturated = BoundedExecutor(max_workers=1, max_queue=0)
+    release = threading.Event()
+    saturated.submit(release.wait, 5)
+    monkeypatch.setattr(webapi, 'executor', saturated)
+    try:
+        response = client.get('/api/v1/business/pinpoint', params={'term': 'name', 'value': 'saturated 1'})
+    finally:
+        release.set()
+        saturated.shutdown()
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '5'
@@ -0,0 +1,44 @@
+import csv
+import io
+import json
+import pytest
+import export
+
+def test_flatten_maps_headers_to_columns():
+    record = {'outer': {'STT': '1', 'MST': '01', 'Tên người nộp thuế': 'HÒA'},
+              'inner': [{'Mã số thuế': '01'}, {'Tình trạng': 'Đang hoạt động'}, {'Điện thoại': '0123'}],
+              'sub': {'chinhanh': [{'Tên': 'CN1'}], 'unknown': []}}
+    row = export.flatten(record, input_row=3, search={'name': 'hòa'})
+    assert list(row) == list(export.SCHEMA)
+    assert (row['taxnum'], row['name'], row['row'], row['status']) == ('01', 'HÒA', '1', 'Đang hoạt động')
+    assert json.loads(row['extra']) == {'Điện thoại': '0123'}
+    assert json.loads(row['sub_chinhanh']) == [{'Tên': 'CN1'}]
+    assert row['sub_daidien'] is None
+    assert (row['input_row'], json.loads(row['search'])) == (3, {'name': 'hòa'})
+
+def test_pinpoint_details_only_its_first_row():
+    result = {'outer': [{'MST': '01'}, {'MST': '02'}], 'inner': [{'Tình trạng': 'x'}]}
+    records = list(export.iter_records('pinpoint', result))
+    assert [record.get('inner') for record in records] == [[{'Tình trạng': 'x'}], None]
+    assert list(export.iter_records('sweep', None)) == []
+
+def test_csv_is_written_in_batches():
+    rows = [export.flatten({'outer': {'MST': f'{i:02}'}}, page=1) for i in range(5)]
+    chunks = list(export.export(rows, 'csv', batch_size=2))
+    assert len(chunks) == 4 # the header with the first row, two full batches, the rest on close
+    text = b''.join(chunks).decode('utf-8-sig')
+    lines = list(csv.reader(io.StringIO(text)))
+    assert lines[0] == list(export.SCHEMA)
+    assert [line[export.SCHEMA.index('taxnum')] for line in lines[1:]] == ['00', '01', '02', '03', '04']
+
+def test_result_rows_of_a_bulk_job():
+    lines = [json.dumps({'row': 0, 'search_terms': {'name': 'a'},
+                         'result': {"{'name': 'a'}": {'command': 'sweep', 'result': {'outer': [{'MST': '01'}]}}}}),
+             json.dumps({'row': 1, 'search_terms': {'name': 'b'}, 'error': 'UpstreamError()'})]
+    rows = list(export.result_rows(lines))
+    assert [(row['input_row'], row['taxnum'], row['error']) for row in rows] == [(0, '01', None),
+                                                                              (1, None, 'UpstreamError()')]
+
+def test_unknown_format():
+    with pytest.raises(export.UnsupportedFormat):
+        export.create_writer('xml')
@@ -0,0 +1,73 @@
+import pytest
+from replay_server import OracleSolver
+from httpscraper import HttpBusinessProfileScraper, HttpPersonalProfileScraper
+from metrics import CAPTCHA_STATS
+
+pytestmark = pytest.mark.usefixtures('unthrottled')
+
+def taxnums(rows):
+    return [row['MST'] for row in rows]
+
+def test_pinpoint_reads_the_first_profile(replay, site_values):
+    value = site_values(3)
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        result = scraper.pinpoint({'name': value})
+    expected = replay[0].RequestHandlerClass.site.taxnums(value)
+    assert taxnums(result['outer']) == expected
+    assert result['inner'][0] == {'Mã số thuế': expected[0]}
+
+def test_sweep_follows_every_page(replay, site_values):
+    value = site_values(20)
+    with HttpPersonalProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        result = scraper.sweep({'name': value})
+    assert taxnums(result['outer']) == replay[0].RequestHandlerClass.site.taxnums(value)
+
+def test_empty_search(replay):
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        assert scraper.pinpoint({'name': 'empty'}) is None
+        assert scraper.sweep({'name': 'empty'}) == {'outer': []}
+
+class WrongFirst(OracleSolver):
+    """Get the first captcha wrong"""
+    def solve_many(self, raw_inputs):
+        answers = super().solve_many(raw_inputs)
+        if not hasattr(self, 'wrong'):
+            self.wrong = answers[0] = answers[0]._replace(label='xxxxx')
+        return answers
+
+def test_rejected_captcha_is_answered_again(replay, site_values):
+    value = site_values(3)
+    rejected = CAPTCHA_STATS.rejected
+    with HttpBusinessProfileScraper(solver=WrongFirst(), base_url=replay[1]) as scraper:
+        result = scraper.sweep({'name': value})
+    assert taxnums(result['outer']) == replay[0].RequestHandlerClass.site.taxnums(value)
+    assert CAPTCHA_STATS.rejected == rejected + 1
+
+def test_parallel_subtables_match_sequential_ones(replay, site_values):
+    value = site_values(3)
+    results = []
+    for parallel in (True, False):
+        with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+            scraper.parallel_subtables = parallel
+            results.append(scraper.pinpoint({'name': value}))
+    assert list(results[0]['sub']) == list(HttpBusinessProfileScraper.subtables)
+    assert results[0] == results[1]
+
+def test_selected_subtables_only(replay, site_values):
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        result = scraper.pinpoint({'name': site_values(3)}, subtables=['chinhanh', 'nganhkinhdoanh'])
+    assert list(result['sub']) == ['chinhanh', 'nganhkinhdoanh']
+
+def test_harvest_details_every_record_with_the_captchas_of_a_sweep(replay, site_values):
+    value = site_values(20)
+    expected = replay[0].RequestHandlerClass.site.taxnums(value)
+    solved = CAPTCHA_STATS.solved
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        scraper.sweep({'name': value})
+    sweep_captchas, solved = CAPTCHA_STATS.solved - solved, CAPTCHA_STATS.solved
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        records = scraper.harvest({'name': value}, subtables=['chinhanh'])
+    assert CAPTCHA_STATS.solved - solved == sweep_captchas
+    assert taxnums(record['outer'] for record in records) == expected
+    assert [record['inner'][0] for record in records] == [{'Mã số thuế': taxnum} for taxnum in expected]
+    assert all(list(record['sub']) == ['chinhanh'] for record in records)
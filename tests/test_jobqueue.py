@@ -0,0 +1,89 @@
+import time
+import uuid
+import pytest
+from jobqueue import JobQueue, RedisJobQueue, JobFailed, create_queue, QUEUED, LEASED, DONE, FAILED
+from ratelimit import UpstreamError
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def jobs(request, tmp_path):
+    options = {'lease': 0.2, 'max_attempts': 2, 'timeout': 1, 'poll': 0.01}
+    if request.param == 'redis':
+        client = request.getfixturevalue('redis_client')
+        jobs = RedisJobQueue(prefix=f'test:{uuid.uuid4().hex}', client=client, **options)
+    else:
+        jobs = JobQueue(tmp_path / 'jobs.sqlite3', **options)
+    yield jobs
+    if request.param == 'redis':
+        client.delete(*client.keys(f'{jobs.prefix}:*'))
+    jobs.close()
+
+def test_identical_lookups_share_a_job(jobs):
+    first = jobs.put('business', 'sweep', {'name': 'Hòa'})
+    assert jobs.put('business', 'sweep', {'name': 'hòa'}) == first
+    assert jobs.put('business', 'sweep', {'name': 'hòa'}, {'max_page': 2}) != first
+
+def test_expired_lease_is_claimed_again(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    job = jobs.claim('crashed')
+    assert (job['id'], job['attempt']) == (job_id, 1)
+    assert jobs.claim('other') is None # still leased
+    time.sleep(0.3)
+    job = jobs.claim('other')
+    assert (job['id'], job['attempt']) == (job_id, 2)
+    assert not jobs.ack(job_id, 'crashed', 'late') # lost its lease
+    assert jobs.ack(job_id, 'other', {'ok': 1})
+    assert jobs.wait(job_id) == {'ok': 1}
+
+def test_lease_expiring_too_often_fails_the_job(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    for worker in ('w1', 'w2'):
+        assert jobs.claim(worker)['id'] == job_id
+        time.sleep(0.3)
+    assert jobs.claim('w3') is None
+    with pytest.raises(JobFailed):
+        jobs.wait(job_id)
+    assert jobs.stats()[FAILED] == 1
+
+def test_renewed_lease_is_kept(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    jobs.claim('w1')
+    for _ in range(3):
+        time.sleep(0.1)
+        assert jobs.renew([job_id], 'w1') == []
+    assert jobs.claim('w2') is None
+    assert jobs.stats()[LEASED] == 1
+
+def test_nack_retries_then_raises_upstream_errors(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    jobs.claim('w1')
+    assert jobs.nack(job_id, 'w1', UpstreamError('503'), retry=True)
+    assert jobs.stats()[QUEUED] == 1
+    jobs.claim('w1')
+    jobs.nack(job_id, 'w1', UpstreamError('503'), retry=True) # no attempt left
+    with pytest.raises(UpstreamError):
+        jobs.wait(job_id)
+
+def test_wait_times_out(jobs):
+    from jobqueue import JobTimeout
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    with pytest.raises(JobTimeout):
+        jobs.wait(job_id, timeout=0.05)
+    assert jobs.stats()[DONE] == 0
+
+def test_finished_jobs_are_purged(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'a'})
+    jobs.claim('w1')
+    jobs.ack(job_id, 'w1', 1)
+    assert jobs.stats()[DONE] == 1
+    jobs.max_age = 0
+    jobs.purge()
+    assert jobs.stats()[DONE] == 0
+    with pytest.raises(KeyError):
+        jobs.get(job_id)
+
+def test_config_picks_the_broker(tmp_path):
+    assert create_queue({'enabled': False}) is None
+    jobs = create_queue({'enabled': True, 'broker': 'sqlite', 'path': str(tmp_path / 'jobs.sqlite3'),
+                         'url': 'redis://localhost:6379/0', 'prefix': 'jobs', 'worker': {'concurrency': 2}})
+    assert isinstance(jobs, JobQueue)
+    jobs.close()
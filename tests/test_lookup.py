@@ -0,0 +1,55 @@
+import threading
+import webapi
+from cache import ResultCache
+
+def test_lookup_then_cache_hit(client, site_values):
+    params = {'term': 'name', 'value': site_values(3), 'timings': 'true'}
+    first = client.get('/api/v1/business/sweep', params=params)
+    assert first.status_code == 200 and first.headers['X-Cache'] == 'MISS'
+    assert 'submit' in first.json()['timings']
+    second = client.get('/api/v1/business/sweep', params=params)
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.json()['result'] == first.json()['result']
+
+def test_disk_hit_is_read_by_the_worker(client, tmp_path, monkeypatch):
+    path = tmp_path / 'cache.sqlite3'
+    ResultCache(path=path).set('business', 'sweep', {'name': 'on disk'}, {'outer': ['cached']})
+    results = ResultCache(path=path)
+    reads = []
+    get = results.get
+    def spy(*args, **kwargs):
+        reads.append((kwargs.get('disk', True), threading.current_thread().name))
+        return get(*args, **kwargs)
+    monkeypatch.setattr(results, 'get', spy)
+    monkeypatch.setattr(webapi, 'cache', results)
+    response = client.get('/api/v1/business/sweep', params={'term': 'name', 'value': 'on disk'})
+    assert response.headers['X-Cache'] == 'HIT' and response.json() == {'outer': ['cached']}
+    assert [disk for disk, _ in reads] == [False, True]
+    assert not reads[0][1].startswith('scraper') and reads[1][1].startswith('scraper') # in a worker thread
+
+def test_status_does_not_load_a_solver(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, 'SOLVER', None)
+    response = client.get('/api/v1/status')
+    assert response.status_code == 200
+    assert set(response.json()['solver']) == {'captcha'}
+    assert main.SOLVER is None
+
+def test_harvest_timings_include_the_detail_threads(client, site_values):
+    params = {'term': 'name', 'value': site_values(2), 'timings': 'true'}
+    response = client.get('/api/v1/business/harvest', params=params)
+    assert response.status_code == 200
+    [lookup] = response.json()['result'].values()
+    assert len(lookup['result']) == 2
+    assert {'detail', 'subtables', 'parse'} <= set(response.json()['timings'])
+    assert 'detail;dur=' in response.headers['Server-Timing']
+
+def test_subtables_parameter(client, site_values):
+    params = {'term': 'name', 'value': site_values(3), 'subtables': 'nganhkinhdoanh, chinhanh'}
+    response = client.get('/api/v1/business/pinpoint', params=params)
+    assert response.status_code == 200
+    [lookup] = response.json().values()
+    assert list(lookup['result']['sub']) == ['chinhanh', 'nganhkinhdoanh']
+    assert client.get('/api/v1/business/pinpoint', params={**params, 'subtables': 'nope'}).status_code == 422
+    assert client.get('/api/v1/business/sweep', params=params).status_code == 422
+    assert client.get('/api/v1/personal/pinpoint', params=params).status_code == 422
@@ -0,0 +1,11 @@
+from prometheus_client import CollectorRegistry
+import metrics
+
+def test_register_again_replaces_the_sources(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', CollectorRegistry()) # leave the app's collector alone
+    monkeypatch.setattr(metrics, '_collector', None)
+    flights = lambda in_flight: lambda: {'in_flight': in_flight, 'leaders': 0, 'coalesced': 0}
+    metrics.register(flights=flights(1))
+    metrics.register(flights=flights(2)) # e.g. the app started again
+    body = metrics.latest()[0].decode()
+    assert 'lookups_in_flight 2.0' in body and 'lookups_in_flight 1.0' not in body
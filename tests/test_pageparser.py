@@ -0,0 +1,28 @@
+import pytest
+from bs4 import BeautifulSoup
+from pages import sample_pages
+import pageparser
+
+PAGES = sample_pages()
+PARSERS = {'outer': pageparser.process_outer,
+           'empty': pageparser.process_outer,
+           'wrong_captcha': pageparser.process_outer,
+           'inner': pageparser.parse_inner,
+           'subtable': pageparser.parse_subtable}
+
+@pytest.mark.parametrize('kind', sorted(PARSERS))
+def test_lxml_path_matches_the_soup_path(kind):
+    parse, page = PARSERS[kind], PAGES[kind]
+    expected = parse(BeautifulSoup(page, 'html.parser'))
+    assert parse(page) == expected
+    assert parse(page.decode('utf-8')) == expected
+    assert parse(pageparser.to_document(page)) == expected
+
+def test_status_codes():
+    assert pageparser.process_outer(PAGES['empty']) == pageparser.EMPTY
+    assert pageparser.process_outer(PAGES['wrong_captcha']) == pageparser.WRONG_CAPTCHA
+    assert len(pageparser.process_outer(PAGES['outer'])) == 15
+
+def test_page_in_another_charset():
+    page = PAGES['outer'].decode('utf-8').replace('charset=UTF-8', 'charset=utf-16')
+    assert pageparser.process_outer(page.encode('utf-16')) == pageparser.process_outer(PAGES['outer'])
@@ -0,0 +1,104 @@
+import threading
+import pytest
+from pool import DriverPool, PoolExhausted, PoolManager, TabFactory
+
+class FakeDriver():
+    def __init__(self):
+        self.healthy = True
+        self.quitted = False
+        self.resets = 0
+
+    @property
+    def current_url(self):
+        if not self.healthy:
+            raise ConnectionError('browser is gone')
+        return 'about:blank'
+
+    def clear_responses(self):
+        self.resets += 1
+
+    def quit(self):
+        self.quitted = True
+
+def test_driver_is_reused_between_leases():
+    created = []
+    pool = DriverPool(lambda: created.append(FakeDriver()) or created[-1], min_size=1, max_size=2)
+    pool.warm_up()
+    for _ in range(3):
+        with pool.lease() as driver:
+            assert driver is created[0]
+    assert len(created) == 1 and created[0].resets == 3
+    assert pool.stats() == {'size': 1, 'idle': 1, 'min_size': 1, 'max_size': 2}
+
+def test_pool_waits_then_gives_up_when_full():
+    pool = DriverPool(FakeDriver, min_size=0, max_size=1, lease_timeout=0.1)
+    driver = pool.acquire()
+    with pytest.raises(PoolExhausted):
+        pool.acquire()
+    threading.Timer(0.05, pool.release, (driver,)).start()
+    pool.lease_timeout = 5
+    assert pool.acquire() is driver
+
+def test_unhealthy_and_worn_out_drivers_are_replaced():
+    pool = DriverPool(FakeDriver, min_size=0, max_size=1, max_uses=2)
+    first = pool.acquire()
+    pool.release(first)
+    first.healthy = False
+    second = pool.acquire()
+    assert second is not first and first.quitted
+    pool.release(second)
+    assert pool.acquire() is second
+    pool.release(second) # second use
+    assert second.quitted and pool.size == 0
+
+def test_failed_lease_discards_the_driver():
+    pool = DriverPool(FakeDriver, min_size=0, max_size=1)
+    with pytest.raises(RuntimeError):
+        with pool.lease() as driver:
+            raise RuntimeError('page broke')
+    assert driver.quitted and pool.size == 0
+
+def test_manager_applies_defaults_and_site_options():
+    pools = PoolManager({'business': FakeDriver, 'personal': FakeDriver},
+                        {'max_size': 3, 'personal': {'max_size': 1, 'min_size': 0}})
+    assert pools['business'].max_size == 3 and pools['personal'].max_size == 1
+    pools.warm_up()
+    assert pools.stats()['business']['size'] == 1 and pools.stats()['personal']['size'] == 0
+    pools.close()
+    with pytest.raises(RuntimeError):
+        pools['business'].acquire()
+
+class FakeBrowser():
+    def __init__(self, tabs=2):
+        self.tabs = tabs
+        self.opened = []
+        self.alive = True
+
+    def open_tab(self):
+        if not self.alive:
+            raise ConnectionError('browser is gone')
+        if len(self.opened) == self.tabs:
+            return None
+        self.opened.append(FakeDriver())
+        return self.opened[-1]
+
+def test_tabs_share_a_browser_until_it_is_full():
+    browsers = []
+    factory = TabFactory(lambda: browsers.append(FakeBrowser()) or browsers[-1])
+    tabs = [factory() for _ in range(3)]
+    assert len(browsers) == 2
+    assert tabs == browsers[0].opened + browsers[1].opened
+
+def test_dead_browser_is_replaced():
+    browsers = []
+    factory = TabFactory(lambda: browsers.append(FakeBrowser()) or browsers[-1])
+    factory()
+    browsers[0].alive = False
+    assert factory() is browsers[1].opened[0]
+
+def test_pool_of_tabs():
+    browsers = []
+    pool = DriverPool(TabFactory(lambda: browsers.append(FakeBrowser(tabs=3)) or browsers[-1]),
+                      min_size=0, max_size=3)
+    drivers = [pool.acquire() for _ in range(3)]
+    assert len(browsers) == 1 and len(set(map(id, drivers))) == 3
@@ -0,0 +1,49 @@
+import threading
+import time
+import pytest
+from replay_server import OracleSolver
+from httpscraper import HttpBusinessProfileScraper
+from metrics import CAPTCHA_STATS
+from prefetch import CaptchaPrefetch
+
+def test_answer_is_taken_once():
+    prefetch = CaptchaPrefetch()
+    assert prefetch.take() is None
+    prefetched = CAPTCHA_STATS.prefetched
+    prefetch.start(str.upper, 'abcde')
+    assert prefetch.pending and prefetch.take() == 'ABCDE'
+    assert not prefetch.pending and prefetch.take() is None
+    assert CAPTCHA_STATS.prefetched == prefetched + 1
+
+def test_failed_prefetch_is_solved_in_line():
+    prefetch = CaptchaPrefetch()
+    prefetch.start(int, 'not a number')
+    assert prefetch.take() is None
+
+def test_discarded_answer_is_counted():
+    started, release = threading.Event(), threading.Event()
+    def solve():
+        started.set()
+        release.wait(5)
+        return 'abcde'
+    prefetch = CaptchaPrefetch()
+    discarded = CAPTCHA_STATS.discarded
+    prefetch.start(solve)
+    started.wait(5)
+    prefetch.start(str, 'next') # replaces the answer being solved
+    assert prefetch.take() == 'next'
+    release.set()
+    deadline = time.monotonic() + 5
+    while CAPTCHA_STATS.discarded == discarded and time.monotonic() < deadline: # counted once it is solved
+        time.sleep(0.01)
+    assert CAPTCHA_STATS.discarded == discarded + 1
+
+@pytest.mark.usefixtures('unthrottled')
+def test_sweep_with_prefetched_captchas(replay, site_values):
+    value = site_values(40)
+    prefetched = CAPTCHA_STATS.prefetched
+    with HttpBusinessProfileScraper(solver=OracleSolver(), base_url=replay[1]) as scraper:
+        scraper.prefetch_captcha = True
+        result = scraper.sweep({'name': value})
+    assert [row['MST'] for row in result['outer']] == replay[0].RequestHandlerClass.site.taxnums(value)
+    assert CAPTCHA_STATS.prefetched > prefetched
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import pytest
+import solver
+from common import load_captchas
+from preprocess import Preprocessor
+
+needs_benchmark = pytest.mark.skipif("not config.pluginmanager.hasplugin('benchmark')",
+                                     reason='pip install pytest-benchmark')
+
+CAPTCHAS = [raw for _, raw in load_captchas(count=20)]
+
+def png(alpha):
+    image = np.zeros(alpha.shape + (4,), np.uint8)
+    image[:, :, 3] = alpha
+    return cv2.imencode('.png', image)[1].tobytes()
+
+def edge_touching():
+    alpha = np.zeros((50, 130), np.uint8)
+    alpha[0:20, 0:30] = 255 # top left corner
+    alpha[10:30, 110:130] = 255 # right edge
+    return png(alpha)
+
+BLANK = png(np.zeros((50, 130), np.uint8))
+
+@pytest.mark.parametrize('raw', CAPTCHAS + [edge_touching(), BLANK],
+                         ids=[f'captcha{i}' for i in range(len(CAPTCHAS))] + ['edge', 'blank'])
+def test_preprocessor_matches_preprocess_image(raw):
+    expected = solver.preprocess_image(raw)
+    assert np.array_equal(Preprocessor()([raw]), expected.astype(np.float32))
+    assert np.array_equal(Preprocessor(dtype=np.uint8)([raw]), expected)
+
+def test_edge_touching_image_keeps_its_padding():
+    image = Preprocessor()._clean(edge_touching())
+    assert image.shape == (32, 132) # rows 0 to 29 and every column, with a zero border
+    assert not image[0].any() and not image[-1].any() and not image[:, 0].any() and not image[:, -1].any()
+
+def test_blank_image_gives_a_blank_input():
+    assert not Preprocessor()([BLANK]).any()
+
+def test_buffer_is_reused_and_cleared():
+    preprocessor = Preprocessor()
+    first = preprocessor(CAPTCHAS[:4]).copy()
+    preprocessor(CAPTCHAS[4:12])
+    assert np.array_equal(preprocessor(CAPTCHAS[:4]), first)
+
+def test_decode_labels_matches_array_to_label():
+    predictions = np.random.default_rng(0).random((50, solver.VALID_SIZE, len(solver.VALID_CHAR)), np.float32)
+    assert solver.decode_labels(predictions) == [''.join(solver.array_to_label(p)) for p in predictions]
+
+@needs_benchmark
+def test_benchmark_preprocess_image(benchmark):
+    benchmark(lambda: [solver.preprocess_image(raw) for raw in CAPTCHAS])
+
+@needs_benchmark
+def test_benchmark_preprocessor(benchmark):
+    preprocessor = Preprocessor()
+    benchmark(preprocessor, CAPTCHAS)
+
+@needs_benchmark
+def test_benchmark_array_to_label(benchmark):
+    predictions = np.random.default_rng(0).random((32, solver.VALID_SIZE, len(solver.VALID_CHAR)), np.float32)
+    benchmark(lambda: [''.join(solver.array_to_label(p)) for p in predictions])
+
+@needs_benchmark
+def test_benchmark_decode_labels(benchmark):
+    predictions = np.random.default_rng(0).random((32, solver.VALID_SIZE, len(solver.VALID_CHAR)), np.float32)
+    benchmark(solver.decode_labels, predictions)
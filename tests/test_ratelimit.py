@@ -0,0 +1,83 @@
+import time
+import pytest
+import ratelimit
+from ratelimit import AdaptiveLimiter, RetryPolicy, UpstreamError
+
+def test_requests_are_spaced_to_the_rate():
+    limiter = AdaptiveLimiter(rate=20, max_rate=20)
+    start = time.monotonic()
+    for _ in range(3):
+        with limiter.request():
+            pass
+    assert time.monotonic() - start >= 0.09
+    assert limiter.stats()['successes'] == 3 and limiter.stats()['waited'] > 0
+
+def test_rate_doubles_until_the_first_cut_then_grows_linearly():
+    limiter = AdaptiveLimiter(rate=1, max_rate=16, increase=0.5, window=0)
+    limiter.record(0.1)
+    assert limiter.rate == 1 # no request waited in the window
+    for expected in (2, 4):
+        limiter._window['waits'] = 1
+        limiter.record(0.1)
+        assert limiter.rate == expected
+    limiter.record(failed=True)
+    assert limiter.rate == 2
+    limiter._window['waits'] = 1
+    limiter.record(0.1)
+    assert limiter.rate == 2.5
+
+def test_slow_responses_and_upstream_errors_cut_the_rate():
+    limiter = AdaptiveLimiter(rate=4, min_rate=1, latency_target=0.5, window=0)
+    limiter.record(1.0)
+    assert limiter.rate == 2
+    with pytest.raises(UpstreamError):
+        with limiter.request():
+            raise UpstreamError('503')
+    assert limiter.rate == 1
+    with pytest.raises(KeyError):
+        with limiter.request():
+            raise KeyError('not the site')
+    stats = limiter.stats()
+    assert (stats['rate'], stats['slow'], stats['failures'], stats['in_flight']) == (1, 1, 1, 0)
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(rate=100, max_rate=16)
+
+def test_step_is_retried_after_restoring_it():
+    calls, restores = [], []
+    def step(value):
+        calls.append(value)
+        if len(calls) < 3:
+            raise UpstreamError('throttled')
+        return value
+    policy = RetryPolicy(attempts=3, backoff=0)
+    assert policy.call(step, 'page', before_retry=lambda: restores.append(1)) == 'page'
+    assert len(calls) == 3 and len(restores) == 2 and policy.retries == 2
+
+def test_retries_give_up_after_the_last_attempt():
+    calls = []
+    def step():
+        calls.append(1)
+        raise UpstreamError('down')
+    with pytest.raises(UpstreamError):
+        RetryPolicy(attempts=2, backoff=0).call(step)
+    assert len(calls) == 2
+    with pytest.raises(ValueError):
+        RetryPolicy(backoff=0).call(int, 'not a number')
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(backoff=1, max_backoff=3)
+    assert all(0 <= policy.delay(retry) <= 3 for retry in range(10))
+
+def test_configure_keeps_the_limiter_while_the_section_is_unchanged(monkeypatch):
+    monkeypatch.setattr(ratelimit, '_options', None)
+    monkeypatch.setattr(ratelimit, 'LIMITER', ratelimit.LIMITER)
+    monkeypatch.setattr(ratelimit, 'RETRY', ratelimit.RETRY)
+    ratelimit.configure({'rate': 2, 'retry': {'attempts': 5}})
+    limiter = ratelimit.LIMITER
+    assert limiter.rate == 2 and ratelimit.RETRY.attempts == 5
+    ratelimit.configure({'rate': 2, 'retry': {'attempts': 5}})
+    assert ratelimit.LIMITER is limiter
+    ratelimit.configure({'rate': 3})
+    assert ratelimit.LIMITER is not limiter and ratelimit.RETRY.attempts == 3
@@ -0,0 +1,68 @@
+import pytest
+from recordindex import RecordIndex, fold
+
+def outer(taxnum, name, row=1):
+    return {'STT': str(row), 'MST': taxnum, 'Tên người nộp thuế': name}
+
+def inner(taxnum, name, address):
+    return [{'Mã số thuế': taxnum}, {'Tên người nộp thuế': name}, {'Địa chỉ trụ sở': address}]
+
+def sweep_result(*rows):
+    return {'command': 'sweep', 'result': {'outer': [outer(t, n, i + 1) for i, (t, n) in enumerate(rows)]}}
+
+@pytest.fixture
+def index():
+    return RecordIndex()
+
+def test_fold_ignores_case_and_diacritics():
+    assert fold('Đường Hòa Bình') == 'duong hoa binh'
+
+def test_same_sweep_is_answered(index):
+    index.ingest('business', 'sweep', {'name': 'Hòa Bình'}, sweep_result(('01', 'CÔNG TY HÒA BÌNH')), max_page=9)
+    answer = index.answer('business', 'sweep', {'name': 'hòa bình'})
+    assert answer == {'command': 'sweep', 'result': {'outer': [outer('01', 'CÔNG TY HÒA BÌNH')]}}
+    assert index.answer('personal', 'sweep', {'name': 'hòa bình'}) is None
+
+def test_narrower_sweep_is_answered_from_a_complete_one(index):
+    index.ingest('business', 'sweep', {'name': 'hòa'},
+                 sweep_result(('01', 'HÒA BÌNH'), ('02', 'HÒA PHÁT'), ('03', 'AN HÒA BÌNH')), max_page=9)
+    answer = index.answer('business', 'sweep', {'name': 'hòa bình'})['result']['outer']
+    assert [(row['STT'], row['MST']) for row in answer] == [('1', '01'), ('2', '03')] # renumbered
+
+def test_sweep_cut_by_max_page_is_not_answered(index):
+    rows = [(f'{i:02}', f'HÒA {i}') for i in range(15)]
+    index.ingest('business', 'sweep', {'name': 'hòa'}, sweep_result(*rows), max_page=1)
+    assert index.answer('business', 'sweep', {'name': 'hòa 1'}) is None
+    assert index.answer('business', 'sweep', {'name': 'hòa'}) is None # the site may have more pages
+
+def test_harvest_needs_fresh_details(index):
+    index.ingest('business', 'sweep', {'name': 'hòa'}, sweep_result(('01', 'HÒA')), max_page=9)
+    assert index.answer('business', 'harvest', {'name': 'hòa'}) is None
+    sub = {name: [] for name in ('doanhnghiepchuquan', 'chinhanh', 'tructhuoc', 'daidien', 'loaithue',
+                                 'nganhkinhdoanh')}
+    index.ingest('business', 'harvest', {'name': 'hòa'},
+                 {'command': 'harvest', 'result': [{'outer': outer('01', 'HÒA'), 'inner': inner('01', 'HÒA', 'HN'),
+                                                    'sub': sub}]}, max_page=9)
+    result = index.answer('business', 'harvest', {'name': 'hòa'})['result']
+    assert result[0]['inner'] == inner('01', 'HÒA', 'HN') and result[0]['sub'] == sub
+    assert index.answer('business', 'harvest', {'name': 'hòa'}, max_page=2) is None
+
+def test_single_row_pinpoint_is_answered(index):
+    result = {'outer': [outer('01', 'HÒA')], 'inner': inner('01', 'HÒA', 'HN')}
+    index.ingest('personal', 'pinpoint', {'taxnum': '01'}, {'command': 'pinpoint', 'result': result})
+    assert index.answer('personal', 'pinpoint', {'taxnum': '01'}) == {'command': 'pinpoint', 'result': result}
+
+def test_multi_row_pinpoint_is_answered(index):
+    result = {'outer': [outer('01', 'HÒA', 1), outer('02', 'HÒA PHÁT', 2), outer('03', 'AN HÒA', 3)],
+              'inner': inner('01', 'HÒA', 'HN')}
+    index.ingest('personal', 'pinpoint', {'name': 'hòa'}, {'command': 'pinpoint', 'result': result})
+    assert index.answer('personal', 'pinpoint', {'name': 'hòa'}) == {'command': 'pinpoint', 'result': result}
+    # the other rows were not detailed, so a harvest still goes to the site
+    assert index.answer('personal', 'harvest', {'name': 'hòa'}) is None
+
+def test_search_by_token_prefix(index):
+    index.ingest('business', 'sweep', {'name': 'x'},
+                 sweep_result(('01', 'CÔNG TY HÒA BÌNH'), ('02', 'HÒA PHÁT')), max_page=9)
+    assert [r['taxnum'] for r in index.search('business', 'hoa bi')] == ['01']
+    assert {r['taxnum'] for r in index.search('business', 'HOA', field='name')} == {'01', '02'}
+    assert index.search('business', 'hoa', field='address') == []
@@ -0,0 +1,44 @@
+import requests
+import pageparser
+from common import make_captcha
+from load_test import search_values
+from replay_server import serve, add_label, read_label, WRONG_CAPTCHA, PAGE_SIZE
+
+def search(session, base_url, value, captcha=None, page=1):
+    if captcha is None:
+        captcha = read_label(session.get(base_url + 'captcha.png').content)
+    data = {'fullname': value, 'captcha': captcha, 'page': page}
+    return session.post(base_url + 'mstdn.jsp', data=data).content
+
+def test_label_round_trip():
+    png = make_captcha('a2b3c', seed=0)
+    assert read_label(add_label(png, 'a2b3c')) == 'a2b3c'
+    assert read_label(png) == ''
+
+def test_search_needs_the_captcha_of_the_session(replay, site_values):
+    value = site_values(20)
+    with requests.Session() as session:
+        assert WRONG_CAPTCHA.encode('utf-8') in search(session, replay[1], value, captcha='wrong')
+        rows = pageparser.process_outer(search(session, replay[1], value))
+        assert [row['MST'] for row in rows] == replay[0].RequestHandlerClass.site.taxnums(value)[:PAGE_SIZE]
+        assert len(pageparser.process_outer(search(session, replay[1], value, page=2))) == 5
+        assert pageparser.process_outer(search(session, replay[1], value, page=3)) == pageparser.EMPTY
+        assert pageparser.process_outer(search(session, replay[1], 'empty')) == pageparser.EMPTY
+
+def test_captcha_of_another_session_is_rejected(replay, site_values):
+    with requests.Session() as session, requests.Session() as other:
+        label = read_label(session.get(replay[1] + 'captcha.png').content)
+        assert WRONG_CAPTCHA.encode('utf-8') in search(other, replay[1], site_values(3), captcha=label)
+
+def test_errors_are_answered_503():
+    server, base_url = serve(errors=1.0)
+    try:
+        assert requests.get(base_url + 'captcha.png').status_code == 503
+        assert requests.get(base_url + 'css/style.css').status_code == 200
+    finally:
+        server.shutdown()
+
+def test_search_values_repeat():
+    assert search_values(5) == search_values(5)
+    assert len(set(search_values(5))) == 5
+    assert len(set(search_values(100, repeat=0.5))) < 75
@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from singleflight import SingleFlight
+
+def test_identical_calls_share_one_run():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    runs = []
+    def scrape(value):
+        runs.append(value)
+        started.set()
+        release.wait(5)
+        return value.upper()
+    with ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(flights.run, 'key', scrape, 'a')
+        started.wait(5)
+        followers = [pool.submit(flights.run, 'key', scrape, 'a') for _ in range(3)]
+        while flights.stats()['coalesced'] < 3:
+            pass
+        release.set()
+        assert [f.result(5) for f in [leader, *followers]] == ['A'] * 4
+    assert runs == ['a']
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 3}
+
+def test_exception_is_shared_then_forgotten():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError('site down')
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flights.run, 'key', fail)
+        started.wait(5)
+        follower = pool.submit(flights.run, 'key', fail)
+        while flights.stats()['coalesced'] < 1:
+            pass
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result(5)
+    assert flights.join('key') is None
+    assert flights.run('key', lambda: 'again') == 'again'
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+import numpy as np
+import pytest
+import solver
+
+def test_batching_keeps_the_input_dtype_of_its_backend():
+    rest = solver.BatchingBackend(solver.RestBackend())
+    assert rest.input_dtype is np.uint8
+    assert solver.BatchingBackend(object()).input_dtype is np.float32
+
+def joint_softmax(label, margin=20.0):
+    """Output of the shipped model: one softmax over the 5*23 values, reshaped per character"""
+    logits = np.zeros((1, solver.VALID_SIZE * len(solver.VALID_CHAR)), np.float32)
+    for position, char in enumerate(label):
+        logits[0, position * len(solver.VALID_CHAR) + solver.VALID_CHAR.index(char)] = margin
+    exp = np.exp(logits - logits.max())
+    return (exp / exp.sum()).reshape(1, solver.VALID_SIZE, len(solver.VALID_CHAR))
+
+class FixedBackend():
+    def __init__(self, predictions):
+        self.predictions = predictions
+
+    def predict_batch(self, batch):
+        return np.repeat(self.predictions, len(batch), axis=0)
+
+def test_joint_softmax_confident_prediction_scores_near_one():
+    labels, char_confidence, confidence = solver.decode_with_confidence(joint_softmax('ab2y8'))
+    assert labels == ['ab2y8']
+    assert np.allclose(char_confidence, 1, atol=1e-4) and confidence[0] > 0.999
+
+def test_logits_are_turned_into_probabilities():
+    logits = np.log(joint_softmax('ab2y8')) # negative values
+    labels, _, confidence = solver.decode_with_confidence(logits)
+    assert labels == ['ab2y8'] and confidence[0] > 0.999
+
+def test_flat_prediction_is_not_confident():
+    predictions = np.full((1, solver.VALID_SIZE, len(solver.VALID_CHAR)), 1 / 115, np.float32)
+    _, char_confidence, confidence = solver.decode_with_confidence(predictions)
+    assert np.allclose(char_confidence, 1 / len(solver.VALID_CHAR)) and confidence[0] < 1e-6
+
+def answer_with(replay, predictions, threshold=0.9):
+    """Answer the first captcha of the replay site. Return (label, captchas refreshed)"""
+    from httpscraper import HttpBusinessProfileScraper
+    manager = solver.SolverManager(backend=FixedBackend(predictions), confidence_threshold=threshold, max_refresh=2)
+    refreshed = solver.CAPTCHA_STATS.refreshed
+    with HttpBusinessProfileScraper(solver=manager, base_url=replay[1]) as scraper:
+        scraper._open()
+        label = scraper._answer_captcha()
+    return label, solver.CAPTCHA_STATS.refreshed - refreshed
+
+def test_confident_answer_is_submitted_at_once(replay):
+    assert answer_with(replay, joint_softmax('ab2y8')) == ('ab2y8', 0)
+
+def test_doubtful_answer_is_refreshed_up_to_max_refresh(replay):
+    flat = np.full((1, solver.VALID_SIZE, len(solver.VALID_CHAR)), 1 / 115, np.float32)
+    label, refreshed = answer_with(replay, flat)
+    assert refreshed == 2 and len(label) == solver.VALID_SIZE
+
+def test_local_backend_falls_back_to_rest(tmp_path):
+    backend = solver.create_backend({'backend': 'onnx', 'model_path': str(tmp_path / 'missing.onnx'),
+                                     'url': 'http://solver:8501/v1/models/solver:predict', 'encoding': 'columnar',
+                                     'confidence_threshold': 0.5, 'max_refresh': 2})
+    assert isinstance(backend, solver.RestBackend)
+    assert (backend.url, backend.encoding) == ('http://solver:8501/v1/models/solver:predict', 'columnar')
+
+class RecordingBackend():
+    """Predict the mean of each image, remembering the size of every batch"""
+    def __init__(self):
+        self.sizes = []
+
+    def predict_batch(self, batch):
+        time.sleep(0.01)
+        self.sizes.append(len(batch))
+        return np.asarray(batch).reshape(len(batch), -1).mean(axis=1, keepdims=True)
+
+def test_concurrent_predictions_share_batches():
+    backend = RecordingBackend()
+    batching = solver.BatchingBackend(backend, max_size=4, max_delay=0.05)
+    barrier = threading.Barrier(8)
+    answers = {}
+    def predict(value):
+        barrier.wait()
+        answers[value] = batching.predict_batch(np.full((1, 2, 2, 1), value, np.float32))[0, 0]
+    threads = [threading.Thread(target=predict, args=(value,)) for value in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert answers == {value: value for value in range(8)} # each caller gets its own prediction
+    assert sum(backend.sizes) == 8 and max(backend.sizes) <= 4 and len(backend.sizes) < 8
+    assert batching.stats()['images'] == 8
+
+def test_batch_failure_reaches_every_caller():
+    class Failing():
+        def predict_batch(self, batch):
+            raise ConnectionError('solver is down')
+    batching = solver.BatchingBackend(Failing(), max_delay=0)
+    with pytest.raises(ConnectionError):
+        batching.predict_batch(np.zeros((2, 2, 2, 1), np.float32))
+
+def test_compact_json_matches_tolist():
+    batch = np.random.default_rng(0).integers(0, 256, (2, 64, 128, 1), dtype=np.uint8)
+    for encoding, key in (('row', 'instances'), ('columnar', 'inputs')):
+        body = solver.encode_json(batch, encoding)
+        assert ' ' not in body
+        assert json.loads(body) == {key: batch.tolist()}
+    floats = batch.astype(np.float32) / 255
+    assert json.loads(solver.encode_json(floats)) == {'instances': floats.tolist()}
+
+def test_decode_json_reads_both_formats():
+    predictions = [[[0.5, 0.5]]]
+    for key in ('predictions', 'outputs'):
+        decoded = solver.decode_json(json.dumps({key: predictions}).encode())
+        assert decoded.dtype == np.float32 and decoded.tolist() == predictions
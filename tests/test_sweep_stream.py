@@ -0,0 +1,54 @@
+import itertools
+import json
+import threading
+import time
+import webapi
+
+def stream(client, **params):
+    response = client.get('/api/v1/business/sweep/stream', params=params)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_cursor_resumes_the_sweep(client, site_values):
+    value = site_values(20)
+    lines = stream(client, term='name', value=value)
+    assert [line['page'] for line in lines] == [1, 2]
+    assert [len(line['outer']) for line in lines] == [15, 5]
+    assert lines[0]['cursor'] and lines[-1]['cursor'] is None
+    resumed = stream(client, cursor=lines[0]['cursor'])
+    assert [line['page'] for line in resumed] == [2]
+    assert resumed[0]['outer'] == lines[1]['outer']
+
+def test_max_page_ends_the_sweep(client, site_values):
+    lines = stream(client, term='name', value=site_values(35), max_page=2)
+    assert [line['page'] for line in lines] == [1, 2]
+    assert lines[-1]['cursor'] is None
+
+def test_cursor_of_another_site_is_rejected(client, site_values):
+    cursor = stream(client, term='name', value=site_values(16))[0]['cursor']
+    response = client.get('/api/v1/personal/sweep/stream', params={'cursor': cursor})
+    assert response.status_code == 422
+
+def test_full_last_page_ends_with_a_null_cursor(client, site_values):
+    lines = stream(client, term='name', value=site_values(15))
+    assert [line['page'] for line in lines] == [1, 2]
+    assert [len(line['outer']) for line in lines] == [15, 0]
+    assert lines[-1]['cursor'] is None
+    resumed = stream(client, cursor=lines[0]['cursor'])
+    assert [(line['page'], line['outer'], line['cursor']) for line in resumed] == [(2, [], None)]
+
+def test_unread_sweep_waits_for_room_then_stops_once_closed(client, monkeypatch):
+    produced, closed = [], threading.Event()
+    def endless(site, search_terms, pools, start_page, max_page):
+        try:
+            for page in itertools.count(start_page):
+                produced.append(page)
+                yield {'page': page, 'outer': [], 'next_page': page + 1}
+        finally:
+            closed.set()
+    monkeypatch.setattr(webapi, 'iter_sweep', endless)
+    pages = webapi.SweepPages('business', {'name': 'a'}, 1, None, ahead=2)
+    time.sleep(0.3)
+    assert produced == [1, 2, 3] # two pages waiting for the reader, the third one for room
+    pages.close() # e.g. the client went away before the first line
+    assert closed.wait(5) and produced == [1, 2, 3]
@@ -0,0 +1,36 @@
+import subprocess
+import sys
+from pathlib import Path
+import yaml
+import utility
+
+def write(folder, **sections):
+    for name, values in sections.items():
+        (folder / f'{name}.yaml').write_text(yaml.dump(values))
+
+def test_config_is_loaded_once(tmp_path, monkeypatch):
+    write(tmp_path, logging={'version': 1}, scraper={'engine': 'http'})
+    configured = []
+    monkeypatch.setattr(utility, '_config', None)
+    monkeypatch.setattr(utility, 'init_logger', configured.append)
+    config = utility.load_config(tmp_path)
+    write(tmp_path, scraper={'engine': 'browser'})
+    assert utility.load_config(tmp_path) is config and config['scraper'] == {'engine': 'http'}
+    assert configured == [{'version': 1}]
+
+def test_watcher_reloads_in_place(tmp_path):
+    write(tmp_path, scraper={'engine': 'http'}, reload={'enabled': True})
+    config = utility.import_config(tmp_path)
+    changes = []
+    watcher = utility.ConfigWatcher(config, tmp_path, on_change=changes.append)
+    write(tmp_path, scraper={'engine': 'browser'})
+    (tmp_path / 'reload.yaml').unlink()
+    watcher.reload()
+    assert config == {'scraper': {'engine': 'browser'}} and changes == [config]
+
+def test_importing_the_api_loads_no_browser_or_model():
+    modules = ('selenium', 'seleniumwire', 'cv2', 'onnxruntime', 'tensorflow')
+    code = f'import sys, webapi; print([name for name in {modules!r} if name in sys.modules])'
+    output = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).resolve().parent.parent / 'app', capture_output=True, text=True,
+                            check=True).stdout
+    assert output.strip() == '[]'
@@ -0,0 +1,32 @@
+import threading
+import time
+import uuid
+import pytest
+from jobqueue import JobQueue, RedisJobQueue
+from worker import Worker
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def jobs(request, tmp_path):
+    if request.param == 'redis':
+        return RedisJobQueue(prefix=f'test:{uuid.uuid4().hex}', client=request.getfixturevalue('redis_client'),
+                             lease=0.3, poll=0.01)
+    return JobQueue(tmp_path / 'jobs.sqlite3', lease=0.3, poll=0.01)
+
+def test_leases_are_renewed_until_running_lookups_finish(jobs):
+    job_id = jobs.put('business', 'pinpoint', {'name': 'slow'})
+    started = threading.Event()
+    def lookup(site, command, search_terms, **options):
+        started.set()
+        time.sleep(1) # outlives the lease, after stop() was called
+        return {'done': True}
+    worker = Worker(jobs, lookup, concurrency=1, name='w1', poll=0.01)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    started.wait(5)
+    worker.stop()
+    time.sleep(0.5)
+    assert jobs.claim('w2') is None # still held by w1
+    thread.join(5)
+    assert jobs.wait(job_id, timeout=1) == {'done': True}
+    assert worker.succeeded == 1
+    jobs.close()